@@ -6,8 +6,9 @@ import os
 import sys
 
 from jinja2 import Template
-from yoconfigurator.smush import (config_sources, local_config_sources,
-                                  smush_config)
+from yoconfigurator.smush import config_sources, local_config_sources
+
+from yodeploy.smush import smush_config
 
 
 log = logging.getLogger('test_templates')
@@ -23,7 +24,7 @@ def build_config(app, env, cluster, local, deployconfigs):
         sources = itertools.chain(sources,
                 local_config_sources(app, deployconfigs, app_config))
 
-    return smush_config(sources)
+    return smush_config(sources, environment=env, cluster=cluster)
 
 
 def template(filename, app, config):
@@ -1,12 +1,15 @@
 import errno
+import json
 import logging
 import os
 import shutil
 import subprocess
+import tarfile
 
 import yodeploy.config
 import yodeploy.ipc_logging
-from yodeploy import virtualenv
+from yodeploy import delta, virtualenv
+from yodeploy.hooks.base import EVENTS_FILE
 from yodeploy.locking import LockFile, SpinLockFile
 from yodeploy.repository import version_sort_key
 from yodeploy.util import extract_tar, ignoring
@@ -68,7 +71,9 @@ class Application(object):
                                      'deploy', 'requirements.txt')
         python_version = virtualenv.get_python_version(is_deploy=True)
         platform = self.settings.artifacts.platform
-        ve_id = virtualenv.get_id(deploy_req_fn, python_version, platform)
+        legacy_id = self.settings.artifacts.get('legacy_ve_ids', False)
+        ve_id = virtualenv.get_id(deploy_req_fn, python_version, platform,
+                                  legacy=legacy_id)
         ves_dir = os.path.join(self.settings.paths.apps, 'deploy',
                                'virtualenvs')
         ve_dir = os.path.join(ves_dir, ve_id)
@@ -81,8 +86,12 @@ class Application(object):
         tarball = os.path.join(ve_working, 'virtualenv.tar.gz')
         with SpinLockFile(os.path.join(ves_dir, 'deploy.lock'), timeout=30):
             log.debug('Deploying hook virtualenv %s', ve_id)
+            # Artifacts built before normalized ids only have legacy ids
+            fallback_ids = () if legacy_id else (virtualenv.get_id(
+                deploy_req_fn, python_version, platform, legacy=True),)
             virtualenv.download_ve(
-                repository, 'deploy', ve_id, target, tarball)
+                repository, 'deploy', ve_id, target, tarball,
+                fallback_ids=fallback_ids)
             extract_tar(tarball, ve_unpack_root)
             if os.path.exists(ve_dir):
                 shutil.rmtree(ve_dir)
@@ -112,6 +121,9 @@ class Application(object):
         env = {
             'PATH': os.environ['PATH'],
         }
+        # Options for the hooks
+        env.update((k, v) for k, v in os.environ.items()
+                   if k.startswith('YODEPLOY_'))
 
         try:
             subprocess.check_call(cmd, env=env, close_fds=False)
@@ -127,6 +139,10 @@ class Application(object):
         log.info('Deploying %s/%s', self.app, version)
         with self.lock:
             self.unpack(target, repository, version)
+            # Only report this deploy's events
+            with ignoring(errno.ENOENT):
+                os.unlink(os.path.join(self.appdir, 'versions', version,
+                                       EVENTS_FILE))
             self.prepare(target, repository, version)
             self.swing_symlink(version)
             self.deployed(target, repository, version)
@@ -147,22 +163,79 @@ class Application(object):
             os.makedirs(unpack_dir)
         tarball = os.path.join(unpack_dir, '%s.tar.gz' % self.app)
 
-        with repository.get(self.app, version, target) as f1:
-            self.compat = int(f1.metadata.get('deploy_compat', 1))
-            if self.compat not in (4, 5):
-                raise Exception('Unsupported artifact: compat level %s'
-                                % self.compat)
-            with open(tarball, 'wb') as f2:
-                shutil.copyfileobj(f1, f2)
+        if not self.unpack_delta(target, repository, version):
+            with repository.get(self.app, version, target) as f1:
+                self.check_compat(f1.metadata)
+                with open(tarball, 'wb') as f2:
+                    shutil.copyfileobj(f1, f2)
 
-        extract_tar(tarball, os.path.join(unpack_dir, version))
-        os.unlink(tarball)
+            extract_tar(tarball, os.path.join(unpack_dir, version))
+            os.unlink(tarball)
         staging = os.path.join(self.appdir, 'versions', version)
         if os.path.isdir(staging):
             shutil.rmtree(staging)
         os.rename(os.path.join(self.appdir, 'versions', 'unpack', version),
                   staging)
 
+    def check_compat(self, metadata):
+        self.compat = int(metadata.get('deploy_compat', 1))
+        if self.compat not in (4, 5):
+            raise Exception('Unsupported artifact: compat level %s'
+                            % self.compat)
+
+    def unpack_delta(self, target, repository, version):
+        """Try to unpack version from a deployed version and a delta.
+
+        Returns True if versions/unpack/version was built, False if the full
+        tarball needs to be downloaded.
+        """
+        try:
+            manifest = delta.load_manifest(repository, self.app, version,
+                                           target)
+        except KeyError:
+            return False
+        base = delta.choose_base(manifest, self.deployed_versions)
+        if base is None:
+            return False
+
+        unpack_dir = os.path.join(self.appdir, 'versions', 'unpack')
+        dest = os.path.join(unpack_dir, version)
+        tarball = os.path.join(unpack_dir, '%s.delta.tar.gz' % self.app)
+        log.debug('Unpacking %s/%s from %s and a delta (%i bytes)',
+                  self.app, version, base, manifest['deltas'][base])
+        try:
+            self.check_compat(repository.get_metadata(self.app, version,
+                                                      target))
+            with repository.get(self.app, delta.delta_version(version, base),
+                                target, delta.delta_artifact(self.app)) as f1:
+                with open(tarball, 'wb') as f2:
+                    shutil.copyfileobj(f1, f2)
+            if os.path.exists(dest):
+                shutil.rmtree(dest)
+            delta.apply_delta(os.path.join(self.appdir, 'versions', base),
+                              tarball, manifest, dest)
+        except (KeyError, OSError, tarfile.TarError, delta.DeltaError) as e:
+            log.warning('Unable to unpack %s/%s from a delta, falling back '
+                        'to the full artifact: %s', self.app, version, e)
+            with ignoring(errno.ENOENT):
+                shutil.rmtree(dest)
+            return False
+        finally:
+            with ignoring(errno.ENOENT):
+                os.unlink(tarball)
+        return True
+
+    def events(self, version):
+        """Return the events recorded by version's hooks"""
+        fn = os.path.join(self.appdir, 'versions', version, EVENTS_FILE)
+        try:
+            with open(fn) as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
     def prepare(self, target, repository, version):
         """Post-unpack, pre-swing hook"""
         assert self.lock.held
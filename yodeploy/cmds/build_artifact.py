@@ -1,13 +1,18 @@
 #!/usr/bin/env python
 
 import argparse
+import contextlib
 import copy
+import hashlib
 import json
 import os
 import shutil
 import socket
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 from xml.etree import ElementTree
 
 
@@ -18,18 +23,45 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
 
 from yoconfigurator.base import write_config  # noqa
 from yoconfigurator.filter import filter_config  # noqa
-from yoconfigurator.smush import config_sources, smush_config  # noqa
+from yoconfigurator.smush import config_sources  # noqa
 import yodeploy.config  # noqa
+import yodeploy.delta  # noqa
 import yodeploy.repository  # noqa
+import yodeploy.smush  # noqa
 
 from yodeploy.unicode_stdout import ensure_unicode_compatible
 
 
+# S3 limits user-defined metadata to 2KB, keys and values combined
+METADATA_LIMIT = 2048
+# The longest free-text metadata values (commit messages, test descriptions)
+METADATA_TEXT_LIMIT = 512
+
+
+def truncate(text, limit=METADATA_TEXT_LIMIT):
+    """Trim text to at most limit characters"""
+    if len(text) <= limit:
+        return text
+    return text[:limit - 3] + '...'
+
+
+def metadata_size(metadata):
+    """The size of metadata, as S3 counts it"""
+    return sum(len(key.encode('utf-8')) + len(str(value).encode('utf-8'))
+               for key, value in metadata.items())
+
+
+def build_index_artifact(app):
+    """The artifact mapping build keys to the versions built from them"""
+    return app + yodeploy.repository.BUILD_INDEX_SUFFIX
+
+
 class Builder(object):
     def __init__(self, app, target, version, commit, commit_msg, branch, tag,
                  deploy_settings, deploy_settings_file, repository,
                  build_virtualenvs, upload_virtualenvs,
-                 force_virtualenvs=False):
+                 force_virtualenvs=False, commit_time=None, tree=None,
+                 test_shards=1):
         print_banner('%s %s' % (app, version), border='double')
         self.app = app
         self.target = target
@@ -44,6 +76,25 @@ class Builder(object):
         self.build_virtualenvs = build_virtualenvs
         self.upload_virtualenvs = upload_virtualenvs
         self.force_virtualenvs = force_virtualenvs
+        self.commit_time = commit_time
+        self.tree = tree
+        self.test_shards = test_shards
+        self.reused_version = None
+        # (GitHub status, description) of the tests, if they ran
+        self.test_status = None
+        # Phase: seconds, subphases are named phase.subphase
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        """Record the time taken by the enclosed phase"""
+        # Reserve our place, so phases are listed in the order they started
+        self.timings[phase] = 0.0
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[phase] = time.time() - start
 
     def set_commit_status(self, status, description):
         """Report test status to GitHub"""
@@ -90,18 +141,94 @@ class Builder(object):
         except URLError as e:
             print('Failed to notify GitHub: %s' % e, file=sys.stderr)
 
+    def settings_fingerprint(self):
+        """Hash the deploy settings that can affect the build's output"""
+        settings = {
+            'compat': self.compat,
+            'build': self.deploy_settings.build,
+            'platform': self.deploy_settings.artifacts.platform,
+            'configs': self.configs_fingerprint(),
+        }
+        return hashlib.sha256(json.dumps(
+            settings, sort_keys=True, default=repr).encode()).hexdigest()
+
+    def config_sources(self):
+        build_settings = self.deploy_settings.build
+        return config_sources(self.app, build_settings.environment,
+                              build_settings.cluster,
+                              [build_settings.configs_dir],
+                              os.path.join('deploy', 'configuration'),
+                              build=True)
+
+    def configs_fingerprint(self):
+        """Hash the config sources that configure() will smush"""
+        build_settings = self.deploy_settings.build
+        if not build_settings.get('configs_dir'):
+            return None
+        return yodeploy.smush.cache_key(
+            self.config_sources(), environment=build_settings.environment,
+            cluster=build_settings.cluster)
+
+    @property
+    def build_key(self):
+        """Identify the build's inputs, or None if we can't"""
+        if not self.tree:
+            return None
+        return '%s-%.16s' % (self.tree, self.settings_fingerprint())
+
+    def cached_version(self):
+        """Return an existing version built from identical inputs, or None"""
+        if not self.build_key:
+            return None
+        try:
+            with self.repository.get(
+                    self.app, self.build_key, self.target,
+                    artifact=build_index_artifact(self.app)) as f:
+                version = f.read().decode().strip()
+            metadata = self.repository.get_metadata(self.app, version,
+                                                    self.target)
+        except KeyError:
+            # Never built, or garbage collected since
+            return None
+        if metadata.get('tree') != self.tree:
+            return None
+        # Only reuse builds that were tested, and passed
+        if metadata.get('test_status') != 'success':
+            return None
+        return version
+
+    def reuse(self, version):
+        """Upload version's artifact as this version, instead of building"""
+        print_banner('Reuse build %s' % version)
+        self.reused_version = version
+        metadata = self.repository.get_metadata(self.app, version,
+                                                self.target)
+        self.test_status = (metadata['test_status'],
+                            metadata.get('test_description', ''))
+        if version == self.version:
+            print('Already uploaded')
+            return
+        if not os.path.isdir('dist'):
+            os.mkdir('dist')
+        with self.timed('reuse'):
+            with self.repository.get(self.app, version, self.target) as f1:
+                with open('dist/%s.tar.gz' % self.app, 'wb') as f2:
+                    shutil.copyfileobj(f1, f2)
+        self.set_commit_status('success', 'Reused build %s' % version)
+        self.upload()
+
     def configure(self):
         build_settings = self.deploy_settings.build
-        configs_dirs = [build_settings.configs_dir]
         app_conf_dir = os.path.join('deploy', 'configuration')
-        sources = config_sources(self.app, build_settings.environment,
-                                 build_settings.cluster,
-                                 configs_dirs, app_conf_dir, build=True)
-        config = smush_config(sources,
-                              initial={'yoconfigurator': {
-                                  'app': self.app,
-                                  'environment': build_settings.environment,
-                              }})
+        config = yodeploy.smush.smush_config(
+            self.config_sources(),
+            initial={'yoconfigurator': {
+                'app': self.app,
+                'environment': build_settings.environment,
+            }},
+            environment=build_settings.environment,
+            cluster=build_settings.cluster,
+            cache=build_settings.get('smush_cache', True))
         write_config(config, '.')
 
         # public configuration
@@ -132,32 +259,65 @@ class Builder(object):
             build_deploy_virtualenv.append('--force')
             build_app_virtualenv.append('--force')
 
+        timings_dir = tempfile.mkdtemp(prefix='build-artifact-timings')
+        build_deploy_virtualenv += [
+            '--timings', os.path.join(timings_dir, 'deploy.json')]
+        build_app_virtualenv += [
+            '--timings', os.path.join(timings_dir, 'app.json')]
+
+        # These are independent, and mostly waiting on the network, so build
+        # them concurrently
+        jobs = []
+        if self.build_virtualenvs:
+            jobs.append(('deploy', build_deploy_virtualenv, {'cwd': 'deploy'}))
+        if os.path.exists('requirements.txt'):
+            jobs.append(('app', build_app_virtualenv, {}))
+
+        try:
+            if jobs:
+                print_banner('Build virtualenvs (%s)'
+                             % ', '.join(label for label, cmd, kwargs in jobs))
+                with self.timed('virtualenvs'):
+                    times = run_parallel(jobs, abort='build-virtualenv failed')
+                for label, seconds in sorted(times.items()):
+                    phase = 'virtualenvs.%s' % label
+                    self.timings[phase] = seconds
+                    # build-virtualenv's own breakdown (download, build, etc.)
+                    timings_file = os.path.join(timings_dir, '%s.json' % label)
+                    if os.path.exists(timings_file):
+                        with open(timings_file) as f:
+                            subphases = json.load(f)
+                        for subphase, seconds in subphases.items():
+                            self.timings['%s.%s' % (phase, subphase)] = seconds
+        finally:
+            shutil.rmtree(timings_dir)
+
         if self.build_virtualenvs:
-            print_banner('Build deploy virtualenv')
-            check_call(build_deploy_virtualenv, cwd='deploy',
-                       abort='build-virtualenv failed')
             shutil.rmtree('deploy/virtualenv')
             os.unlink('deploy/virtualenv.tar.gz')
 
-        if os.path.exists('requirements.txt'):
-            print_banner('Build app virtualenv')
-            check_call(build_app_virtualenv, abort='build-virtualenv failed')
-
-        self.configure()
+        with self.timed('configure'):
+            self.configure()
 
     def build_env(self):
         """Return environment variables to be exported for the build"""
         env = copy.copy(os.environ)
         # Some of the old build scripts depend on APPNAME
         env['APPNAME'] = self.app
+        # Reproducible builds: timestamp everything with the commit's
+        if self.commit_time and 'SOURCE_DATE_EPOCH' not in env:
+            env['SOURCE_DATE_EPOCH'] = str(self.commit_time)
         return env
 
     def build(self):
         print_banner('Build')
         env = self.build_env()
-        check_call('scripts/build.sh', env=env, abort='Build script failed')
+        with self.timed('build'):
+            check_call('scripts/build.sh', env=env,
+                       abort='Build script failed')
         print_banner('Package')
-        check_call('scripts/dist.sh', env=env, abort='Dist script failed')
+        with self.timed('dist'):
+            check_call('scripts/dist.sh', env=env, abort='Dist script failed')
 
     def test(self):
         print_banner('Test')
@@ -166,7 +326,11 @@ class Builder(object):
         failed = False
 
         try:
-            check_call('scripts/test.sh', env=env)
+            with self.timed('test'):
+                if self.test_shards > 1:
+                    self.test_sharded(env)
+                else:
+                    check_call('scripts/test.sh', env=env)
         except subprocess.CalledProcessError:
             failed = True
 
@@ -190,28 +354,118 @@ class Builder(object):
         # fail the build
         commit_status = failed or bool(results['failures'])
 
-        self.set_commit_status(
-            'failure' if commit_status else 'success', msg)
+        self.test_status = ('failure' if commit_status else 'success', msg)
+        self.set_commit_status(*self.test_status)
 
         if failed:
             abort(msg)
 
+    def test_sharded(self, env):
+        """Run test_shards copies of test.sh in parallel.
+
+        Each is told its SHARD_INDEX (from 0), the SHARD_COUNT, and a
+        TEST_REPORTS_DIR to write its xunit reports to. The reports are merged
+        into test_build/reports, as if a single test.sh had run.
+        """
+        if os.path.isdir('test_shards'):
+            shutil.rmtree('test_shards')
+        jobs = []
+        for i in range(self.test_shards):
+            reports_dir = os.path.abspath(
+                os.path.join('test_shards', str(i), 'reports'))
+            os.makedirs(reports_dir)
+            shard_env = dict(env, SHARD_INDEX=str(i),
+                             SHARD_COUNT=str(self.test_shards),
+                             TEST_REPORTS_DIR=reports_dir)
+            jobs.append(('shard %i' % i, 'scripts/test.sh',
+                         {'env': shard_env}))
+
+        try:
+            times = run_parallel(jobs)
+            for i in range(self.test_shards):
+                self.timings['test.shard%i' % i] = times['shard %i' % i]
+        finally:
+            if not os.path.isdir('test_build/reports'):
+                os.makedirs('test_build/reports')
+            for report_file in ('xunit', 'xunit-integration'):
+                sources = [
+                    os.path.join('test_shards', str(i), 'reports',
+                                 '%s.xml' % report_file)
+                    for i in range(self.test_shards)]
+                merge_xunit_reports(
+                    [source for source in sources if os.path.isfile(source)],
+                    'test_build/reports/%s.xml' % report_file)
+
     def upload(self):
         print_banner('Upload')
         artifact = 'dist/%s.tar.gz' % self.app
         metadata = {
             'build_number': self.version,
-            'commit_msg': self.commit_msg,
+            'commit_msg': truncate(self.commit_msg),
             'commit': self.commit,
             'deploy_compat': str(self.compat),
         }
         if self.tag:
             metadata['vcs_tag'] = self.tag
-
-        with open(artifact, 'rb') as f:
-            self.repository.put(self.app, self.version, f, metadata,
-                                target=self.target)
-        print('Uploaded')
+        if self.tree:
+            metadata['tree'] = self.tree
+            metadata['settings_fingerprint'] = self.settings_fingerprint()
+        if self.reused_version:
+            metadata['reused_build'] = self.reused_version
+        if self.test_status:
+            metadata['test_status'] = self.test_status[0]
+            metadata['test_description'] = truncate(self.test_status[1])
+        if self.timings:
+            # Top-level phases, up to this point. write_timings() reports
+            # the subphases too
+            metadata['build_timings'] = json.dumps(
+                dict((phase, round(seconds, 1))
+                     for phase, seconds in self.timings.items()
+                     if '.' not in phase),
+                sort_keys=True, separators=(',', ':'))
+            if metadata_size(metadata) > METADATA_LIMIT:
+                print('Warning: Too many timings to store in metadata',
+                      file=sys.stderr)
+                del metadata['build_timings']
+
+        with self.timed('upload'):
+            with self.timed('upload.artifact'):
+                with open(artifact, 'rb') as f:
+                    self.repository.put(self.app, self.version, f, metadata,
+                                        target=self.target)
+            print('Uploaded')
+
+            if self.build_key:
+                self.repository.put(self.app, self.build_key,
+                                    '%s\n' % self.version, {}, self.target,
+                                    build_index_artifact(self.app))
+
+            max_deltas = self.deploy_settings.build.get('delta_versions', 3)
+            with self.timed('upload.deltas'):
+                try:
+                    manifest = yodeploy.delta.build_deltas(
+                        self.repository, self.app, self.version, artifact,
+                        target=self.target, max_deltas=max_deltas,
+                        workdir='dist')
+                except yodeploy.delta.DeltaError as e:
+                    # The artifact is already uploaded, deploys just won't
+                    # be able to use deltas for this version
+                    print('Warning: Unable to build deltas: %s' % e,
+                          file=sys.stderr)
+                    return
+            print('Uploaded manifest (%i deltas)' % len(manifest['deltas']))
+
+    def write_timings(self, path='test_build/reports/build-timings.json'):
+        """Write the phase timings as JSON, for trending"""
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            json.dump({
+                'app': self.app,
+                'version': self.version,
+                'commit': self.commit,
+                'timings': self.timings,
+            }, f, indent=2, sort_keys=True)
 
     def summary(self):
         print_banner('Summary')
@@ -221,10 +475,17 @@ class Builder(object):
         print('Branch: %s' % self.branch)
         print('Commit: %s' % self.commit)
         print('Commit message: %s' % self.commit_msg)
+        if self.reused_version:
+            print('Reused build: %s' % self.reused_version)
         jenkins_tag = ''
         if self.tag:
             print('Tag: %s' % self.tag)
             jenkins_tag = ' (tag: %s)' % self.tag
+        if self.timings:
+            print('Timings:')
+            for phase, seconds in self.timings.items():
+                print('  %-40s %7.1fs' % (phase, seconds))
+            self.write_timings()
         print()
         print('Jenkins description: %s:%.8s%s "%s"' % (
             self.branch.replace('origin/', ''), self.commit, jenkins_tag,
@@ -262,6 +523,14 @@ def parse_args(default_app):
                              "build")
     parser.add_argument('--force-virtualenv', action='store_true',
                         help='Force rebuild of virtualenvs')
+    parser.add_argument('--test-shards', metavar='N', type=int,
+                        help='Run N copies of test.sh in parallel, each '
+                             'running a shard of the tests. (Defaults to '
+                             'build.test_shards in the deploy settings, or 1)')
+    parser.add_argument('--no-build-cache', action='store_false',
+                        dest='build_cache',
+                        help="Build, even if an artifact has already been "
+                             "built from this source tree")
     parser.add_argument('-c', '--config', metavar='FILE',
                         default=yodeploy.config.find_deploy_config(False),
                         help='Location of the Deploy configuration file.')
@@ -311,6 +580,93 @@ def check_call(*args, **kwargs):
             raise
 
 
+def merge_xunit_reports(sources, dest):
+    '''
+    Merge the test suites in the xunit reports sources into a single test
+    suite in dest, summing their counts.
+    Does nothing if there are no sources.
+    '''
+    if not sources:
+        return
+    suites = []
+    for source in sources:
+        root = ElementTree.parse(source).getroot()
+        if root.tag == 'testsuites':
+            suites += root.findall('testsuite')
+        else:
+            suites.append(root)
+
+    merged = ElementTree.Element('testsuite', name=suites[0].get('name', ''))
+    for attr in ('tests', 'failures', 'errors', 'skip', 'skipped'):
+        values = [int(suite.get(attr)) for suite in suites
+                  if suite.get(attr) is not None]
+        if values:
+            merged.set(attr, str(sum(values)))
+    merged.set('time', '%.3f' % sum(float(suite.get('time', 0))
+                                    for suite in suites))
+    for suite in suites:
+        merged.extend(list(suite))
+    ElementTree.ElementTree(merged).write(dest, encoding='utf-8',
+                                          xml_declaration=True)
+
+
+def run_parallel(jobs, **kwargs):
+    '''
+    Run several commands concurrently, multiplexing their output onto stdout,
+    with each line prefixed by the job's label.
+
+    jobs is a list of (label, args, kwargs) for subprocess.Popen.
+    Returns a dict of label: seconds taken. If any command fails (or can't be
+    started), we abort with the `abort` message, if set, or raise
+    CalledProcessError once they have all finished.
+    '''
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    abort_msg = kwargs.pop('abort', None)
+    width = max(len(job[0]) for job in jobs)
+    lock = threading.Lock()
+    times = {}
+    returncodes = {}
+
+    def run(label, args, popen_kwargs):
+        prefix = '%s | ' % label.ljust(width)
+        start = time.time()
+        try:
+            p = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, **popen_kwargs)
+        except OSError as e:
+            returncodes[label] = 127
+            times[label] = time.time() - start
+            with lock:
+                print('%sUnable to start %s: %s' % (prefix, args[0], e))
+            return
+        for line in p.stdout:
+            line = line.decode('utf-8', 'replace').rstrip('\n')
+            with lock:
+                print(prefix + line)
+                sys.stdout.flush()
+        p.stdout.close()
+        returncodes[label] = p.wait()
+        times[label] = time.time() - start
+        with lock:
+            print('%sExited %i after %.1fs' % (prefix, returncodes[label],
+                                                times[label]))
+
+    threads = [threading.Thread(target=run, args=job) for job in jobs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for label, args, popen_kwargs in jobs:
+        if returncodes[label] != 0:
+            if abort_msg:
+                abort(abort_msg)
+            raise subprocess.CalledProcessError(returncodes[label], args)
+    return times
+
+
 def print_box(lines, border='light'):
     '''Print lines (a list of unicode strings) inside a pretty box.'''
     styles = {
@@ -398,6 +754,28 @@ class GitHelper(object):
             commit = commit.strip()
         return commit
 
+    @property
+    def commit_time(self):
+        """The commit's timestamp, or None if git can't tell us"""
+        git_show = ('git', 'show', '-s', '--format=%ct', self.commit)
+        try:
+            return int(subprocess.check_output(git_show).strip())
+        except (subprocess.CalledProcessError, ValueError):
+            return None
+
+    @property
+    def tree(self):
+        """The commit's tree hash, or None if there are local modifications
+
+        Untracked files are assumed to be build artifacts, and ignored.
+        """
+        git_status = ('git', 'status', '--porcelain', '--untracked-files=no')
+        if subprocess.check_output(git_status).strip():
+            return None
+        git_rev_parse = ('git', 'rev-parse', '%s^{tree}' % self.commit)
+        return subprocess.check_output(
+            git_rev_parse, universal_newlines=True).strip()
+
     @property
     def branch(self):
         branch = os.environ.get('GIT_BRANCH')
@@ -472,7 +850,9 @@ def main():
     commit = git.commit
     branch = git.branch
     commit_msg = git.commit_msg
+    commit_time = git.commit_time
     tag = git.tag
+    tree = git.tree if opts.build_cache else None
 
     version = os.environ.get('BUILD_NUMBER')
     if not version:
@@ -488,15 +868,27 @@ def main():
                            repository=repository,
                            build_virtualenvs=opts.build_virtualenvs,
                            upload_virtualenvs=upload_virtualenvs,
-                           force_virtualenvs=opts.force_virtualenv)
-    builder.prepare()
-    if not opts.prepare_only:
-        if not opts.test_only:
-            builder.build()
-        if not opts.skip_tests:
-            builder.test()
-        if not opts.test_only:
-            builder.upload()
+                           force_virtualenvs=opts.force_virtualenv,
+                           commit_time=commit_time, tree=tree,
+                           test_shards=(opts.test_shards or
+                                        deploy_settings.build.get(
+                                            'test_shards', 1)))
+
+    cached_version = None
+    if not (opts.prepare_only or opts.test_only):
+        cached_version = builder.cached_version()
+
+    if cached_version:
+        builder.reuse(cached_version)
+    else:
+        builder.prepare()
+        if not opts.prepare_only:
+            if not opts.test_only:
+                builder.build()
+            if not opts.skip_tests:
+                builder.test()
+            if not opts.test_only:
+                builder.upload()
     builder.summary()
 
 
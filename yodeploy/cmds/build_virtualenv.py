@@ -1,15 +1,17 @@
 #!/usr/bin/env python
 
 import argparse
+import contextlib
+import json
 import logging
 import os
 import shutil
-import subprocess
 import sys
+import time
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
 
-from yodeploy import virtualenv
+from yodeploy import interpreters, virtualenv
 import yodeploy.config
 import yodeploy.repository
 import yodeploy.util
@@ -17,6 +19,19 @@ import yodeploy.util
 
 log = logging.getLogger(os.path.basename(__file__).rsplit('.', 1)[0])
 
+# Phase: seconds, for --timings
+timings = {}
+
+
+@contextlib.contextmanager
+def timed(phase):
+    timings[phase] = 0.0
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[phase] = time.time() - start
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -56,8 +71,33 @@ def main():
     parser.add_argument('--compat', metavar='LEVEL', type=int,
                         help='Assume the specified compat level. '
                              '(Defaults to reading deploy/compat)')
+    parser.add_argument('--legacy-id', action='store_true',
+                        help='Identify the virtualenv by the raw bytes of '
+                             'the requirements file, rather than the '
+                             'normalized requirement set. (Defaults to '
+                             'artifacts.legacy_ve_ids in the deploy settings)')
+    parser.add_argument('--wheelhouse', metavar='DIR',
+                        help='Local wheel cache, shared with the repository. '
+                             '(Defaults to build.wheelhouse in the deploy '
+                             'settings, or ~/.cache/yodeploy/wheelhouse)')
+    parser.add_argument('--no-wheelhouse', action='store_false',
+                        dest='use_wheelhouse',
+                        help="Install straight from PyPI, don't use or "
+                             "populate the wheelhouse")
+    parser.add_argument('--timings', metavar='FILE',
+                        help='Write the time taken by each phase to FILE, as '
+                             'JSON')
 
     options = parser.parse_args()
+    try:
+        build(parser, options)
+    finally:
+        if options.timings:
+            with open(options.timings, 'w') as f:
+                json.dump(timings, f)
+
+
+def build(parser, options):
     if not os.path.isfile(options.requirement):
         parser.error('%s does not exist' % options.requirement)
 
@@ -85,18 +125,18 @@ def main():
             options.compat = yodeploy.util.infer_compat_version()
 
     if options.app == 'deploy':
-        python_version = subprocess.check_output([
-            sys.executable,
-            '-c',
-            'import sys; print(".".join(map(str, sys.version_info[:2])))'
-        ]).decode().strip()
+        python_version = interpreters.interpreter_info(
+            sys.executable)['version']
     else:
         python_version = virtualenv.get_python_version(
             options.compat, is_deploy=False
         )
 
     platform = deploy_settings.artifacts.platform
-    ve_id = virtualenv.get_id(options.requirement, python_version, platform)
+    legacy_id = (options.legacy_id
+                 or deploy_settings.artifacts.get('legacy_ve_ids', False))
+    ve_id = virtualenv.get_id(options.requirement, python_version, platform,
+                              legacy=legacy_id)
     if options.hash:
         print(ve_id)
         return
@@ -115,26 +155,51 @@ def main():
 
     if options.download:
         downloaded = False
-        try:
-            virtualenv.download_ve(
-                repository, options.app, ve_id, options.target)
-            downloaded = True
-        except KeyError:
-            log.warning('No existing virtualenv, building...')
-        if downloaded:
-            options.upload = False
-            yodeploy.util.extract_tar('virtualenv.tar.gz', 'virtualenv')
-
+        with timed('download'):
+            try:
+                virtualenv.download_ve(
+                    repository, options.app, ve_id, options.target)
+                downloaded = True
+            except KeyError:
+                log.warning('No existing virtualenv, building...')
+            if downloaded:
+                options.upload = False
+                yodeploy.util.extract_tar('virtualenv.tar.gz', 'virtualenv')
+
+    wheelhouse = None
     if not os.path.isdir('virtualenv'):
-        virtualenv.create_ve(
-            '.', python_version, platform,
-            pypi=deploy_settings.build.pypi,
-            req_file=options.requirement)
+        if options.use_wheelhouse:
+            wheelhouse = os.path.join(
+                options.wheelhouse
+                or deploy_settings.build.get('wheelhouse')
+                or os.path.expanduser('~/.cache/yodeploy/wheelhouse'),
+                platform)
+            if not os.path.isdir(wheelhouse):
+                os.makedirs(wheelhouse)
+            with timed('wheelhouse'):
+                virtualenv.download_wheels(
+                    repository, platform,
+                    virtualenv.pinned_requirements(options.requirement),
+                    wheelhouse)
+        with timed('build'):
+            virtualenv.create_ve(
+                '.', python_version, platform,
+                pypi=deploy_settings.build.pypi,
+                req_file=options.requirement,
+                wheelhouse=wheelhouse,
+                legacy_id=legacy_id,
+                compress_level=deploy_settings.build.get(
+                    'compress_level', virtualenv.DEFAULT_LEVEL),
+                compress_threads=deploy_settings.build.get(
+                    'compress_threads'))
 
     if options.upload:
-        virtualenv.upload_ve(
-            repository, options.app, ve_id,
-            options.target, overwrite=options.force)
+        with timed('upload'):
+            if wheelhouse:
+                virtualenv.upload_wheels(repository, platform, wheelhouse)
+            virtualenv.upload_ve(
+                repository, options.app, ve_id,
+                options.target, overwrite=options.force)
 
 
 if __name__ == '__main__':
@@ -10,6 +10,7 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
 from yodeploy.deploy import (available_applications, configure_logging, deploy,
                              gc)
 import yodeploy.config
+import yodeploy.interpreters
 
 
 def parse_args():
@@ -21,6 +22,12 @@ def parse_args():
     deploy_p = subparsers.add_parser('deploy',
                                      help='Deploy an application and configs')
     deploy_p.add_argument('app', help='The application name')
+    deploy_p.add_argument('--commit', metavar='SHA',
+                          help='Deploy the latest version built from commit '
+                               'SHA (may be abbreviated)')
+    deploy_p.add_argument('--force-migrate', action='store_true',
+                          help='Run migrations, even if they are unchanged '
+                               'since the live version')
 
     subparsers.add_parser('available-apps', help='Show available applications')
 
@@ -30,6 +37,9 @@ def parse_args():
                       type=int, default=2,
                       help='The most versions to leave behind')
 
+    subparsers.add_parser('interpreters',
+                          help='List the Python interpreters in $PATH')
+
     # hack in some short aliases:
     shortcuts = {}
     for k, v in list(subparsers._name_parser_map.items()):
@@ -82,8 +92,22 @@ def do_available_apps(opts):
 
 def do_deploy(opts):
     "Deploy an application"
+    if opts.force_migrate:
+        # Passed through to the hooks
+        os.environ['YODEPLOY_FORCE_MIGRATE'] = '1'
     deploy(opts.app, opts.target, opts.config, opts.version,
-           opts.deploy_settings)
+           opts.deploy_settings, commit=opts.commit)
+
+
+def do_interpreters(opts):
+    "List the Python interpreters in $PATH"
+    found = yodeploy.interpreters.discover()
+    if not found:
+        print('No Python interpreters found')
+        return
+    for info in found:
+        print('%(path)s: %(implementation)s %(full_version)s (%(abi)s)'
+              % info)
 
 
 def do_gc(opts):
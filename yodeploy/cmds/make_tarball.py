@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from yodeploy import compression
+
+
+log = logging.getLogger(os.path.basename(__file__).rsplit('.', 1)[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Create a gzipped tarball, compressing with multiple '
+                    'threads. A drop-in replacement for "tar -czf" in '
+                    'scripts/dist.sh.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('tarball', help='The tarball to create')
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='Files and directories to include')
+    parser.add_argument('-l', '--level', type=int,
+                        default=compression.DEFAULT_LEVEL,
+                        help='gzip compression level (1-9)')
+    parser.add_argument('-t', '--threads', type=int,
+                        default=os.cpu_count(),
+                        help='Number of compression threads')
+    parser.add_argument('--mtime', type=int,
+                        default=compression.source_date_epoch(),
+                        help='Create a reproducible tarball, with this '
+                             'timestamp on every member. '
+                             '(Defaults to $SOURCE_DATE_EPOCH)')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Compare against single-threaded compression '
+                             'at levels 1, %i and 9, rather than creating '
+                             'the tarball' % compression.DEFAULT_LEVEL)
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    if options.benchmark:
+        workdir = os.path.dirname(os.path.abspath(options.tarball))
+        results = compression.benchmark(options.paths, threads=options.threads,
+                                        workdir=workdir)
+        print('%-10s %5s %10s %14s' % ('method', 'level', 'seconds', 'bytes'))
+        for method, level, seconds, size in results:
+            print('%-10s %5i %10.2f %14i' % (method, level, seconds, size))
+        return
+
+    compression.make_tarball(options.tarball, options.paths,
+                             level=options.level, threads=options.threads,
+                             mtime=options.mtime)
+    log.info('Created %s', options.tarball)
+
+
+if __name__ == '__main__':
+    main()
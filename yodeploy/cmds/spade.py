@@ -6,10 +6,12 @@ import logging
 import os
 import shutil
 import sys
+import tempfile
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
 
 import yodeploy.config
+import yodeploy.config_slices
 import yodeploy.repository
 
 # Replaced when configured
@@ -56,6 +58,45 @@ def parse_args():
                             default='master',
                             help='The target to examine')
 
+    find_p = subparsers.add_parser('find',
+            help='Find the versions of an app built from a commit, tag, etc.')
+    find_p.add_argument('app', help='The application name')
+    find_p.add_argument('filename', nargs='?', help='The file to examine')
+    find_p.add_argument('--target', metavar='TARGET',
+                        default='master',
+                        help='The target to examine')
+    find_p.add_argument('--commit', metavar='SHA',
+                        help='Built from commit SHA (may be abbreviated)')
+    find_p.add_argument('--tag', metavar='TAG', dest='vcs_tag',
+                        help='Built from VCS tag TAG')
+    find_p.add_argument('--build-number', metavar='N',
+                        help='Built by build number N')
+    find_p.add_argument('--compat', metavar='LEVEL', dest='deploy_compat',
+                        help='Deploy compat level LEVEL')
+
+    reindex_p = subparsers.add_parser('reindex',
+            help="Rebuild a file's metadata index, for find")
+    reindex_p.add_argument('app', help='The application name')
+    reindex_p.add_argument('filename', nargs='?', help='The file to index')
+    reindex_p.add_argument('--target', metavar='TARGET',
+                           default='master',
+                           help='The target to index')
+
+    slices_p = subparsers.add_parser('build-config-slices',
+            help="Prebuild an app's configuration, for deploys")
+    slices_p.add_argument('app', help='The application name')
+    slices_p.add_argument('clusters', nargs='+', metavar='ENV:CLUSTER',
+                          help='Environment and cluster to build for')
+    slices_p.add_argument('--target', metavar='TARGET',
+                          default='master',
+                          help='The target to build for')
+    slices_p.add_argument('--version', metavar='VER',
+                          help='Build for version VER of the app '
+                               '(Default: latest)')
+    slices_p.add_argument('--configs-version', metavar='VER',
+                          help='Build from version VER of configs '
+                               '(Default: latest)')
+
     subparsers.add_parser('list_apps', help='List apps in the repository')
 
     list_targets_p = subparsers.add_parser('list_targets',
@@ -137,6 +178,56 @@ def do_versions(opts, repository):
         sys.exit(1)
 
 
+def do_find(opts, repository):
+    "Find versions by their metadata"
+
+    criteria = dict((key, getattr(opts, key)) for key in
+                    ('commit', 'vcs_tag', 'build_number', 'deploy_compat')
+                    if getattr(opts, key) is not None)
+    if not criteria:
+        log.error('At least one of --commit, --tag, --build-number or '
+                  '--compat is required')
+        sys.exit(1)
+    versions = repository.find(opts.app, target=opts.target,
+                               artifact=opts.filename, **criteria)
+    if versions:
+        print('\n'.join(versions))
+    else:
+        print('No versions found', file=sys.stderr)
+        sys.exit(1)
+
+
+def do_reindex(opts, repository):
+    "Rebuild the metadata index of a file"
+
+    index = repository.reindex(opts.app, target=opts.target,
+                               artifact=opts.filename)
+    log.info('Indexed %i versions', len(index))
+
+
+def do_build_config_slices(opts, repository):
+    "Prebuild an app's configuration for each environment and cluster"
+
+    clusters = []
+    for cluster in opts.clusters:
+        if ':' not in cluster:
+            log.error('Expected ENV:CLUSTER, got %s', cluster)
+            sys.exit(1)
+        clusters.append(tuple(cluster.split(':', 1)))
+
+    workdir = tempfile.mkdtemp(prefix='spade-')
+    try:
+        uploaded = yodeploy.config_slices.build_slices(
+            repository, opts.app, clusters, workdir, target=opts.target,
+            version=opts.version, configs_version=opts.configs_version)
+    except yodeploy.config_slices.SliceError as e:
+        log.error('Unable to build config slices: %s', e)
+        sys.exit(1)
+    finally:
+        shutil.rmtree(workdir)
+    log.info('Uploaded %s', ', '.join(uploaded))
+
+
 def do_list_apps(opts, repository):
     "List apps in the repository"
 
@@ -1,19 +1,35 @@
 # -*- coding: utf-8 -*-
-from yodeploy.cmds.build_artifact import GitHelper
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+from xml.etree import ElementTree
+
+from yodeploy.cmds.build_artifact import (
+    METADATA_LIMIT, METADATA_TEXT_LIMIT, BuildCompat5, GitHelper,
+    build_index_artifact, merge_xunit_reports, metadata_size, run_parallel)
+from yodeploy.delta import DeltaError
+from yodeploy.repository import LocalRepositoryStore, Repository
+from yodeploy.tests import TmpDirTestCase
 from unittest import TestCase
 from unittest.mock import patch
 
 
+class AttrDict(dict):
+    __getattr__ = dict.__getitem__
+
+
 class TestGitHelper(TestCase):
 
     def setUp(self):
         self.patcher = patch('subprocess.check_output')
         self.check_output = self.patcher.start()
+        self.addCleanup(self.patcher.stop)
         self.git = GitHelper()
 
-    def cleanUp(self):
-        self.patcher.stop()
-
     def test_uses_get_show_for_the_commit_message(self):
         self.check_output.return_value = b'my commit message'
         self.assertEqual(self.git.commit_msg, 'my commit message')
@@ -23,3 +39,264 @@ class TestGitHelper(TestCase):
     def test_removes_special_chars_from_the_commit_message(self):
         self.check_output.return_value = 'frosty the ☃'.encode('utf-8')
         self.assertEqual(self.git.commit_msg, 'frosty the ?')
+
+    def test_commit_time(self):
+        self.check_output.return_value = b'1500000000\n'
+        self.assertEqual(self.git.commit_time, 1500000000)
+
+    def test_tree(self):
+        self.check_output.side_effect = [b'', 'HEAD\n', 'abc123\n']
+        self.assertEqual(self.git.tree, 'abc123')
+
+    def test_tree_with_local_modifications(self):
+        self.check_output.return_value = b' M setup.py\n'
+        self.assertEqual(self.git.tree, None)
+
+
+class TestRunParallel(TestCase):
+
+    def run_parallel(self, jobs):
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            times = run_parallel(jobs)
+        return times, stdout.getvalue().splitlines()
+
+    def test_prefixes_output(self):
+        times, lines = self.run_parallel([
+            ('a', [sys.executable, '-c', 'print("foo")'], {}),
+            ('bb', [sys.executable, '-c', 'print("bar")'], {}),
+        ])
+        self.assertEqual(sorted(times), ['a', 'bb'])
+        self.assertIn('a  | foo', lines)
+        self.assertIn('bb | bar', lines)
+
+    def test_runs_concurrently(self):
+        sleep = [sys.executable, '-c', 'import time; time.sleep(0.5)']
+        start = time.time()
+        self.run_parallel([('a', sleep, {}), ('b', sleep, {})])
+        self.assertLess(time.time() - start, 0.9)
+
+    def test_failure(self):
+        self.assertRaises(
+            subprocess.CalledProcessError, self.run_parallel,
+            [('a', [sys.executable, '-c', 'print("foo")'], {}),
+             ('b', [sys.executable, '-c', 'raise SystemExit(1)'], {})])
+
+    def test_unable_to_start(self):
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                run_parallel([
+                    ('a', [sys.executable, '-c', 'print("foo")'], {}),
+                    ('b', ['/nonexistent/command'], {}),
+                ])
+        self.assertEqual(cm.exception.returncode, 127)
+        self.assertEqual(cm.exception.cmd, ['/nonexistent/command'])
+        self.assertIn('b | Unable to start /nonexistent/command',
+                      stdout.getvalue())
+
+
+class TestBuildCache(TmpDirTestCase):
+
+    def setUp(self):
+        super(TestBuildCache, self).setUp()
+        self.repo = Repository(LocalRepositoryStore(self.mkdir('repo')))
+        self.mkdir('dist')
+        self.create_tar('dist/app.tar.gz', 'app/foo')
+        pwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        self.addCleanup(os.chdir, pwd)
+
+    def builder(self, version, tree='abc', build_settings=None):
+        settings = AttrDict(
+            artifacts=AttrDict(platform='linux'),
+            build=AttrDict(github=AttrDict(report=False),
+                           **(build_settings or {})),
+        )
+        with patch('sys.stdout', new_callable=io.StringIO):
+            return BuildCompat5(
+                app='app', target='master', version=version, commit='123',
+                commit_msg='msg', branch='master', tag=None,
+                deploy_settings=settings, deploy_settings_file=None,
+                repository=self.repo, build_virtualenvs=False,
+                upload_virtualenvs=False, tree=tree)
+
+    def upload(self, builder, test_status='success'):
+        if test_status:
+            builder.test_status = (test_status, 'Ran 1 tests')
+        with patch('sys.stdout', new_callable=io.StringIO):
+            builder.upload()
+
+    def test_records_build_key(self):
+        builder = self.builder('1')
+        self.upload(builder)
+        self.assertEqual(
+            self.repo.list_versions('app',
+                                    artifact=build_index_artifact('app')),
+            [builder.build_key])
+        self.assertEqual(self.repo.get_metadata('app', '1')['tree'], 'abc')
+
+    def test_cached_version(self):
+        self.upload(self.builder('1'))
+        self.assertEqual(self.builder('2').cached_version(), '1')
+
+    def test_different_tree(self):
+        self.upload(self.builder('1'))
+        self.assertEqual(self.builder('2', tree='def').cached_version(), None)
+
+    def test_different_settings(self):
+        self.upload(self.builder('1'))
+        builder = self.builder('2', build_settings={'wheelhouse': '/tmp'})
+        self.assertEqual(builder.cached_version(), None)
+
+    def test_untested(self):
+        self.upload(self.builder('1'), test_status=None)
+        self.assertEqual(self.builder('2').cached_version(), None)
+
+    def test_tests_failed(self):
+        self.upload(self.builder('1'), test_status='failure')
+        self.assertEqual(self.builder('2').cached_version(), None)
+
+    def test_different_configs(self):
+        settings = {'configs_dir': self.mkdir('configs'),
+                    'environment': 'dev', 'cluster': 'default'}
+        with open(self.tmppath('configs', 'common.py'), 'w') as f:
+            f.write('def update(config):\n    return {}\n')
+        self.upload(self.builder('1', build_settings=settings))
+        self.assertEqual(
+            self.builder('2', build_settings=settings).cached_version(), '1')
+
+        with open(self.tmppath('configs', 'common.py'), 'a') as f:
+            f.write('# changed\n')
+        self.assertEqual(
+            self.builder('3', build_settings=settings).cached_version(), None)
+
+    def test_no_tree(self):
+        self.upload(self.builder('1', tree=None))
+        self.assertEqual(self.builder('2', tree=None).cached_version(), None)
+
+    @patch('yodeploy.delta.build_deltas',
+           side_effect=DeltaError('Unsupported tar member: app/dev'))
+    def test_delta_error(self, build_deltas):
+        with patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            self.upload(self.builder('1'))
+        self.assertEqual(self.repo.list_versions('app'), ['1'])
+        self.assertIn('Unable to build deltas', stderr.getvalue())
+
+    def test_prepare_failure_cleans_up(self):
+        with open('requirements.txt', 'w') as f:
+            f.write('six\n')
+        timings_dir = self.mkdir('timings')
+        builder = self.builder('1')
+        with patch('tempfile.mkdtemp', return_value=timings_dir), \
+                patch('yodeploy.cmds.build_artifact.run_parallel',
+                      side_effect=SystemExit(1)), \
+                patch('sys.stdout', new_callable=io.StringIO):
+            self.assertRaises(SystemExit, builder.prepare)
+        self.assertNotTMPPExists('timings')
+
+    def test_timings(self):
+        builder = self.builder('1')
+        with builder.timed('build'):
+            for i in range(100):
+                with builder.timed('build.step%i' % i):
+                    pass
+        self.upload(builder)
+        timings = json.loads(
+            self.repo.get_metadata('app', '1')['build_timings'])
+        self.assertEqual(list(timings), ['build'])
+
+        with patch('sys.stdout', new_callable=io.StringIO):
+            builder.summary()
+        with open(self.tmppath('test_build', 'reports',
+                               'build-timings.json')) as f:
+            report = json.load(f)
+        self.assertEqual(len(builder.timings), 104)
+        self.assertIn('build.step99', report['timings'])
+        self.assertEqual(sorted(report['timings']), sorted(builder.timings))
+
+    def test_metadata_size(self):
+        builder = self.builder('1')
+        builder.commit_msg = 'A long commit message. ' * 200
+        for i in range(200):
+            builder.timings['prepare.phase%i' % i] = 1.0
+        builder.test_status = ('failure', 'A long failure. ' * 200)
+        with patch('sys.stderr', new_callable=io.StringIO):
+            self.upload(builder, test_status=None)
+        metadata = self.repo.get_metadata('app', '1')
+        self.assertLessEqual(metadata_size(metadata), METADATA_LIMIT)
+        self.assertEqual(len(metadata['commit_msg']), METADATA_TEXT_LIMIT)
+        self.assertTrue(metadata['commit_msg'].endswith('...'))
+        self.assertEqual(len(metadata['test_description']),
+                         METADATA_TEXT_LIMIT)
+
+    def test_reuse(self):
+        self.upload(self.builder('1'))
+        os.unlink('dist/app.tar.gz')
+        builder = self.builder('2')
+        with patch('sys.stdout', new_callable=io.StringIO):
+            builder.reuse(builder.cached_version())
+        self.assertEqual(self.repo.list_versions('app'), ['1', '2'])
+        metadata = self.repo.get_metadata('app', '2')
+        self.assertEqual(metadata['reused_build'], '1')
+        self.assertEqual(metadata['test_status'], 'success')
+        self.assertEqual(metadata['test_description'], 'Ran 1 tests')
+
+
+class TestMergeXunitReports(TmpDirTestCase):
+
+    def write(self, name, contents):
+        with open(self.tmppath(name), 'w') as f:
+            f.write(contents)
+        return self.tmppath(name)
+
+    def test_merge(self):
+        a = self.write('a.xml',
+                       '<testsuite name="a" tests="2" failures="1" '
+                       'errors="0" time="1.5">'
+                       '<testcase name="a1"/><testcase name="a2"/>'
+                       '</testsuite>')
+        b = self.write('b.xml',
+                       '<testsuites><testsuite name="b" tests="1" '
+                       'failures="0" errors="1" time="0.5">'
+                       '<testcase name="b1"/></testsuite></testsuites>')
+        merge_xunit_reports([a, b], self.tmppath('merged.xml'))
+        root = ElementTree.parse(self.tmppath('merged.xml')).getroot()
+        self.assertEqual(root.get('tests'), '3')
+        self.assertEqual(root.get('failures'), '1')
+        self.assertEqual(root.get('errors'), '1')
+        self.assertEqual(root.get('time'), '2.000')
+        self.assertEqual([case.get('name') for case in root],
+                         ['a1', 'a2', 'b1'])
+
+    def test_no_sources(self):
+        merge_xunit_reports([], self.tmppath('merged.xml'))
+        self.assertNotTMPPExists('merged.xml')
+
+
+class TestShardedTests(TmpDirTestCase):
+
+    def setUp(self):
+        super(TestShardedTests, self).setUp()
+        self.mkdir('scripts')
+        with open(self.tmppath('scripts', 'test.sh'), 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'echo "<testsuite tests=\\"$SHARD_INDEX\\"/>" '
+                    '> $TEST_REPORTS_DIR/xunit.xml\n'
+                    'echo "shard $SHARD_INDEX of $SHARD_COUNT"\n')
+        os.chmod(self.tmppath('scripts', 'test.sh'), 0o755)
+        pwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        self.addCleanup(os.chdir, pwd)
+
+    def test_sharded(self):
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            builder = BuildCompat5(
+                app='app', target='master', version='1', commit='123',
+                commit_msg='msg', branch='master', tag=None,
+                deploy_settings=None, deploy_settings_file=None,
+                repository=None, build_virtualenvs=False,
+                upload_virtualenvs=False, test_shards=3)
+            builder.test_sharded(dict(os.environ))
+        self.assertIn('shard 2 | shard 2 of 3', stdout.getvalue())
+        root = ElementTree.parse(
+            self.tmppath('test_build', 'reports', 'xunit.xml')).getroot()
+        self.assertEqual(root.get('tests'), '3')
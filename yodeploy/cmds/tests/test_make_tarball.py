@@ -0,0 +1 @@
+import yodeploy.cmds.make_tarball
@@ -0,0 +1,154 @@
+"""Prebuilt configuration slices.
+
+Deploying an app needs its configuration smushed from the whole configs
+artifact, plus the app's own deploy/configuration. A slice is that result,
+for one version of an app, one version of configs, and one environment and
+cluster, built once (e.g. by spade build-config-slices) and stored as a small
+JSON artifact alongside the app.
+
+Slices can't capture machine-specific configuration, so none are built if the
+configs contain any, and deploys fall back to smushing locally if the
+(machine-local) deployconfigs overrides have any sources for the app.
+"""
+import json
+import logging
+import os
+import shutil
+import tarfile
+
+from yoconfigurator.base import DetectMissingEncoder
+from yoconfigurator.smush import (available_sources, config_sources,
+                                  smush_config)
+
+from yodeploy.util import extract_tar
+
+log = logging.getLogger(__name__)
+
+# Sources that are specific to the machine the configuration is built on
+MACHINE_SOURCES = ('hostname', 'common-overrides', '%(app)s-overrides')
+
+
+class SliceError(Exception):
+    pass
+
+
+def slice_artifact(app, environment, cluster):
+    return '%s.config-%s-%s.json' % (app, environment, cluster)
+
+
+def slice_version(version, configs_version):
+    """The repository version of the slice for (app) version and configs"""
+    return '%s-%s' % (version, configs_version)
+
+
+def machine_sources(app, configs_dirs):
+    """Return the machine-specific sources present in configs_dirs"""
+    return list(available_sources(
+        (configs_dirs, name % {'app': app}) for name in MACHINE_SOURCES))
+
+
+def override_sources(app, environment, cluster, overrides, app_conf_dir):
+    """Return the sources in the (machine-local) overrides that apply to app"""
+    sources = config_sources(app, environment, cluster, overrides,
+                             app_conf_dir)
+    return [fn for fn in sources
+            if not fn.startswith(os.path.join(app_conf_dir, ''))]
+
+
+def build_slice(app, environment, cluster, configs_dir, app_conf_dir):
+    """Smush the configuration for app in environment and cluster.
+
+    Returns the configuration, serialized as JSON.
+    """
+    found = machine_sources(app, [configs_dir])
+    if found:
+        raise SliceError('Configs have machine-specific sources: %s'
+                         % ', '.join(found))
+    sources = config_sources(app, environment, cluster, [configs_dir],
+                             app_conf_dir)
+    config = smush_config(sources,
+                          initial={'yoconfigurator': {'app': app}})
+    try:
+        return json.dumps(config, cls=DetectMissingEncoder, sort_keys=True)
+    except ValueError as e:
+        raise SliceError(str(e))
+
+
+def download_slice(repository, app, version, configs_version, environment,
+                   cluster, target='master'):
+    """Return the prebuilt configuration, as a dict.
+
+    Raises KeyError if the slice hasn't been built.
+    """
+    with repository.get(app, slice_version(version, configs_version),
+                        target=target,
+                        artifact=slice_artifact(app, environment,
+                                                cluster)) as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def _extract_app_conf(tarball, dest):
+    """Extract only deploy/configuration from an app tarball, into dest"""
+    workdir = dest + '.tmp'
+    os.mkdir(workdir)
+    try:
+        with tarfile.open(tarball, 'r') as tar:
+            members = [member for member in tar.getmembers()
+                       if member.name.split('/', 1)[-1].startswith(
+                           'deploy/configuration/')]
+            tar.extractall(workdir, members)
+        for root in os.listdir(workdir):
+            conf = os.path.join(workdir, root, 'deploy', 'configuration')
+            if os.path.isdir(conf):
+                os.rename(conf, dest)
+                return
+        os.mkdir(dest)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def _download(repository, app, version, target, dest):
+    with repository.get(app, version, target=target) as f1:
+        with open(dest, 'wb') as f2:
+            shutil.copyfileobj(f1, f2)
+
+
+def build_slices(repository, app, clusters, workdir, target='master',
+                 version=None, configs_version=None):
+    """Build and upload slices for each (environment, cluster) in clusters.
+
+    Defaults to the latest versions of app and configs.
+    Returns the names of the uploaded slice artifacts.
+    """
+    if version is None:
+        version = repository.latest_version(app, target=target)
+    if configs_version is None:
+        configs_version = repository.latest_version('configs')
+
+    tarball = os.path.join(workdir, 'configs.tar.gz')
+    _download(repository, 'configs', configs_version, 'master', tarball)
+    configs_dir = os.path.join(workdir, 'configs')
+    extract_tar(tarball, configs_dir)
+    os.unlink(tarball)
+
+    tarball = os.path.join(workdir, '%s.tar.gz' % app)
+    _download(repository, app, version, target, tarball)
+    app_conf_dir = os.path.join(workdir, 'configuration')
+    _extract_app_conf(tarball, app_conf_dir)
+    os.unlink(tarball)
+
+    uploaded = []
+    for environment, cluster in clusters:
+        artifact = slice_artifact(app, environment, cluster)
+        log.info('Building %s for %s version %s, configs version %s',
+                 artifact, app, version, configs_version)
+        data = build_slice(app, environment, cluster, configs_dir,
+                           app_conf_dir)
+        metadata = {
+            'version': version,
+            'configs_version': configs_version,
+        }
+        repository.put(app, slice_version(version, configs_version), data,
+                       metadata, target=target, artifact=artifact)
+        uploaded.append(artifact)
+    return uploaded
@@ -0,0 +1,255 @@
+"""File manifests and delta archives between artifact versions.
+
+At build time, every uploaded artifact gets a manifest describing each file in
+its tarball, and delta archives against a few previous versions, containing
+only the members that changed.
+
+At deploy time, a version can be reconstructed from an already unpacked
+version on disk plus a (small) delta archive, instead of downloading the full
+tarball.
+"""
+import copy
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import tarfile
+import zlib
+
+from yodeploy.util import ignoring
+
+log = logging.getLogger(__name__)
+
+
+class DeltaError(Exception):
+    pass
+
+
+def manifest_artifact(app):
+    return '%s.manifest.json' % app
+
+
+def delta_artifact(app):
+    return '%s.delta.tar.gz' % app
+
+
+def delta_version(version, base_version):
+    """The repository version of the delta from base_version to version"""
+    return '%s-%s' % (version, base_version)
+
+
+def sha256sum(f):
+    m = hashlib.sha256()
+    for chunk in iter(lambda: f.read(64 * 1024), b''):
+        m.update(chunk)
+    return m.hexdigest()
+
+
+def _relpath(name, root):
+    """Strip the single top-level directory from a tar member name"""
+    parts = name.split('/', 1)
+    if parts[0] != root:
+        raise DeltaError('Tarball has > 1 top-level directory')
+    return parts[1] if len(parts) > 1 else ''
+
+
+def tar_manifest(tarball):
+    """Describe every member of an artifact tarball.
+
+    Paths are relative to the tarball's (single) top-level directory.
+    """
+    files = {}
+    with tarfile.open(tarball, 'r') as tar:
+        members = tar.getmembers()
+        roots = set(member.name.split('/', 1)[0] for member in members)
+        if len(roots) != 1:
+            raise DeltaError('Tarball has > 1 top-level directory')
+        root = roots.pop()
+        for member in members:
+            path = _relpath(member.name, root)
+            if not path:
+                continue
+            entry = {'mode': stat.S_IMODE(member.mode)}
+            if member.isdir():
+                entry['type'] = 'dir'
+            elif member.issym():
+                entry['type'] = 'symlink'
+                entry['target'] = member.linkname
+            elif member.isfile() or member.islnk():
+                # Hardlinks are described (and delta'd) as regular files
+                entry['type'] = 'file'
+                data = tar.extractfile(member)
+                entry['sha256'] = sha256sum(data)
+                # A hardlink member's own size is 0
+                entry['size'] = data.tell()
+            else:
+                # Devices, FIFOs, etc. can't be expressed as a delta
+                raise DeltaError('Unsupported tar member: %s' % member.name)
+            files[path] = entry
+
+    return {
+        'root': root,
+        'size': os.path.getsize(tarball),
+        'files': files,
+        'deltas': {},
+    }
+
+
+def changed_paths(manifest, base_manifest):
+    """Paths in manifest that differ from (or are missing in) base_manifest"""
+    base_files = base_manifest['files']
+    return set(path for path, entry in manifest['files'].items()
+               if base_files.get(path) != entry)
+
+
+def write_delta(tarball, manifest, base_manifest, dest):
+    """Write a tarball of the members of tarball that aren't in base"""
+    changed = changed_paths(manifest, base_manifest)
+    with tarfile.open(tarball, 'r') as src:
+        with tarfile.open(dest, 'w:gz') as dst:
+            for member in src.getmembers():
+                path = _relpath(member.name, manifest['root'])
+                if path not in changed:
+                    continue
+                if member.islnk():
+                    # The link's target may not be in the delta
+                    data = src.extractfile(member)
+                    member = copy.copy(member)
+                    member.type = tarfile.REGTYPE
+                    member.linkname = ''
+                    member.size = manifest['files'][path]['size']
+                    dst.addfile(member, data)
+                elif member.isfile():
+                    dst.addfile(member, src.extractfile(member))
+                else:
+                    dst.addfile(member)
+
+
+def load_manifest(repository, app, version, target='master'):
+    with repository.get(app, version, target,
+                        artifact=manifest_artifact(app)) as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def upload_manifest(repository, app, version, manifest, target='master'):
+    repository.put(app, version, json.dumps(manifest, sort_keys=True), {},
+                   target, manifest_artifact(app))
+
+
+def build_deltas(repository, app, version, tarball, target='master',
+                 max_deltas=3, workdir='.'):
+    """Upload a manifest for tarball, and deltas against older versions.
+
+    Deltas are produced against the most recent max_deltas versions that have
+    manifests. The manifest is uploaded last, recording the sizes of the
+    available deltas, so its presence means the deltas are usable.
+    """
+    manifest = tar_manifest(tarball)
+    versions = [v for v in repository.list_versions(app, target)
+                if v != version]
+    bases = versions[-max_deltas:] if max_deltas else []
+    for base in bases:
+        try:
+            base_manifest = load_manifest(repository, app, base, target)
+        except KeyError:
+            log.debug('No manifest for %s/%s, skipping delta', app, base)
+            continue
+        if base_manifest['root'] != manifest['root']:
+            continue
+        delta = os.path.join(workdir, '%s-%s.delta.tar.gz' % (app, base))
+        write_delta(tarball, manifest, base_manifest, delta)
+        size = os.path.getsize(delta)
+        if size < manifest['size']:
+            with open(delta, 'rb') as f:
+                repository.put(app, delta_version(version, base), f, {},
+                               target, delta_artifact(app))
+            manifest['deltas'][base] = size
+            log.info('Uploaded delta %s -> %s (%i bytes)', base, version, size)
+        os.unlink(delta)
+
+    upload_manifest(repository, app, version, manifest, target)
+    return manifest
+
+
+def choose_base(manifest, available_versions):
+    """Return the base version giving the smallest delta, or None"""
+    candidates = [(size, base) for base, size in manifest['deltas'].items()
+                  if base in available_versions and size < manifest['size']]
+    if not candidates:
+        return None
+    return min(candidates)[1]
+
+
+def _verify(directory, path, entry, name):
+    """Check that path in directory matches its manifest entry"""
+    fn = os.path.join(directory, path)
+    if entry is None:
+        raise DeltaError('Not in the manifest: %s' % path)
+    try:
+        if entry['type'] == 'dir':
+            ok = os.path.isdir(fn) and not os.path.islink(fn)
+        elif entry['type'] == 'symlink':
+            ok = os.path.islink(fn) and os.readlink(fn) == entry['target']
+        else:
+            with open(fn, 'rb') as f:
+                ok = sha256sum(f) == entry['sha256']
+    except (IOError, OSError) as e:
+        raise DeltaError('Unreadable in %s: %s (%s)' % (name, path, e))
+    if not ok:
+        raise DeltaError('Modified in %s: %s' % (name, path))
+
+
+def apply_delta(base_dir, delta_tarball, manifest, dest):
+    """Reconstruct the tree described by manifest in dest.
+
+    Changed members come from delta_tarball, everything else is copied from
+    base_dir, and both are verified against the manifest. Raises DeltaError
+    if the base or delta can't be used (e.g. the base's files have been
+    modified in place).
+    """
+    os.makedirs(dest)
+    changed = set()
+    try:
+        with tarfile.open(delta_tarball, 'r') as tar:
+            members = tar.getmembers()
+            for member in members:
+                member.name = _relpath(member.name, manifest['root'])
+                member.uid = 0
+                member.gid = 0
+                member.uname = 'root'
+                member.gname = 'root'
+                changed.add(member.name)
+            tar.extractall(dest, [member for member in members
+                                  if member.name])
+    except (tarfile.TarError, EOFError, zlib.error) as e:
+        raise DeltaError('Unreadable delta: %s' % e)
+
+    files = manifest['files']
+    for path in sorted(changed):
+        if path:
+            _verify(dest, path, files.get(path), 'delta')
+
+    for path in sorted(files):
+        if path in changed:
+            continue
+        entry = files[path]
+        src = os.path.join(base_dir, path)
+        dst = os.path.join(dest, path)
+        if entry['type'] == 'dir':
+            with ignoring(errno.EEXIST):
+                os.makedirs(dst)
+        elif entry['type'] == 'symlink':
+            os.symlink(entry['target'], dst)
+        else:
+            with ignoring(errno.EEXIST):
+                os.makedirs(os.path.dirname(dst))
+            _verify(base_dir, path, entry, 'base')
+            shutil.copyfile(src, dst)
+            os.chmod(dst, entry['mode'])
+
+    for path in sorted(files, reverse=True):
+        if files[path]['type'] == 'dir':
+            os.chmod(os.path.join(dest, path), files[path]['mode'])
@@ -48,8 +48,11 @@ def strip_auth(url):
 
 
 def report(app, action, target, old_version, version, deploy_settings,
-           user=None):
-    """Report to the world that we deployed."""
+           user=None, events=None):
+    """Report to the world that we deployed.
+
+    events are the events recorded by the app's deploy hooks.
+    """
     if user is None:
         user = os.getenv('SUDO_USER', os.getenv('LOGNAME'))
     environment = deploy_settings.artifacts.environment
@@ -59,6 +62,8 @@ def report(app, action, target, old_version, version, deploy_settings,
                                                      old_version, version)
 
     log.info(message)
+    for event in events or []:
+        log.info('Hook event: %s', json.dumps(event, sort_keys=True))
     services = deploy_settings.report.services
 
     if 'webhooks' in services:
@@ -72,6 +77,7 @@ def report(app, action, target, old_version, version, deploy_settings,
             'user': user,
             'fqdn': fqdn,
             'environment': environment,
+            'events': events or [],
         }
         for webhook_url in service_settings.urls:
             log.info('Sending deploy information to webhook: %s',
@@ -93,8 +99,13 @@ def available_applications(deploy_settings):
     return repository.list_apps()
 
 
-def deploy(app, target, config, version, deploy_settings, user=None):
-    """Deploy an application."""
+def deploy(app, target, config, version, deploy_settings, user=None,
+           commit=None):
+    """Deploy an application.
+
+    If version isn't specified, the latest version built from commit is
+    deployed, or the latest version if commit isn't specified either.
+    """
     if app not in available_applications(deploy_settings):
         log.error('This application is not in the available applications '
                   'list. Please check your deploy config.')
@@ -104,12 +115,18 @@ def deploy(app, target, config, version, deploy_settings, user=None):
     application = yodeploy.application.Application(app, config)
 
     old_version = application.live_version
+    if version is None and commit:
+        versions = repository.find(app, target, commit=commit)
+        if not versions:
+            log.error('No version of %s has been built from %s', app, commit)
+            sys.exit(1)
+        version = versions[-1]
     if version is None:
         version = repository.latest_version(app, target)
 
     application.deploy(target, repository, version)
     report(application.app, 'deploy', target, old_version, version,
-           deploy_settings, user)
+           deploy_settings, user, events=application.events(version))
 
 
 def gc(max_versions, config, deploy_settings):
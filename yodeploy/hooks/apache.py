@@ -8,6 +8,7 @@ import sys
 from os.path import join
 
 from yodeploy.hooks.configurator import ConfiguratedApp
+from yodeploy.reloads import coalesced_reload, config_changed, reload_pending
 
 log = logging.getLogger(__name__)
 
@@ -27,6 +28,12 @@ class ApacheHostedApp(ConfiguratedApp):
     vhost_path = '/etc/apache2/sites-enabled'
     includes_path = '/etc/apache2/yola.d'
     apache = Apache
+    # Reload Apache on every deploy, even if our configuration is unchanged.
+    # Needed if Apache runs the app's code (e.g. mod_wsgi). Apps that only
+    # have Apache configuration (e.g. static sites, proxies) can disable it.
+    reload_unchanged = True
+    # Seconds to wait for concurrent deploys to join our reload
+    reload_window = 1
 
     def deployed(self):
         super(ApacheHostedApp, self).deployed()
@@ -35,6 +42,8 @@ class ApacheHostedApp(ConfiguratedApp):
     def prepare(self):
         super(ApacheHostedApp, self).prepare()
         self.apache_hosted_prepare()
+        if self.templates_changed(self.vhost_path, self.includes_path):
+            config_changed('apache2')
 
     def apache_hosted_prepare(self):
         """Create a vhost and place optional includes."""
@@ -50,6 +59,7 @@ class ApacheHostedApp(ConfiguratedApp):
         old_vhost = join(self.vhost_path, self.app)
         if os.path.exists(old_vhost):
             os.unlink(old_vhost)
+            self.record_change(old_vhost)
 
     def place_includes(self):
         """Place all snippits in Apache's yola.d.
@@ -61,7 +71,12 @@ class ApacheHostedApp(ConfiguratedApp):
         self.template_all(tmpls_dir, yolad_app_path)
 
     def apache_hosted_deployed(self):
-        self.apache.reload()
+        # Our templates changed, or an earlier deploy's reload failed
+        if self.reload_unchanged or reload_pending('apache2'):
+            coalesced_reload('apache2', self.apache.reload,
+                             window=self.reload_window)
+        else:
+            log.info('Apache configuration is unchanged, not reloading')
 
 
 class ApacheMultiSiteApp(ApacheHostedApp):
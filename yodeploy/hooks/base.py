@@ -1,5 +1,10 @@
+import json
 import os
 
+# Events recorded by hooks, within the version's directory, for the deploy
+# report. JSON, one event per line.
+EVENTS_FILE = '.deploy-events'
+
 
 class DeployHook(object):
     def __init__(self, app, target, root, version, settings,
@@ -30,3 +35,9 @@ class DeployHook(object):
     def deploy_path(self, *args):
         '''Convenience function combining deploy_dir and os.path.join'''
         return os.path.join(self.deploy_dir, *args)
+
+    def report_event(self, event, **data):
+        '''Record an event, to be included in the deploy report'''
+        data['event'] = event
+        with open(self.deploy_path(EVENTS_FILE), 'a') as f:
+            f.write(json.dumps(data, sort_keys=True) + '\n')
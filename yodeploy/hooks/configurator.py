@@ -3,14 +3,17 @@ import json
 import logging
 import os
 import shutil
+import time
 
 from yoconfigurator.base import read_config, write_config
 from yoconfigurator.dicts import DotDict
 from yoconfigurator.filter import filter_config
-from yoconfigurator.smush import config_sources, smush_config
+from yoconfigurator.smush import config_sources
 
+from yodeploy.config_slices import download_slice, override_sources
 from yodeploy.hooks.templating import TemplatedApp
 from yodeploy.locking import SpinLockFile
+from yodeploy.smush import smush_config
 from yodeploy.util import extract_tar
 
 log = logging.getLogger(__name__)
@@ -20,6 +23,11 @@ class ConfiguratedApp(TemplatedApp):
 
     public_config_js_path = None
     public_config_token = "<%= config %>"
+    # Number of extracted configs versions to keep around
+    configs_cache_keep = 3
+    # Seconds since a cached configs version was last used, before it can be
+    # pruned (readers use them without the lock)
+    configs_cache_grace = 3600
 
     def __init__(self, *args, **kwargs):
         super(ConfiguratedApp, self).__init__(*args, **kwargs)
@@ -44,37 +52,130 @@ class ConfiguratedApp(TemplatedApp):
         self.config = self.read_config()
         self.pub_config = self.read_pub_config()
 
-    def write_config(self):
+    def configs_dir(self, version=None):
+        """Return a directory containing the configs artifact (latest).
+
+        Each version of the configs artifact is extracted once, into an
+        immutable directory named for the version. Readers only take the lock
+        if the version they want isn't there yet. Using a version refreshes
+        its mtime, so that prune_configs leaves it alone for a while.
+        """
         conf_root = os.path.join(self.settings.paths.apps, 'configs')
-        if not os.path.exists(conf_root):
-            os.mkdir(conf_root)
-        conf_tarball = os.path.join(conf_root, 'configs.tar.gz')
-        with SpinLockFile(os.path.join(conf_root, 'deploy.lock'), timeout=30):
+        versions = os.path.join(conf_root, 'versions')
+        if version is None:
             try:
-                with self.repository.get('configs', target='master') as f1:
-                    with open(conf_tarball, 'wb') as f2:
-                        shutil.copyfileobj(f1, f2)
+                version = self.repository.latest_version('configs')
             except KeyError:
                 raise Exception("No configs in artifacts repository")
+        configs = os.path.join(versions, version)
+        if os.path.isdir(configs):
+            log.debug('Using cached configs version %s', version)
+            try:
+                os.utime(configs, None)
+            except OSError:
+                # Pruned under us, despite the grace period
+                pass
+            else:
+                return configs
+
+        if not os.path.exists(versions):
+            os.makedirs(versions)
+        with SpinLockFile(os.path.join(conf_root, 'deploy.lock'), timeout=30):
+            if os.path.isdir(configs):
+                return configs
+
+            log.info('Downloading configs version %s', version)
+            workdir = os.path.join(conf_root, 'tmp-%i' % os.getpid())
+            if os.path.exists(workdir):
+                shutil.rmtree(workdir)
+            os.mkdir(workdir)
+            try:
+                conf_tarball = os.path.join(workdir, 'configs.tar.gz')
+                try:
+                    with self.repository.get('configs', version=version,
+                                             target='master') as f1:
+                        with open(conf_tarball, 'wb') as f2:
+                            shutil.copyfileobj(f1, f2)
+                except KeyError:
+                    raise Exception("No configs in artifacts repository")
+                extract_tar(conf_tarball, os.path.join(workdir, 'configs'))
+                os.rename(os.path.join(workdir, 'configs'), configs)
+                # For pruning, by the time we got it, not when it was built
+                os.utime(configs, None)
+            finally:
+                shutil.rmtree(workdir)
+
+            self.prune_configs(conf_root)
+        return configs
+
+    def prune_configs(self, conf_root):
+        """Remove all but the most recently used few configs versions.
+
+        Versions used within configs_cache_grace are kept, as readers may
+        still be using them. Must be called with the lock held.
+        """
+        # Left behind by older releases
+        legacy = os.path.join(conf_root, 'configs')
+        if os.path.isdir(legacy):
+            shutil.rmtree(legacy)
+
+        versions = os.path.join(conf_root, 'versions')
+        cached = sorted(
+            os.listdir(versions),
+            key=lambda v: os.stat(os.path.join(versions, v)).st_mtime)
+        cutoff = time.time() - self.configs_cache_grace
+        for version in cached[:-self.configs_cache_keep]:
+            if os.stat(os.path.join(versions, version)).st_mtime > cutoff:
+                continue
+            log.debug('Removing cached configs version %s', version)
+            shutil.rmtree(os.path.join(versions, version))
+
+    def config_slice(self, configs_version):
+        """Return the prebuilt configuration for this app, or None.
+
+        See yodeploy.config_slices.
+        """
+        if override_sources(self.app, self.settings.artifacts.environment,
+                            self.settings.artifacts.cluster,
+                            self.settings.deployconfigs.overrides,
+                            self.deploy_path('deploy', 'configuration')):
+            log.debug('Config overrides present, not using a config slice')
+            return None
+        try:
+            config = download_slice(
+                self.repository, self.app, self.version, configs_version,
+                self.settings.artifacts.environment,
+                self.settings.artifacts.cluster, target=self.target)
+        except KeyError:
+            log.debug('No config slice for %s version %s, configs version %s',
+                      self.app, self.version, configs_version)
+            return None
+        log.info('Using prebuilt config slice')
+        return DotDict(config)
 
-            configs = os.path.join(conf_root, 'configs')
-            if os.path.exists(configs):
-                shutil.rmtree(configs)
-
-            extract_tar(conf_tarball, configs)
-            os.unlink(conf_tarball)
+    def write_config(self):
+        app_conf_dir = self.deploy_path('deploy', 'configuration')
+        try:
+            configs_version = self.repository.latest_version('configs')
+        except KeyError:
+            raise Exception("No configs in artifacts repository")
 
+        config = self.config_slice(configs_version)
+        if config is None:
+            configs = self.configs_dir(configs_version)
             configs_dirs = [configs] + self.settings.deployconfigs.overrides
-            app_conf_dir = self.deploy_path('deploy', 'configuration')
             sources = config_sources(self.app,
                                      self.settings.artifacts.environment,
                                      self.settings.artifacts.cluster,
                                      configs_dirs, app_conf_dir)
             config = smush_config(
-                sources, initial={'yoconfigurator': {'app': self.app}})
+                sources, initial={'yoconfigurator': {'app': self.app}},
+                environment=self.settings.artifacts.environment,
+                cluster=self.settings.artifacts.cluster,
+                cache=self.settings.deployconfigs.get('smush_cache', True))
 
-            public_filter_pn = os.path.join(app_conf_dir, 'public-data.py')
-            public_config = filter_config(config, public_filter_pn)
+        public_filter_pn = os.path.join(app_conf_dir, 'public-data.py')
+        public_config = filter_config(config, public_filter_pn)
 
         write_config(config, self.deploy_dir)
         if public_config:
@@ -5,20 +5,70 @@ This looks for templates in deploy/templates/{upstart,supervisord,systemd}, and
 installs them in the appropriate place for the given init system / process
 manager. It then tells the manager to load, enable, and start the jobs.
 
+All the templates are rendered before the manager reloads its configuration
+(once), and then the jobs are restarted concurrently. With
+DaemonApp.rolling_restart, they are restarted in batches instead, waiting for
+each batch to pass its readiness probes before restarting the next.
+
 The templates should be named with the disired final name + '.template', e.g.
 my-celery-worker.service.template
 """
 
 import logging
 import os
+import socket
 import subprocess
+import threading
+import time
+import xmlrpc.client
+from concurrent.futures import ThreadPoolExecutor
 
 from yodeploy.hooks.templating import TemplatedApp
+from yodeploy.reloads import config_applied, config_changed, reload_pending
+from yodeploy.supervisor import (CONNECTION_ERRORS, SOCKET_PATH,
+                                 SupervisorClient)
 
 
 log = logging.getLogger(__name__)
 
 
+def probe_command(command, timeout=10):
+    """Does command succeed?"""
+    try:
+        return subprocess.call(command, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL,
+                               timeout=timeout) == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+def probe_port(port, host='localhost', timeout=1):
+    """Is something accepting connections on host:port?"""
+    try:
+        socket.create_connection((host, port), timeout=timeout).close()
+    except OSError:
+        return False
+    return True
+
+
+def probe_pidfile(path, since, min_age=0):
+    """Has a live process written path since since, min_age seconds ago?"""
+    try:
+        mtime = os.stat(path).st_mtime
+        with open(path) as f:
+            pid = int(f.read().strip())
+    except (OSError, ValueError):
+        return False
+    try:
+        os.kill(pid, 0)
+    except PermissionError:
+        # Alive, but not ours
+        pass
+    except OSError:
+        return False
+    return mtime >= since and time.time() - mtime >= min_age
+
+
 class Manager(object):
     name = None
     target_path = None
@@ -31,24 +81,100 @@ class Manager(object):
         raise NotImplemented
 
     def install_daemons(self):
+        changed = False
+        restart = []
         for name, template, target in self.iter_templates():
             if self.app.is_daemon_enabled(name):
-                log.info('Creating and restarting %s %s daemon',
-                         name, self.name)
-                self.app.template(template, target)
-                self.reload()
-                self.restart(name)
+                log.info('Creating %s %s daemon', name, self.name)
+                if self.app.template(template, target):
+                    changed = True
+                    restart.append(name)
+                elif self.app.restart_unchanged_daemons:
+                    restart.append(name)
             elif os.path.exists(target):
                 log.info('Removing %s %s daemon', name, self.name)
                 self.destroy(name)
                 os.unlink(target)
-                self.reload()
+                changed = True
             self.installed_daemons = True
 
+        if changed:
+            config_changed(self.name)
+        # Our configuration changed, or an earlier deploy's reload failed
+        if reload_pending(self.name):
+            started = time.time()
+            if self.reload():
+                config_applied(self.name, started)
+        if restart:
+            self.restart_all(restart)
+
+    def restart_all(self, tasks):
+        """Restart tasks, all at once or rolling, in batches"""
+        if not self.app.rolling_restart:
+            self.restart_batch(tasks)
+            return
+
+        size = max(1, self.app.rolling_batch_size)
+        batches = [tasks[i:i + size] for i in range(0, len(tasks), size)]
+        for i, batch in enumerate(batches, 1):
+            start = time.time()
+            self.restart_batch(batch)
+            restarted = time.time()
+            self.wait_ready(batch, start)
+            ready = time.time()
+            log.info('Restarted %s daemon batch %i/%i (%s) in %.1fs, ready '
+                     'after %.1fs', self.name, i, len(batches),
+                     ', '.join(batch), restarted - start, ready - restarted)
+            self.app.report_event(
+                'daemon_batch_restarted', manager=self.name, daemons=batch,
+                batch=i, batches=len(batches),
+                seconds=round(restarted - start, 3),
+                ready_seconds=round(ready - restarted, 3))
+
+    def wait_ready(self, tasks, since):
+        """Wait for tasks (restarted at since) to pass their readiness probes
+
+        Raises an Exception if they aren't ready within readiness_timeout,
+        leaving the remaining batches alone.
+        """
+        pending = list(tasks)
+        deadline = time.time() + self.app.readiness_timeout
+        while True:
+            pending = [task for task in pending
+                       if not self.app.is_daemon_ready(task, since)]
+            if not pending:
+                return
+            if time.time() > deadline:
+                raise Exception('%s %s daemon(s) not ready after %is, '
+                                'aborting rolling restart'
+                                % (', '.join(pending), self.name,
+                                   self.app.readiness_timeout))
+            time.sleep(0.5)
+
+    def restart_batch(self, tasks):
+        """Restart tasks concurrently, and report how long each took"""
+        lock = threading.Lock()
+
+        def restart(task):
+            start = time.time()
+            self.restart(task)
+            with lock:
+                self.report_restart(task, time.time() - start)
+
+        workers = min(len(tasks), self.app.daemon_restart_workers)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for future in [pool.submit(restart, task) for task in tasks]:
+                future.result()
+
+    def report_restart(self, task, seconds):
+        log.info('Restarted %s %s daemon in %.1fs', task, self.name, seconds)
+        self.app.report_event('daemon_restarted', manager=self.name,
+                              daemon=task, seconds=round(seconds, 3))
+
     def iter_templates(self):
         if not os.path.exists(self.template_dir):
             return
-        for fn in os.listdir(self.template_dir):
+        for fn in sorted(os.listdir(self.template_dir)):
             if not fn.endswith('.template'):
                 continue
             name = fn.split('.')[0]
@@ -57,6 +183,7 @@ class Manager(object):
             yield name, template, target
 
     def reload(self):
+        """Load the installed configuration. Returns True if it succeeded"""
         raise NotImplemented
 
     def restart(self, task):
@@ -71,18 +198,71 @@ class Manager(object):
 
 
 class Supervisor(Manager):
+    """Talks to supervisord over XML-RPC, or via supervisorctl.
+
+    supervisorctl is only used if supervisord's socket isn't there, or we
+    can't talk to it.
+    """
     name = 'supervisord'
     target_path = '/etc/supervisor/conf.d'
+    socket_path = SOCKET_PATH
+    # Seconds to wait for daemons to start running
+    restart_timeout = 60
+
+    _client = None
 
     def is_available(self):
         return os.path.exists('/usr/bin/supervisord')
 
+    @property
+    def client(self):
+        """A SupervisorClient, or None to use supervisorctl"""
+        if self._client is None:
+            self._client = False
+            if os.path.exists(self.socket_path):
+                self._client = SupervisorClient(self.socket_path)
+        return self._client or None
+
+    def _rpc_failed(self, e):
+        log.warning('Unable to talk to supervisord (%s), falling back to '
+                    'supervisorctl', e)
+        self._client.close()
+        self._client = False
+
     def reload(self):
+        if self.client:
+            try:
+                self.client.update()
+                return True
+            except xmlrpc.client.Fault as e:
+                log.error('Unable to update supervisord configs: %s', e)
+                return False
+            except CONNECTION_ERRORS as e:
+                self._rpc_failed(e)
         try:
             subprocess.check_call(('supervisorctl', 'reread'))
             subprocess.check_call(('supervisorctl', 'update'))
         except subprocess.CalledProcessError:
             log.error('Unable to update supervisord configs')
+            return False
+        return True
+
+    def restart_batch(self, tasks):
+        if self.client:
+            try:
+                results = self.client.restart(tasks,
+                                              timeout=self.restart_timeout)
+            except CONNECTION_ERRORS as e:
+                self._rpc_failed(e)
+            else:
+                for task in tasks:
+                    if results[task] is None:
+                        log.error('Unable to restart %s supervisord task',
+                                  task)
+                    else:
+                        self.report_restart(task, results[task])
+                return
+        super(Supervisor, self).restart_batch(tasks)
 
     def restart(self, task):
         try:
@@ -92,6 +272,12 @@ class Supervisor(Manager):
             log.error('Unable to restart %s supervisord task', task)
 
     def destroy(self, task):
+        if self.client:
+            try:
+                self.client.stop([task], timeout=self.restart_timeout)
+                return
+            except CONNECTION_ERRORS as e:
+                self._rpc_failed(e)
         subprocess.call(('supervisorctl', 'stop', task))
 
 
@@ -107,17 +293,28 @@ class SystemD(Manager):
             subprocess.check_call(('systemctl', 'daemon-reload'))
         except subprocess.CalledProcessError:
             log.error('Unable to reload systemd config')
+            return False
+        return True
 
-    def restart(self, task):
+    def enable(self, tasks):
         try:
-            subprocess.check_call(('systemctl', 'enable', task))
+            subprocess.check_call(('systemctl', 'enable') + tuple(tasks))
         except subprocess.CalledProcessError:
-            log.error('Unable to install %s systemd task', task)
+            log.error('Unable to install %s systemd task(s)',
+                      ', '.join(tasks))
+
+    def restart(self, task):
         try:
             subprocess.check_call(('systemctl', 'restart', task))
         except subprocess.CalledProcessError:
             log.error('Unable to restart %s systemd task', task)
 
+    def restart_all(self, tasks):
+        # One enable for all the units. Restarts stay one unit per systemctl
+        # (run concurrently), so that we can time each.
+        self.enable(tasks)
+        super(SystemD, self).restart_all(tasks)
+
     def destroy(self, task):
         try:
             subprocess.check_call(('systemctl', 'disable', task))
@@ -137,7 +334,7 @@ class Upstart(Manager):
         return os.path.exists('/sbin/initctl')
 
     def reload(self):
-        pass
+        return True
 
     def restart(self, task):
         try:
@@ -151,6 +348,24 @@ class Upstart(Manager):
 
 
 class DaemonApp(TemplatedApp):
+    # Restart daemons whose configuration is unchanged, to run the new
+    # version. Disable for daemons that don't run the app's code.
+    restart_unchanged_daemons = True
+    # Most daemons to restart at once
+    daemon_restart_workers = 8
+    # Restart daemons rolling_batch_size at a time, waiting for each batch to
+    # pass its readiness probe (see is_daemon_ready) before the next
+    rolling_restart = False
+    rolling_batch_size = 1
+    # Seconds to wait for a batch to be ready, before failing the deploy
+    readiness_timeout = 60
+    # Readiness probes, by daemon name. One of:
+    #   {'command': ['curl', '-sf', 'http://localhost:8000/health']}
+    #   {'port': 8000, 'host': 'localhost'}
+    #   {'pidfile': '/run/worker.pid', 'min_age': 5}
+    # Daemons without a probe are ready once their manager has restarted them.
+    readiness_probes = {}
+
     def deployed(self):
         super(TemplatedApp, self).deployed()
         self.configure_daemons()
@@ -175,3 +390,17 @@ class DaemonApp(TemplatedApp):
 
     def is_daemon_enabled(self, name):
         return True
+
+    def is_daemon_ready(self, name, since):
+        """Is name (restarted at time since) ready for the next batch?"""
+        probe = self.readiness_probes.get(name)
+        if not probe:
+            return True
+        if 'command' in probe:
+            return probe_command(probe['command'])
+        if 'port' in probe:
+            return probe_port(probe['port'], probe.get('host', 'localhost'))
+        if 'pidfile' in probe:
+            return probe_pidfile(probe['pidfile'], since,
+                                 probe.get('min_age', 0))
+        raise ValueError('Unknown readiness probe for %s: %r' % (name, probe))
@@ -1,23 +1,55 @@
 import errno
+import hashlib
+import inspect
+import json
 import logging
 import os
 import subprocess
 import sys
+import tempfile
+import time
+from http.client import HTTPException
+from urllib.parse import urljoin
+from urllib.request import Request, urlopen
 
 from packaging.version import parse as parse_version
 
+import yodeploy.hooks.django_batch
 from yodeploy.hooks.apache import ApacheHostedApp, ApacheMultiSiteApp
 from yodeploy.hooks.configurator import ConfiguratedApp
 from yodeploy.hooks.nginx import NginxHostedApp
 from yodeploy.hooks.python import PythonApp
-from yodeploy.util import chown_r, ignoring, touch
+from yodeploy.delta import sha256sum
+from yodeploy.util import chown_r, ignoring, link_tree, touch
+
+# Executed by the app's python, see django_batch
+BATCH_RUNNER = inspect.getsource(yodeploy.hooks.django_batch)
+
+# The static source dirs of a version, and hashes of the files in them,
+# relative to the version. Used by incremental_static
+STATIC_SOURCES_MANIFEST = '.static-sources.json'
+# The migrations_fingerprint of a version, once it has been migrated
+MIGRATIONS_FINGERPRINT = '.migrations-fingerprint'
 
 
 log = logging.getLogger(__name__)
 
 
+def collected_names(manifest):
+    """The paths (in STATIC_ROOT) that manifest's sources are collected to"""
+    names = set()
+    for path in manifest['sources']:
+        for source_dir in manifest['dirs']:
+            if path.startswith(os.path.join(source_dir, '')):
+                names.add(os.path.relpath(path, source_dir))
+    return names
+
+
 class DjangoApp(ConfiguratedApp, PythonApp):
     migrate_on_deploy = False
+    # Migrate even if the migrations are unchanged since the live version.
+    # (Also forced by YODEPLOY_FORCE_MIGRATE=1, e.g. deploy --force-migrate)
+    always_migrate = False
     has_migrations = False
     has_media = False
     compress = False
@@ -25,6 +57,29 @@ class DjangoApp(ConfiguratedApp, PythonApp):
     has_static = False
     log_user = 'www-data'
     log_group = 'adm'
+    # Run the prepare hook's management commands in a single Django process
+    # (Django >= 1.8)
+    batch_management_commands = True
+    # Seed static_dir (STATIC_ROOT), relative to the version, from the live
+    # version's, so collectstatic only has to process changed sources.
+    # (compress --force regenerates everything regardless.)
+    incremental_static = False
+    static_dir = None
+    # The directories that collectstatic collects from (app static dirs and
+    # STATICFILES_DIRS), relative to the version. By default, every directory
+    # named static, outside static_dir and the virtualenv.
+    static_source_dirs = None
+    # Warm up the new version: Before swinging, load it (manage.py check) and
+    # import warmup_imports. After the web server has reloaded, request each
+    # of warmup_urls (relative to warmup_base_url) warmup_requests times, to
+    # reach several workers. Each stage gets warmup_budget seconds.
+    warmup = False
+    warmup_imports = ()
+    warmup_urls = ()
+    warmup_base_url = 'http://localhost/'
+    warmup_headers = {}
+    warmup_requests = 4
+    warmup_budget = 30
 
     def prepare(self):
         super(DjangoApp, self).prepare()
@@ -33,6 +88,8 @@ class DjangoApp(ConfiguratedApp, PythonApp):
     def deployed(self):
         self.django_deployed()
         super(DjangoApp, self).deployed()
+        if self.warmup:
+            self.warmup_deployed()
 
     def prepare_logfiles(self):
         path = self.config.get(self.app, {}).get('path', {})
@@ -45,15 +102,19 @@ class DjangoApp(ConfiguratedApp, PythonApp):
                 os.mkdir(os.path.dirname(logfile))
             touch(logfile, self.log_user, self.log_group, 0o660)
 
-    def call_compress(self):
+    def compress_command(self):
         if not self.compress:
-            return
+            return None
 
         file_exts_to_compress = [] if self.compress is True else self.compress
         cmd = ['compress', '--force']
         [cmd.extend(('-e', ext)) for ext in file_exts_to_compress]
+        return cmd
 
-        self.manage_py(*cmd)
+    def call_compress(self):
+        cmd = self.compress_command()
+        if cmd:
+            self.manage_py(*cmd)
 
     def django_prepare(self):
         log.debug('Running DjangoApp prepare hook')
@@ -74,16 +135,141 @@ class DjangoApp(ConfiguratedApp, PythonApp):
 
         self.prepare_logfiles()
 
-        if self.migrate_on_deploy:
-            self.migrate()
+        if self.incremental_static:
+            static_manifest = self.seed_static()
 
-        if self.has_static:
-            self.manage_py('collectstatic', '--noinput')
+        if self.overrides_management_commands():
+            # Respect the subclass, one command at a time
+            if self.migrate_on_deploy:
+                self.migrate()
 
-        self.call_compress()
+            if self.has_static:
+                self.manage_py('collectstatic', '--noinput')
 
-        if self.compile_i18n:
-            self.manage_py('compilemessages')
+            self.call_compress()
+
+            if self.compile_i18n:
+                self.manage_py('compilemessages')
+        else:
+            commands = []
+            if self.migrate_on_deploy:
+                log.info('Running migrations on %s', self.app)
+                commands += self.migrate_batch()
+
+            if self.has_static:
+                commands.append(['collectstatic', '--noinput'])
+
+            if self.compress:
+                commands.append(self.compress_command())
+
+            if self.compile_i18n:
+                commands.append(['compilemessages'])
+
+            self.manage_py_batch(commands)
+
+            if self.migrate_on_deploy:
+                self.record_migrations()
+
+            if self.migrate_on_deploy and os.path.exists(data_dir):
+                chown_r(data_dir, 'www-data', 'www-data')
+
+        if self.incremental_static and static_manifest:
+            with open(self.deploy_path(STATIC_SOURCES_MANIFEST), 'w') as f:
+                json.dump(static_manifest, f, sort_keys=True)
+
+        if self.warmup:
+            self.warmup_prepare()
+
+    def live_path(self, *args):
+        """Path within the live version, or None if we're the first/live"""
+        live = os.path.join(self.root, 'live')
+        if not os.path.islink(live):
+            return None
+        version = os.path.basename(os.readlink(live))
+        if version == self.version:
+            return None
+        return os.path.join(self.root, 'versions', version, *args)
+
+    def find_static_source_dirs(self):
+        """The static_source_dirs, or every directory named static"""
+        if self.static_source_dirs is not None:
+            return sorted(self.static_source_dirs)
+        skip = set(self.deploy_path(path) for path in
+                   (self.static_dir, 'virtualenv', 'node_modules')
+                   if path)
+        found = []
+        for root, dirs, files in os.walk(self.deploy_dir):
+            dirs[:] = [d for d in dirs if os.path.join(root, d) not in skip]
+            if 'static' in dirs:
+                dirs.remove('static')
+                found.append(os.path.relpath(os.path.join(root, 'static'),
+                                             self.deploy_dir))
+        return sorted(found)
+
+    def static_sources(self, source_dirs):
+        """Hash every file in source_dirs, by path within the version"""
+        sources = {}
+        for source_dir in source_dirs:
+            for root, dirs, files in os.walk(self.deploy_path(source_dir)):
+                for fn in files:
+                    path = os.path.join(root, fn)
+                    if os.path.islink(path):
+                        continue
+                    with open(path, 'rb') as f:
+                        sources[os.path.relpath(path, self.deploy_dir)] = (
+                            sha256sum(f))
+        return sources
+
+    def seed_static(self):
+        """Seed the collected static files from the live version.
+
+        They are hardlinked, which relies on collectstatic replacing files
+        rather than writing to them in place (as Django's storages do).
+        collectstatic skips files whose source is older than the collected
+        copy, so unchanged sources (according to the live version's
+        manifest) are backdated, and changed ones touched.
+        Collected files whose sources have been removed are deleted.
+
+        Returns the manifest for this version, or None if static_dir isn't
+        set.
+        """
+        if not self.static_dir:
+            log.warning('incremental_static requires static_dir, collecting '
+                        'all static files')
+            return None
+        manifest = {'dirs': self.find_static_source_dirs()}
+        manifest['sources'] = self.static_sources(manifest['dirs'])
+        live_manifest = self.live_path(STATIC_SOURCES_MANIFEST)
+        if not live_manifest or not os.path.exists(live_manifest):
+            log.info('No static manifest in the live version, collecting '
+                     'all static files')
+            return manifest
+        with open(live_manifest) as f:
+            live = json.load(f)
+
+        if (not os.path.exists(self.deploy_path(self.static_dir))
+                and os.path.isdir(self.live_path(self.static_dir))):
+            link_tree(self.live_path(self.static_dir),
+                      self.deploy_path(self.static_dir))
+
+        removed = collected_names(live) - collected_names(manifest)
+        for name in removed:
+            with ignoring(errno.ENOENT):
+                os.unlink(self.deploy_path(self.static_dir, name))
+
+        changed = 0
+        for path, digest in manifest['sources'].items():
+            # Leave bytecode validation alone
+            if path.endswith('.py'):
+                continue
+            if live['sources'].get(path) == digest:
+                os.utime(self.deploy_path(path), (0, 0))
+            else:
+                os.utime(self.deploy_path(path), None)
+                changed += 1
+        log.info('Seeded static files from the live version, %i sources '
+                 'changed, %i removed', changed, len(removed))
+        return manifest
 
     def django_deployed(self):
         data_dir = os.path.join(self.root, 'data')
@@ -92,47 +278,261 @@ class DjangoApp(ConfiguratedApp, PythonApp):
 
     @property
     def django_version(self):
-        return parse_version(self.manage_py('version'))
+        """The app's Django version (cached)"""
+        if getattr(self, '_django_version', None) is None:
+            # Much cheaper than manage.py version, which sets Django up
+            try:
+                version = subprocess.check_output(
+                    ['virtualenv/bin/python', '-c',
+                     'import django; print(django.get_version())'],
+                    cwd=self.deploy_dir, stderr=subprocess.STDOUT)
+                version = version.decode('utf-8').strip()
+            except subprocess.CalledProcessError:
+                version = self.manage_py('version').strip()
+            self._django_version = parse_version(version)
+        return self._django_version
+
+    def migrate_commands(self):
+        if self.django_version >= parse_version('1.7.0'):
+            return [['migrate', '--noinput']]
+        commands = [['syncdb', '--noinput']]
+        if self.has_migrations:
+            commands.append(['migrate'])
+        return commands
 
     def run_migrate_commands(self):
-        if self.django_version >= parse_version('1.7.0'):
-            self.manage_py('migrate', '--noinput')
-        else:
-            self.manage_py('syncdb', '--noinput')
-            if self.has_migrations:
-                self.manage_py('migrate')
+        for command in self.migrate_commands():
+            self.manage_py(*command)
 
-    def migrate(self):
-        log.info('Running migrations on %s', self.app)
-        if self.config is None:
-            raise Exception("Config hasn't been loaded yet")
+    def overrides_management_commands(self):
+        """Has a subclass overridden how prepare's commands are run?
 
-        data_dir = os.path.join(self.root, 'data')
-        aconf = self.config.get(self.app)
-
-        if 'db' not in aconf:
-            return
+        If so, we can't batch them (in manage_py_batch).
+        """
+        return any(getattr(type(self), name) is not getattr(DjangoApp, name)
+                   for name in ('migrate', 'run_migrate_commands',
+                                'call_compress', 'manage_py'))
 
+    def new_db(self):
+        """Are we about to create the (sqlite) database?"""
+        aconf = self.config.get(self.app)
         uses_sqlite = aconf.get('db', {}).get('engine', '').endswith('sqlite3')
-        new_db = False
-        if uses_sqlite:
-            if not os.path.exists(aconf.db.name):
-                new_db = True
+        return uses_sqlite and not os.path.exists(aconf.db.name)
 
-        self.run_migrate_commands()
+    def needs_migrations(self):
+        if self.config is None:
+            raise Exception("Config hasn't been loaded yet")
+
+        if 'db' not in self.config.get(self.app):
+            return False
+
+        if not self.new_db() and not self.migrations_changed():
+            log.info('Migrations are unchanged since the live version, '
+                     'skipping them')
+            return False
+        return True
+
+    def seed_data(self):
+        """The fixture to load into a new database, or None"""
+        seed_data = self.deploy_path(self.app, 'seed_data.json')
+        if self.new_db() and os.path.exists(seed_data):
+            return seed_data
+        return None
+
+    def migrate_batch(self):
+        """The management commands that migrate (and maybe seed) the DB"""
+        if not self.needs_migrations():
+            return []
+
+        seed_data = self.seed_data()
+        commands = self.migrate_commands()
+        if seed_data:
+            commands.append(['loaddata', seed_data])
+        return commands
+
+    def migrations_fingerprint(self):
+        """Hash everything that determines the result of migrate.
+
+        That is: the migration modules in the app, the virtualenv (which
+        identifies the versions of third-party apps and their migrations), and
+        the database configuration.
+        """
+        m = hashlib.sha256()
+        m.update(os.path.basename(os.path.realpath(
+            self.deploy_path('virtualenv'))).encode('utf-8'))
+        m.update(json.dumps(self.config.get(self.app).get('db'),
+                            sort_keys=True).encode('utf-8'))
+        for root, dirs, files in os.walk(self.deploy_dir):
+            dirs[:] = sorted(d for d in dirs
+                             if d not in ('virtualenv', 'node_modules'))
+            if os.path.basename(root) != 'migrations':
+                continue
+            for fn in sorted(files):
+                if not fn.endswith('.py'):
+                    continue
+                path = os.path.join(root, fn)
+                with open(path, 'rb') as f:
+                    m.update(('%s\0%s\0' % (
+                        os.path.relpath(path, self.deploy_dir), sha256sum(f))
+                    ).encode('utf-8'))
+        return m.hexdigest()
+
+    def migrations_changed(self):
+        """Do we need to migrate, or has the live version done it for us?"""
+        if self.always_migrate or os.environ.get('YODEPLOY_FORCE_MIGRATE'):
+            return True
+        # syncdb (Django < 1.7) depends on models, not just migrations
+        if self.django_version < parse_version('1.7.0'):
+            return True
+        live_fingerprint = self.live_path(MIGRATIONS_FINGERPRINT)
+        if not live_fingerprint or not os.path.exists(live_fingerprint):
+            return True
+        with open(live_fingerprint) as f:
+            return f.read().strip() != self.migrations_fingerprint()
+
+    def record_migrations(self):
+        """Record that this version's migrations have been applied"""
+        if 'db' not in self.config.get(self.app):
+            return
+        with open(self.deploy_path(MIGRATIONS_FINGERPRINT), 'w') as f:
+            f.write('%s\n' % self.migrations_fingerprint())
 
-        if new_db:
-            seed_data = self.deploy_path(self.app, 'seed_data.json')
-            if os.path.exists(seed_data):
+    def migrate(self):
+        log.info('Running migrations on %s', self.app)
+        if self.needs_migrations():
+            seed_data = self.seed_data()
+            self.run_migrate_commands()
+            if seed_data:
                 self.manage_py('loaddata', seed_data)
+        self.record_migrations()
 
+        data_dir = os.path.join(self.root, 'data')
         if os.path.exists(data_dir):
             chown_r(data_dir, 'www-data', 'www-data')
 
+    def warmup_prepare(self):
+        """Load the new version's Django project, before it goes live"""
+        log.info('Warming up %s', self.app)
+        commands = [self.manage_py_cmd('check')]
+        if self.warmup_imports:
+            commands.append(self.manage_py_cmd(
+                'shell', '-c', 'import %s' % ', '.join(self.warmup_imports)))
+
+        start = time.time()
+        success = True
+        for cmd in commands:
+            remaining = self.warmup_budget - (time.time() - start)
+            try:
+                subprocess.check_output(cmd, cwd=self.deploy_dir,
+                                        stderr=subprocess.STDOUT,
+                                        timeout=max(remaining, 0))
+            except subprocess.CalledProcessError as e:
+                log.warning('Warm-up command failed: %r\n%s', cmd,
+                            e.output.decode('utf-8', 'replace'))
+                success = False
+            except subprocess.TimeoutExpired:
+                log.warning('Warm-up exceeded its budget of %is',
+                            self.warmup_budget)
+                success = False
+                break
+
+        self.report_event('warmup_prepare', success=success,
+                          seconds=round(time.time() - start, 3))
+
+    def warmup_deployed(self):
+        """Request warmup_urls from the newly reloaded web server"""
+        if not self.warmup_urls:
+            return
+        log.info('Warming up %s workers', self.app)
+        start = time.time()
+        latencies = []
+        failures = 0
+        timed_out = False
+        for i in range(self.warmup_requests):
+            for url in self.warmup_urls:
+                remaining = self.warmup_budget - (time.time() - start)
+                if remaining <= 0:
+                    timed_out = True
+                    break
+                url = urljoin(self.warmup_base_url, url)
+                request_start = time.time()
+                try:
+                    response = urlopen(Request(url,
+                                               headers=self.warmup_headers),
+                                       timeout=remaining)
+                    response.read()
+                    response.close()
+                except (OSError, HTTPException) as e:
+                    log.debug('Warm-up request to %s failed: %s', url, e)
+                    failures += 1
+                latencies.append(time.time() - request_start)
+            if timed_out:
+                log.warning('Warm-up exceeded its budget of %is',
+                            self.warmup_budget)
+                break
+
+        latencies_ms = [int(latency * 1000) for latency in latencies]
+        self.report_event(
+            'warmup', success=not (failures or timed_out),
+            requests=len(latencies), failures=failures,
+            seconds=round(time.time() - start, 3),
+            first_ms=latencies_ms[0] if latencies_ms else None,
+            median_ms=(sorted(latencies_ms)[len(latencies_ms) // 2]
+                       if latencies_ms else None),
+            max_ms=max(latencies_ms) if latencies_ms else None)
+
+    def manage_py_cmd(self, command, *args):
+        return ['virtualenv/bin/python',
+                os.path.join(self.app, 'manage.py'),
+                command] + list(args)
+
+    def manage_py_batch(self, commands):
+        """Run several management commands, in a single Django process.
+
+        Like manage_py, exits on the first failure. Returns their output.
+        """
+        if not commands:
+            return []
+        if (not self.batch_management_commands
+                or self.django_version < parse_version('1.8')):
+            return [self.manage_py(*command) for command in commands]
+
+        fd, results_fn = tempfile.mkstemp(prefix='manage-py-batch',
+                                          suffix='.json')
+        os.close(fd)
+        cmd = ['virtualenv/bin/python', '-c', BATCH_RUNNER,
+               os.path.join(self.app, 'manage.py'), results_fn]
+        log.debug('Executing %r', commands)
+        try:
+            p = subprocess.Popen(cmd, cwd=self.deploy_dir,
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+            output = p.communicate(json.dumps(commands).encode('utf-8'))[0]
+            with open(results_fn) as f:
+                results = json.load(f)
+        except ValueError:
+            log.error('Management commands failed: %r\n%s', commands,
+                      output.decode('utf-8', 'replace'))
+            sys.exit(1)
+        finally:
+            os.unlink(results_fn)
+
+        self._django_version = parse_version(results['django_version'])
+        for result in results['results']:
+            log.debug('%r took %.1fs', result['command'], result['seconds'])
+            if 'error' in result:
+                log.error('Management command failed: %r\n%s%s',
+                          result['command'], result['output'],
+                          result['error'])
+                sys.exit(1)
+        if p.returncode != 0:
+            log.error('Management commands failed: %r\n%s', commands,
+                      output.decode('utf-8', 'replace'))
+            sys.exit(1)
+        return [result['output'] for result in results['results']]
+
     def manage_py(self, command, *args):
-        cmd = ['virtualenv/bin/python',
-               os.path.join(self.app, 'manage.py'),
-               command] + list(args)
+        cmd = self.manage_py_cmd(command, *args)
         log.debug("Executing %r", cmd)
         try:
             output = subprocess.check_output(cmd, cwd=self.deploy_dir)
@@ -0,0 +1,72 @@
+"""Run several Django management commands in a single process.
+
+This runs in the app's virtualenv, not ours, so it must stand alone (and
+support Python 2.7). DjangoApp passes its source to python -c, with:
+
+    argv: manage.py results.json
+    stdin: A JSON list of commands, each a list of [command, arg, ...]
+
+manage.py is executed as usual, so that it configures the settings module,
+but execute_from_command_line is replaced by a runner that sets Django up
+once, and calls each command in turn with call_command, stopping at the
+first failure. The Django version, and each command's output, error and
+duration are written to results.json.
+"""
+import json
+import os
+import runpy
+import sys
+import time
+import traceback
+
+try:
+    from StringIO import StringIO  # python 2
+except ImportError:
+    from io import StringIO  # python 3
+
+
+def run(commands, results_fn):
+    import django
+    from django.core.management import call_command
+
+    django.setup()
+    results = {
+        'django_version': django.get_version(),
+        'results': [],
+    }
+    try:
+        for command in commands:
+            output = StringIO()
+            result = {'command': command}
+            start = time.time()
+            try:
+                call_command(command[0], *command[1:], stdout=output,
+                             stderr=output)
+            except BaseException:
+                result['error'] = traceback.format_exc()
+            result['output'] = output.getvalue()
+            result['seconds'] = time.time() - start
+            results['results'].append(result)
+            if 'error' in result:
+                break
+    finally:
+        with open(results_fn, 'w') as f:
+            json.dump(results, f)
+
+
+def main():
+    manage_py, results_fn = sys.argv[1:3]
+    commands = json.load(sys.stdin)
+
+    # As if we were running manage.py directly
+    sys.path[0] = os.path.dirname(os.path.abspath(manage_py))
+    sys.argv = [manage_py]
+
+    from django.core import management
+    management.execute_from_command_line = (
+        lambda argv=None: run(commands, results_fn))
+    runpy.run_path(manage_py, run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
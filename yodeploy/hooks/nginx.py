@@ -4,12 +4,15 @@ import subprocess
 import sys
 
 from yodeploy.hooks.configurator import ConfiguratedApp
+from yodeploy.reloads import coalesced_reload, config_changed, reload_pending
 
 log = logging.getLogger(__name__)
 
 
 class NginxHostedApp(ConfiguratedApp):
     server_blocks_path = '/etc/nginx/sites-enabled'
+    # Seconds to wait for concurrent deploys to join our reload
+    reload_window = 1
 
     def deployed(self):
         super(NginxHostedApp, self).deployed()
@@ -18,6 +21,8 @@ class NginxHostedApp(ConfiguratedApp):
     def prepare(self):
         super(NginxHostedApp, self).prepare()
         self.nginx_hosted_prepare()
+        if self.templates_changed(self.server_blocks_path):
+            config_changed('nginx')
 
     def nginx_hosted_prepare(self):
         log.debug('Running NginxHostedApp prepare hook.')
@@ -28,7 +33,12 @@ class NginxHostedApp(ConfiguratedApp):
 
     def nginx_hosted_deployed(self):
         log.debug('Running NginxHostedApp deployed hook.')
-        self._reload_nginx()
+        # Our templates changed, or an earlier deploy's reload failed
+        if reload_pending('nginx'):
+            coalesced_reload('nginx', self._reload_nginx,
+                             window=self.reload_window)
+        else:
+            log.info('nginx configuration is unchanged, not reloading')
 
     def _reload_nginx(self):
         try:
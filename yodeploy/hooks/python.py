@@ -1,5 +1,7 @@
 import logging
 import os
+import subprocess
+import time
 
 from yodeploy import virtualenv
 from yodeploy.hooks.base import DeployHook
@@ -7,8 +9,18 @@ from yodeploy.util import extract_tar
 
 log = logging.getLogger(__name__)
 
+_PRINT_VERSION = 'import sys; print("%i.%i" % sys.version_info[:2])'
+
 
 class PythonApp(DeployHook):
+    # Compile the app and its virtualenv to bytecode before swinging the
+    # symlink, so the first request to each worker doesn't have to.
+    precompile = True
+    # Timestamps are unreliable after extraction, so use hash-based pycs
+    # (Python >= 3.7). 'unchecked-hash' skips validating them against their
+    # sources, at import time.
+    bytecode_invalidation_mode = 'checked-hash'
+
     def prepare(self):
         super(PythonApp, self).prepare()
         self.python_prepare()
@@ -18,6 +30,10 @@ class PythonApp(DeployHook):
         requirements = self.deploy_path('requirements.txt')
         if os.path.exists(requirements):
             self.deploy_ve()
+            if self.precompile:
+                self.compile_bytecode(
+                    self.deploy_dir,
+                    self.deploy_path('virtualenv', 'bin', 'python'))
 
     def deploy_ve(self):
         log = logging.getLogger(__name__)
@@ -28,9 +44,11 @@ class PythonApp(DeployHook):
         python_version = virtualenv.get_python_version(
             compat=compat, is_deploy=False
         )
-        ve_id = virtualenv.get_id(self.deploy_path('requirements.txt'),
-                                  python_version,
-                                  self.settings.artifacts.platform)
+        requirements = self.deploy_path('requirements.txt')
+        platform = self.settings.artifacts.platform
+        legacy_id = self.settings.artifacts.get('legacy_ve_ids', False)
+        ve_id = virtualenv.get_id(requirements, python_version, platform,
+                                  legacy=legacy_id)
         ve_working = os.path.join(self.root, 'virtualenvs', 'unpack')
         ve_dir = os.path.join(self.root, 'virtualenvs', ve_id)
         tarball = os.path.join(ve_working, 'virtualenv.tar.gz')
@@ -41,12 +59,42 @@ class PythonApp(DeployHook):
 
             if not os.path.exists(ve_working):
                 os.makedirs(ve_working)
+            # Artifacts built before normalized ids only have legacy ids
+            fallback_ids = () if legacy_id else (virtualenv.get_id(
+                requirements, python_version, platform, legacy=True),)
             virtualenv.download_ve(
-                self.repository, self.app, ve_id, self.target, dest=tarball)
+                self.repository, self.app, ve_id, self.target, dest=tarball,
+                fallback_ids=fallback_ids)
             extract_tar(tarball, ve_unpack_root)
             os.rename(ve_unpack_root, ve_dir)
+            # Only needed once per virtualenv, they're shared between versions
+            if self.precompile:
+                self.compile_bytecode(
+                    ve_dir, os.path.join(ve_dir, 'bin', 'python'))
 
         ve_symlink = self.deploy_path('virtualenv')
         if not os.path.exists(ve_symlink):
             os.symlink(os.path.join('..', '..', 'virtualenvs', ve_id),
                        ve_symlink)
+
+    def compile_bytecode(self, path, python):
+        """Compile everything under path, with python, in parallel"""
+        start = time.time()
+        version = subprocess.check_output([python, '-c', _PRINT_VERSION],
+                                          universal_newlines=True)
+        version = tuple(int(part) for part in version.split('.'))
+
+        cmd = [python, '-m', 'compileall', '-q']
+        if version >= (3, 5):
+            # One worker process per CPU
+            cmd += ['-j', '0']
+        if version >= (3, 7):
+            cmd += ['--invalidation-mode', self.bytecode_invalidation_mode]
+        p = subprocess.Popen(cmd + [path], stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        out = p.communicate()[0]
+        if p.returncode != 0:
+            # Not fatal, the sources will be compiled on import, as usual
+            log.warning('Failed to compile bytecode in %s:\n%s', path,
+                        out.decode('utf-8', 'replace'))
+        log.info('Compiled bytecode in %s (%.1fs)', path, time.time() - start)
@@ -1,14 +1,85 @@
+import errno
+import fnmatch
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-from jinja2 import Template
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from jinja2.bccache import Bucket
 
 from yodeploy.hooks.base import DeployHook
+from yodeploy.util import ignoring
 
 log = logging.getLogger(__name__)
 
+BYTECODE_CACHE_DIR = os.path.join('~', '.cache', 'yodeploy', 'jinja2')
+# Most compiled templates to keep
+BYTECODE_CACHE_SIZE = 1024
+# Files changed by templating this version (one path per line), within the
+# version's directory. For the deployed hooks to decide what to reload.
+CHANGED_TEMPLATES = '.changed-templates'
+
+
+class ContentBytecodeCache(FileSystemBytecodeCache):
+    """A bytecode cache keyed by template name and source, not filename.
+
+    Every version of an app is deployed to a new path, so a cache keyed by
+    filename (like FileSystemBytecodeCache) would never get a hit.
+    """
+
+    def get_bucket(self, environment, name, filename, source):
+        key = self.get_cache_key(name, self.get_source_checksum(source))
+        bucket = Bucket(environment, key, key)
+        self.load_bytecode(bucket)
+        if bucket.code is not None:
+            # For pruning
+            with ignoring(errno.ENOENT):
+                os.utime(self._get_cache_filename(bucket), None)
+        return bucket
+
+    def prune(self, size=BYTECODE_CACHE_SIZE):
+        """Delete all but the size most recently used templates"""
+        entries = []
+        for fn in fnmatch.filter(os.listdir(self.directory),
+                                 self.pattern % '*'):
+            path = os.path.join(self.directory, fn)
+            with ignoring(errno.ENOENT):
+                entries.append((os.stat(path).st_mtime, path))
+        entries.sort()
+        for mtime, path in entries[:-size]:
+            with ignoring(errno.ENOENT):
+                os.unlink(path)
+
+
+def bytecode_cache():
+    directory = os.environ.get('YODEPLOY_TEMPLATE_CACHE',
+                               os.path.expanduser(BYTECODE_CACHE_DIR))
+    cache = ContentBytecodeCache(directory)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        cache.prune()
+    except OSError as e:
+        log.debug('Unable to use template cache %s: %s', directory, e)
+        return None
+    return cache
+
 
 class TemplatedApp(DeployHook):
+    # Number of templates to render concurrently in template_all
+    template_workers = 4
+
+    _template_env = None
+
+    @property
+    def template_env(self):
+        """The jinja2 Environment for this version's templates"""
+        if self._template_env is None:
+            self._template_env = Environment(
+                loader=FileSystemLoader(self.template_filename('')),
+                bytecode_cache=bytecode_cache())
+        return self._template_env
+
     def template_filename(self, template_name):
         return self.deploy_path('deploy', 'templates', template_name)
 
@@ -16,40 +87,90 @@ class TemplatedApp(DeployHook):
         return os.path.exists(self.template_filename(template_name))
 
     def template(self, template_name, destination, perm=0o644):
+        """Render template_name to destination.
+
+        Returns True if destination changed.
+        """
         log.debug('Parsing template: %s -> %s', template_name, destination)
-        fn = self.template_filename(template_name)
-        with open(fn, 'rb') as f:
-            template_code = f.read().decode('utf-8')
-        tmpl = Template(template_code)
+        tmpl = self.template_env.get_template(template_name)
         output = tmpl.render(
             conf=self.config,
             aconf=self.config.get(self.app, {}),
             cconf=self.config.get('common', {})
         )
-        with open(destination, 'w') as f:
-            f.write(output)
+        return self.write_if_changed(destination, output.encode('utf-8'),
+                                     perm)
+
+    def write_if_changed(self, destination, data, perm=0o644):
+        """Atomically replace destination with data, if it differs.
+
+        Returns True if destination changed.
+        """
+        try:
+            with open(destination, 'rb') as f:
+                unchanged = f.read() == data
+        except IOError:
+            unchanged = False
+
+        if unchanged:
+            log.debug('%s is unchanged', destination)
+            if os.stat(destination).st_mode & 0o7777 != perm:
+                os.chmod(destination, perm)
+            return False
+
+        # Hidden, so that web servers don't include it, mid-write
+        tmp = os.path.join(os.path.dirname(destination), '.%s.tmp-%i' % (
+            os.path.basename(destination), os.getpid()))
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp, perm)
+        os.rename(tmp, destination)
+        self.record_change(destination)
+        return True
+
+    def record_change(self, path):
+        """Record that we changed path, for templates_changed"""
+        with open(self.deploy_path(CHANGED_TEMPLATES), 'a') as f:
+            f.write('%s\n' % path)
 
-        os.chmod(destination, perm)
+    def templates_changed(self, *paths):
+        """Has this version changed any file in (or under) paths?"""
+        try:
+            with open(self.deploy_path(CHANGED_TEMPLATES)) as f:
+                changed = f.read().splitlines()
+        except IOError:
+            return False
+        for path in paths:
+            for fn in changed:
+                if fn == path or fn.startswith(os.path.join(path, '')):
+                    return True
+        return False
 
     def template_all(self, path, dest, min_count=0):
         """Write all templates in the path to the destination.
 
         Fails quietly unless a minimum number of templates is specified.
+        Returns the set of destination files that changed.
         """
-        count = 0
         template_path = self.template_filename(path)
 
         if not self.template_exists(path):
             if min_count:
                 raise Exception("Templates missing from %s" % template_path)
-            return
+            return set()
 
         if not os.path.exists(dest):
             os.makedirs(dest)
 
-        for tmpl in os.listdir(template_path):
-            self.template(os.path.join(path, tmpl), os.path.join(dest, tmpl))
-            count += 1
+        templates = os.listdir(template_path)
+        with ThreadPoolExecutor(max_workers=self.template_workers) as pool:
+            futures = [pool.submit(self.template, '/'.join((path, tmpl)),
+                                   os.path.join(dest, tmpl))
+                       for tmpl in templates]
+            changed = set(os.path.join(dest, tmpl)
+                          for tmpl, future in zip(templates, futures)
+                          if future.result())
 
-        if count < min_count:
+        if len(templates) < min_count:
             raise Exception("Templates missing from %s" % template_path)
+        return changed
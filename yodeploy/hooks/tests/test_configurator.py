@@ -1,2 +1,98 @@
+import json
+import os
+import time
+
+from unittest.mock import patch
+
 from yodeploy.hooks.configurator import ConfiguratedApp
-hush_pyflakes = ConfiguratedApp
+from yodeploy.repository import LocalRepositoryStore, Repository
+from yodeploy.tests import TmpDirTestCase
+
+
+class AttrDict(dict):
+    __getattr__ = dict.__getitem__
+
+
+class TestConfigsCache(TmpDirTestCase):
+    def setUp(self):
+        super(TestConfigsCache, self).setUp()
+        self.repo = Repository(LocalRepositoryStore(self.mkdir('repo')))
+        self.mkdir('apps')
+        settings = AttrDict(
+            paths=AttrDict(apps=self.tmppath('apps')),
+            artifacts=AttrDict(environment='prod', cluster='east'),
+            deployconfigs=AttrDict(overrides=[self.mkdir('overrides')]),
+        )
+        self.ch = ConfiguratedApp('test', 'master', self.tmppath('apps'),
+                                  '1', settings, self.repo)
+
+    def upload(self, version, contents):
+        self.create_tar('configs.tar.gz',
+                        contents={'configs/test.py': contents})
+        with open(self.tmppath('configs.tar.gz'), 'rb') as f:
+            self.repo.put('configs', version, f, {})
+        os.unlink(self.tmppath('configs.tar.gz'))
+
+    def test_extracts_latest(self):
+        self.upload('1', 'one')
+        configs = self.ch.configs_dir()
+        self.assertEqual(configs,
+                         self.tmppath('apps', 'configs', 'versions', '1'))
+        self.assertTMPPContents('one', 'apps', 'configs', 'versions', '1',
+                                'test.py')
+
+    def test_cached(self):
+        self.upload('1', 'one')
+        self.ch.configs_dir()
+        with patch.object(self.repo, 'get') as get:
+            self.ch.configs_dir()
+        self.assertFalse(get.called)
+
+    def test_new_version(self):
+        self.upload('1', 'one')
+        self.ch.configs_dir()
+        self.upload('2', 'two')
+        self.assertTMPPContents('two', self.ch.configs_dir(), 'test.py')
+        self.assertTMPPExists('apps', 'configs', 'versions', '1')
+
+    def test_prunes_old_versions(self):
+        for version in ('1', '2', '3', '4'):
+            self.upload(version, version)
+            self.ch.configs_dir()
+            os.utime(self.tmppath('apps', 'configs', 'versions', version),
+                     (int(version), int(version)))
+        self.assertEqual(
+            sorted(os.listdir(self.tmppath('apps', 'configs', 'versions'))),
+            ['2', '3', '4'])
+
+    def test_keeps_recently_used_versions(self):
+        for version in ('1', '2', '3', '4'):
+            self.upload(version, version)
+            self.ch.configs_dir()
+        self.assertEqual(
+            sorted(os.listdir(self.tmppath('apps', 'configs', 'versions'))),
+            ['1', '2', '3', '4'])
+
+    def test_use_refreshes_mtime(self):
+        self.upload('1', 'one')
+        configs = self.ch.configs_dir()
+        os.utime(configs, (1, 1))
+        self.ch.configs_dir('1')
+        self.assertGreater(os.stat(configs).st_mtime,
+                           time.time() - self.ch.configs_cache_grace)
+
+    def test_missing(self):
+        self.assertRaises(Exception, self.ch.configs_dir)
+
+    def test_config_slice(self):
+        self.repo.put('test', '1-1', json.dumps({'foo': 'bar'}), {},
+                      artifact='test.config-prod-east.json')
+        self.assertEqual(self.ch.config_slice('1'), {'foo': 'bar'})
+        self.assertEqual(self.ch.config_slice('2'), None)
+
+    def test_config_slice_overridden(self):
+        self.repo.put('test', '1-1', json.dumps({'foo': 'bar'}), {},
+                      artifact='test.config-prod-east.json')
+        with open(self.tmppath('overrides', 'test-overrides.py'), 'w') as f:
+            f.write('')
+        self.assertEqual(self.ch.config_slice('1'), None)
@@ -0,0 +1,215 @@
+import json
+import os
+import socket
+import time
+
+from unittest.mock import patch
+
+from yodeploy.hooks.base import EVENTS_FILE
+from yodeploy.hooks.daemon import (DaemonApp, Supervisor, SystemD,
+                                   probe_command, probe_pidfile, probe_port)
+from yodeploy.supervisor import RUNNING
+from yodeploy.tests import TmpDirTestCase
+from yodeploy.tests.supervisord import FakeSupervisord
+
+
+class TestInstallDaemons(TmpDirTestCase):
+    def setUp(self):
+        super(TestInstallDaemons, self).setUp()
+        patcher = patch.dict(os.environ, {
+            'YODEPLOY_RELOAD_DIR': self.tmppath('reloads'),
+            'YODEPLOY_TEMPLATE_CACHE': self.tmppath('cache'),
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mkdir('versions', '1', 'deploy', 'templates', 'systemd')
+        self.add_template('worker')
+        self.mkdir('etc')
+        self.app = DaemonApp('test', None, self.tmpdir, '1', {}, None)
+        self.app.config = {}
+        self.manager = SystemD(self.app)
+        self.manager.target_path = self.tmppath('etc')
+
+        for method in ('reload', 'restart', 'enable'):
+            patcher = patch.object(self.manager, method)
+            setattr(self, method, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def add_template(self, name):
+        with open(self.tmppath('versions', '1', 'deploy', 'templates',
+                               'systemd', '%s.service.template' % name),
+                  'w') as f:
+            f.write('[Service]\n')
+
+    def test_new(self):
+        self.manager.install_daemons()
+        self.assertTMPPExists('etc', 'worker.service')
+        self.reload.assert_called_once_with()
+        self.restart.assert_called_once_with('worker')
+
+    def test_unchanged(self):
+        with open(self.tmppath('etc', 'worker.service'), 'w') as f:
+            f.write('[Service]')
+        os.chmod(self.tmppath('etc', 'worker.service'), 0o644)
+        self.manager.install_daemons()
+        self.assertFalse(self.reload.called)
+        self.restart.assert_called_once_with('worker')
+
+    def test_failed_reload_retried(self):
+        self.reload.return_value = False
+        self.manager.install_daemons()
+        self.reload.return_value = True
+        self.manager.install_daemons()
+        self.assertEqual(self.reload.call_count, 2)
+        self.manager.install_daemons()
+        self.assertEqual(self.reload.call_count, 2)
+
+    def test_unchanged_no_restart(self):
+        with open(self.tmppath('etc', 'worker.service'), 'w') as f:
+            f.write('[Service]')
+        self.app.restart_unchanged_daemons = False
+        self.manager.install_daemons()
+        self.assertFalse(self.restart.called)
+
+    def test_batched(self):
+        for name in ('celery', 'beat'):
+            self.add_template(name)
+        self.manager.install_daemons()
+        self.reload.assert_called_once_with()
+        self.enable.assert_called_once_with(['beat', 'celery', 'worker'])
+        self.assertEqual(sorted(call[0][0] for call in
+                                self.restart.call_args_list),
+                         ['beat', 'celery', 'worker'])
+
+        with open(self.tmppath('versions', '1', EVENTS_FILE)) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual(sorted(event['daemon'] for event in events),
+                         ['beat', 'celery', 'worker'])
+        self.assertEqual(events[0]['event'], 'daemon_restarted')
+
+    def setup_rolling(self):
+        for name in ('worker2', 'worker3'):
+            self.add_template(name)
+        self.app.rolling_restart = True
+        self.app.rolling_batch_size = 2
+
+    def test_rolling(self):
+        self.setup_rolling()
+        ready = []
+        patcher = patch.object(self.app, 'is_daemon_ready',
+                               side_effect=lambda name, since:
+                               ready.append(name) or True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.restart.side_effect = lambda name: ready.append('restart')
+
+        self.manager.install_daemons()
+        self.assertEqual(ready, ['restart', 'restart', 'worker', 'worker2',
+                                 'restart', 'worker3'])
+
+        with open(self.tmppath('versions', '1', EVENTS_FILE)) as f:
+            events = [json.loads(line) for line in f]
+        batches = [event for event in events
+                   if event['event'] == 'daemon_batch_restarted']
+        self.assertEqual([event['daemons'] for event in batches],
+                         [['worker', 'worker2'], ['worker3']])
+        self.assertEqual(batches[0]['batches'], 2)
+
+    def test_rolling_not_ready(self):
+        self.setup_rolling()
+        self.app.readiness_timeout = 0
+        self.app.readiness_probes = {'worker2': {'command': ['false']}}
+        self.assertRaises(Exception, self.manager.install_daemons)
+        self.assertEqual(sorted(call[0][0] for call in
+                                self.restart.call_args_list),
+                         ['worker', 'worker2'])
+
+    def test_not_rolling(self):
+        self.setup_rolling()
+        self.app.rolling_restart = False
+        self.app.readiness_probes = {'worker2': {'command': ['false']}}
+        self.manager.install_daemons()
+        self.assertEqual(self.restart.call_count, 3)
+
+
+class TestProbes(TmpDirTestCase):
+    def test_command(self):
+        self.assertTrue(probe_command(['true']))
+        self.assertFalse(probe_command(['false']))
+        self.assertFalse(probe_command([self.tmppath('missing')]))
+
+    def test_port(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        port = server.getsockname()[1]
+        self.assertFalse(probe_port(port, '127.0.0.1'))
+        server.listen(1)
+        try:
+            self.assertTrue(probe_port(port, '127.0.0.1'))
+        finally:
+            server.close()
+
+    def test_pidfile(self):
+        pidfile = self.tmppath('worker.pid')
+        since = time.time() - 10
+        self.assertFalse(probe_pidfile(pidfile, since))
+        with open(pidfile, 'w') as f:
+            f.write('%i\n' % os.getpid())
+        self.assertTrue(probe_pidfile(pidfile, since))
+        self.assertFalse(probe_pidfile(pidfile, since, min_age=60))
+        self.assertFalse(probe_pidfile(pidfile, time.time() + 10))
+
+    def test_pidfile_unreadable(self):
+        with patch('os.stat', side_effect=PermissionError):
+            self.assertFalse(probe_pidfile(self.tmppath('worker.pid'), 0))
+
+    def test_pidfile_dead(self):
+        pidfile = self.tmppath('worker.pid')
+        with open(pidfile, 'w') as f:
+            f.write('999999999\n')
+        self.assertFalse(probe_pidfile(pidfile, 0))
+
+
+class TestSupervisor(TmpDirTestCase):
+    def setUp(self):
+        super(TestSupervisor, self).setUp()
+        self.app = DaemonApp('test', None, self.tmpdir, '1', {}, None)
+        self.mkdir('versions', '1')
+        self.supervisord = FakeSupervisord(
+            self.tmppath('supervisor.sock'), groups=('web', 'worker'))
+        self.supervisord.start()
+        self.addCleanup(self.supervisord.stop)
+        self.manager = Supervisor(self.app)
+        self.manager.socket_path = self.tmppath('supervisor.sock')
+
+    def test_reload(self):
+        self.supervisord.config.add('celery')
+        self.assertTrue(self.manager.reload())
+        self.assertEqual(self.supervisord.states['celery'], RUNNING)
+
+    def test_restart_all(self):
+        self.manager.restart_all(['web', 'worker'])
+        self.assertEqual(
+            [call for call in self.supervisord.calls
+             if call[0] == 'startProcessGroup'],
+            [('startProcessGroup', 'web'), ('startProcessGroup', 'worker')])
+        with open(self.tmppath('versions', '1', EVENTS_FILE)) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual([event['daemon'] for event in events],
+                         ['web', 'worker'])
+
+    @patch('yodeploy.hooks.daemon.subprocess')
+    def test_fallback(self, subprocess):
+        self.manager.socket_path = self.tmppath('missing.sock')
+        self.manager.restart_all(['web'])
+        subprocess.check_call.assert_called_once_with(
+            ('supervisorctl', 'start', 'web'))
+        self.assertEqual(self.supervisord.calls, [])
+
+    @patch('yodeploy.hooks.daemon.subprocess')
+    def test_fallback_on_error(self, subprocess):
+        self.supervisord.stop()
+        with open(self.tmppath('supervisor.sock'), 'w'):
+            pass
+        self.manager.reload()
+        subprocess.check_call.assert_any_call(('supervisorctl', 'update'))
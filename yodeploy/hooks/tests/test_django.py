@@ -1,9 +1,16 @@
+import json
+import os
+import sys
+import threading
 import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
 from unittest.mock import PropertyMock, call, patch
 from packaging.version import parse as parse_version
 
+from yodeploy.hooks.base import EVENTS_FILE
 from yodeploy.hooks.django import ApacheHostedDjangoApp, DjangoApp
+from yodeploy.tests import TmpDirTestCase
 
 
 class TestApacheHostedDjangoHook(unittest.TestCase):
@@ -54,3 +61,311 @@ class TestDjangoMigrateCommand(unittest.TestCase):
         self.mock_django_version.return_value = parse_version('1.10')
         self.dh.run_migrate_commands()
         self.mock_manage_py.assert_called_once_with('migrate', '--noinput')
+
+
+class WarmupHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200 if self.path == '/ok' else 500)
+        self.end_headers()
+        self.wfile.write(b'Hello')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDjangoWarmup(TmpDirTestCase):
+    def setUp(self):
+        super(TestDjangoWarmup, self).setUp()
+        self.mkdir('versions', '123')
+        self.dh = DjangoApp('test', None, self.tmpdir, '123', {}, None)
+
+        self.server = HTTPServer(('127.0.0.1', 0), WarmupHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.dh.warmup_base_url = 'http://127.0.0.1:%i/' % (
+            self.server.server_address[1])
+
+    def events(self):
+        with open(self.tmppath('versions', '123', EVENTS_FILE)) as f:
+            return [json.loads(line) for line in f]
+
+    def test_warmup_requests(self):
+        self.dh.warmup_urls = ['/ok']
+        self.dh.warmup_requests = 3
+        self.dh.warmup_deployed()
+        event, = self.events()
+        self.assertEqual(event['event'], 'warmup')
+        self.assertTrue(event['success'])
+        self.assertEqual(event['requests'], 3)
+        self.assertEqual(event['failures'], 0)
+
+    def test_warmup_request_failures(self):
+        self.dh.warmup_urls = ['/ok', '/error']
+        self.dh.warmup_deployed()
+        event, = self.events()
+        self.assertFalse(event['success'])
+        self.assertEqual(event['requests'], 8)
+        self.assertEqual(event['failures'], 4)
+
+    def test_warmup_budget(self):
+        self.dh.warmup_urls = ['/ok']
+        self.dh.warmup_budget = 0
+        self.dh.warmup_deployed()
+        event, = self.events()
+        self.assertFalse(event['success'])
+        self.assertEqual(event['requests'], 0)
+
+    def test_warmup_prepare(self):
+        with patch.object(DjangoApp, 'manage_py_cmd',
+                          return_value=[sys.executable, '-c', 'pass']):
+            self.dh.warmup_imports = ['os']
+            self.dh.warmup_prepare()
+        event, = self.events()
+        self.assertEqual(event['event'], 'warmup_prepare')
+        self.assertTrue(event['success'])
+
+    def test_warmup_prepare_failure(self):
+        with patch.object(DjangoApp, 'manage_py_cmd',
+                          return_value=[sys.executable, '-c', 'import foo']):
+            self.dh.warmup_prepare()
+        event, = self.events()
+        self.assertFalse(event['success'])
+
+
+FAKE_DJANGO = {
+    'django/__init__.py': (
+        'def get_version():\n'
+        '    return "1.11"\n'
+        'def setup():\n'
+        '    import os\n'
+        '    print("setup %s" % os.environ["DJANGO_SETTINGS_MODULE"])\n'),
+    'django/core/__init__.py': '',
+    'django/core/management/__init__.py': (
+        'def execute_from_command_line(argv=None):\n'
+        '    raise Exception("Not batched")\n'
+        'def call_command(name, *args, **options):\n'
+        '    if name == "fail":\n'
+        '        raise Exception("Failed")\n'
+        '    options["stdout"].write("%s %s" % (name, " ".join(args)))\n'),
+    'manage.py': (
+        'import os\n'
+        'os.environ.setdefault("DJANGO_SETTINGS_MODULE", "test.settings")\n'
+        'from django.core.management import execute_from_command_line\n'
+        'execute_from_command_line()\n'),
+}
+
+
+class TestDjangoManagePyBatch(TmpDirTestCase):
+    def setUp(self):
+        super(TestDjangoManagePyBatch, self).setUp()
+        for path, contents in FAKE_DJANGO.items():
+            path = self.tmppath('versions', '123', 'test', path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(contents)
+        self.mkdir('versions', '123', 'virtualenv', 'bin')
+        os.symlink(sys.executable,
+                   self.tmppath('versions', '123', 'virtualenv', 'bin',
+                                'python'))
+        self.dh = DjangoApp('test', None, self.tmpdir, '123', {}, None)
+        self.dh._django_version = parse_version('1.11')
+
+    def test_batch(self):
+        output = self.dh.manage_py_batch([['migrate', '--noinput'],
+                                          ['compilemessages']])
+        self.assertEqual(output, ['migrate --noinput', 'compilemessages '])
+
+    def test_failure(self):
+        with patch.object(DjangoApp, 'manage_py') as manage_py:
+            self.assertRaises(SystemExit, self.dh.manage_py_batch,
+                              [['fail'], ['compilemessages']])
+            manage_py.assert_not_called()
+
+    def test_old_django(self):
+        self.dh._django_version = parse_version('1.5')
+        with patch.object(DjangoApp, 'manage_py') as manage_py:
+            self.dh.manage_py_batch([['syncdb', '--noinput'], ['migrate']])
+        manage_py.assert_has_calls(
+            [call('syncdb', '--noinput'), call('migrate')])
+
+    def test_django_version_cached(self):
+        del self.dh._django_version
+        with patch('subprocess.check_output',
+                   return_value=b'1.11\n') as check_output:
+            self.assertEqual(self.dh.django_version, parse_version('1.11'))
+            self.assertEqual(self.dh.django_version, parse_version('1.11'))
+        self.assertEqual(check_output.call_count, 1)
+
+
+class TestDjangoPrepare(TmpDirTestCase):
+    def hook(self, cls):
+        dh = cls('test', None, self.tmpdir, '123', {}, None)
+        dh.config = {'test': {}}
+        dh.migrate_on_deploy = True
+        dh.has_static = True
+        dh.compress = True
+        return dh
+
+    @patch.object(DjangoApp, 'manage_py')
+    @patch.object(DjangoApp, 'manage_py_batch')
+    def test_batched(self, manage_py_batch, manage_py):
+        self.hook(DjangoApp).django_prepare()
+        manage_py_batch.assert_called_once_with(
+            [['collectstatic', '--noinput'], ['compress', '--force']])
+        manage_py.assert_not_called()
+
+    @patch.object(DjangoApp, 'manage_py')
+    @patch.object(DjangoApp, 'manage_py_batch')
+    def test_overridden(self, manage_py_batch, manage_py):
+        calls = []
+
+        class App(DjangoApp):
+            def migrate(self):
+                calls.append('migrate')
+
+            def call_compress(self):
+                calls.append('compress')
+
+        self.hook(App).django_prepare()
+        manage_py_batch.assert_not_called()
+        manage_py.assert_called_once_with('collectstatic', '--noinput')
+        self.assertEqual(calls, ['migrate', 'compress'])
+
+
+class TestIncrementalStatic(TmpDirTestCase):
+    def setUp(self):
+        super(TestIncrementalStatic, self).setUp()
+        for version in ('1', '2'):
+            self.write('versions', version, 'test', 'assets', 'same.css',
+                       contents='same')
+            self.write('versions', version, 'test', 'assets', 'changed.css',
+                       contents='version %s' % version)
+            self.write('versions', version, 'test', 'templates', 'base.html')
+        self.write('versions', '1', 'test', 'assets', 'removed.css')
+        for name in ('same.css', 'removed.css', 'admin.css'):
+            self.write('versions', '1', 'static', name)
+        os.symlink(os.path.join('versions', '1'), self.tmppath('live'))
+
+        self.live = self.hook('1')
+        self.live_manifest = self.live.seed_static()
+        with open(self.tmppath('versions', '1', '.static-sources.json'),
+                  'w') as f:
+            json.dump(self.live_manifest, f)
+        self.dh = self.hook('2')
+
+    def write(self, *path, **kwargs):
+        if not os.path.isdir(self.tmppath(*path[:-1])):
+            self.mkdir(*path[:-1])
+        with open(self.tmppath(*path), 'w') as f:
+            f.write(kwargs.get('contents', 'data'))
+
+    def hook(self, version):
+        dh = DjangoApp('test', None, self.tmpdir, version, {}, None)
+        dh.incremental_static = True
+        dh.static_dir = 'static'
+        dh.static_source_dirs = ['test/assets']
+        return dh
+
+    def test_sources(self):
+        self.assertEqual(
+            sorted(self.live_manifest['sources']),
+            ['test/assets/changed.css', 'test/assets/removed.css',
+             'test/assets/same.css'])
+
+    def test_find_static_source_dirs(self):
+        self.write('versions', '2', 'test', 'static', 'app.css')
+        self.write('versions', '2', 'virtualenv', 'django', 'static', 'a.css')
+        self.dh.static_source_dirs = None
+        self.assertEqual(self.dh.find_static_source_dirs(), ['test/static'])
+
+    def test_seed(self):
+        manifest = self.dh.seed_static()
+        self.assertEqual(manifest['sources']['test/assets/same.css'],
+                         self.live_manifest['sources']['test/assets/same.css'])
+        self.assertEqual(
+            os.stat(self.tmppath('versions', '1', 'static', 'same.css')),
+            os.stat(self.tmppath('versions', '2', 'static', 'same.css')))
+        self.assertEqual(os.stat(self.tmppath(
+            'versions', '2', 'test', 'assets', 'same.css')).st_mtime, 0)
+        self.assertNotEqual(os.stat(self.tmppath(
+            'versions', '2', 'test', 'assets', 'changed.css')).st_mtime, 0)
+        # Only static sources
+        self.assertNotEqual(os.stat(self.tmppath(
+            'versions', '2', 'test', 'templates', 'base.html')).st_mtime, 0)
+
+    def test_seed_prunes_removed_sources(self):
+        self.dh.seed_static()
+        self.assertNotTMPPExists('versions', '2', 'static', 'removed.css')
+        # Not from our sources (e.g. an installed app's)
+        self.assertTMPPExists('versions', '2', 'static', 'admin.css')
+        self.assertTMPPExists('versions', '1', 'static', 'removed.css')
+
+    def test_no_static_dir(self):
+        self.dh.static_dir = None
+        self.assertEqual(self.dh.seed_static(), None)
+        self.assertNotEqual(os.stat(self.tmppath(
+            'versions', '2', 'test', 'assets', 'same.css')).st_mtime, 0)
+
+    def test_no_live_manifest(self):
+        os.unlink(self.tmppath('versions', '1', '.static-sources.json'))
+        self.dh.seed_static()
+        self.assertNotTMPPExists('versions', '2', 'static')
+
+    def test_redeploy_live(self):
+        self.assertEqual(self.hook('1').live_path('static'), None)
+
+
+class TestSkipMigrations(TmpDirTestCase):
+    def setUp(self):
+        super(TestSkipMigrations, self).setUp()
+        django_version_patcher = patch.object(
+            DjangoApp, 'django_version', new_callable=PropertyMock,
+            return_value=parse_version('1.11'))
+        django_version_patcher.start()
+        self.addCleanup(django_version_patcher.stop)
+
+        for version in ('1', '2'):
+            self.write_migration(version, '0001_initial.py', 'initial')
+        os.symlink(os.path.join('versions', '1'), self.tmppath('live'))
+        self.hook('1').record_migrations()
+        self.dh = self.hook('2')
+
+    def write_migration(self, version, name, contents):
+        path = self.tmppath('versions', version, 'test', 'migrations')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, name), 'w') as f:
+            f.write(contents)
+
+    def hook(self, version):
+        dh = DjangoApp('test', None, self.tmpdir, version, {}, None)
+        dh.config = {'test': {'db': {'engine': 'postgresql'}}}
+        return dh
+
+    def test_unchanged(self):
+        self.assertEqual(self.dh.migrate_batch(), [])
+
+    def test_new_migration(self):
+        self.write_migration('2', '0002_more.py', 'more')
+        self.assertEqual(self.dh.migrate_batch(), [['migrate', '--noinput']])
+
+    def test_db_config_changed(self):
+        self.dh.config['test']['db']['name'] = 'other'
+        self.assertEqual(self.dh.migrate_batch(), [['migrate', '--noinput']])
+
+    def test_unmigrated_live(self):
+        os.unlink(self.tmppath('versions', '1', '.migrations-fingerprint'))
+        self.assertEqual(self.dh.migrate_batch(), [['migrate', '--noinput']])
+
+    def test_always_migrate(self):
+        self.dh.always_migrate = True
+        self.assertEqual(self.dh.migrate_batch(), [['migrate', '--noinput']])
+
+    def test_forced_by_environment(self):
+        with patch.dict(os.environ, {'YODEPLOY_FORCE_MIGRATE': '1'}):
+            self.assertEqual(self.dh.migrate_batch(),
+                             [['migrate', '--noinput']])
@@ -1,8 +1,12 @@
+import os
+import subprocess
 from unittest import TestCase
 
 from unittest.mock import patch
 
 from yodeploy.hooks.nginx import NginxHostedApp
+from yodeploy.reloads import config_changed
+from yodeploy.tests import TmpDirTestCase
 
 
 class TestNginxHostedAppPrepareHook(TestCase):
@@ -30,13 +34,48 @@ class TestNginxHostedAppPrepareHook(TestCase):
         )
 
 
-class TestNginxHostedAppDeployedHook(TestCase):
+class TestNginxHostedAppDeployedHook(TmpDirTestCase):
     def setUp(self):
+        super(TestNginxHostedAppDeployedHook, self).setUp()
+        patcher = patch.dict(os.environ, {
+            'YODEPLOY_RELOAD_DIR': self.tmppath('reloads'),
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
         self.dh = NginxHostedApp('test', None, '/tmp/test', '123', {}, None)
+        self.dh.reload_window = 0
 
+    @patch('yodeploy.hooks.nginx.NginxHostedApp.configurator_prepare')
     @patch('yodeploy.hooks.nginx.NginxHostedApp.configurator_deployed')
+    @patch('yodeploy.hooks.nginx.NginxHostedApp.template')
+    @patch('yodeploy.hooks.nginx.NginxHostedApp.templates_changed',
+           return_value=True)
     @patch('yodeploy.hooks.nginx.subprocess.check_call')
-    def test_restarts_nginx(self, check_call_mock, *args):
+    def test_restarts_nginx(self, check_call_mock, templates_changed_mock,
+                            *args):
+        self.dh.prepare()
         self.dh.deployed()
 
+        templates_changed_mock.assert_called_once_with(
+            '/etc/nginx/sites-enabled')
         check_call_mock.assert_called_once_with(('service', 'nginx', 'reload'))
+
+    @patch('yodeploy.hooks.nginx.NginxHostedApp.configurator_deployed')
+    @patch('yodeploy.hooks.nginx.subprocess.check_call')
+    def test_unchanged(self, check_call_mock, *args):
+        self.dh.deployed()
+
+        self.assertFalse(check_call_mock.called)
+
+    @patch('yodeploy.hooks.nginx.NginxHostedApp.configurator_deployed')
+    @patch('yodeploy.hooks.nginx.subprocess.check_call')
+    def test_failed_reload_retried(self, check_call_mock, *args):
+        config_changed('nginx')
+        check_call_mock.side_effect = subprocess.CalledProcessError(1, 'x')
+        self.assertRaises(SystemExit, self.dh.deployed)
+
+        check_call_mock.side_effect = None
+        self.dh.deployed()
+        self.assertEqual(check_call_mock.call_count, 2)
+        self.dh.deployed()
+        self.assertEqual(check_call_mock.call_count, 2)
@@ -1,2 +1,41 @@
+import os
+import struct
+import sys
+
 from yodeploy.hooks.python import PythonApp
-hush_pyflakes = PythonApp
+from yodeploy.tests import TmpDirTestCase
+
+
+class TestCompileBytecode(TmpDirTestCase):
+    def setUp(self):
+        super(TestCompileBytecode, self).setUp()
+        self.mkdir('app', 'pkg')
+        for path in (('app', 'foo.py'), ('app', 'pkg', '__init__.py')):
+            with open(self.tmppath(*path), 'w') as f:
+                f.write('x = 1\n')
+        self.hook = PythonApp('test', None, self.tmppath('root'), '123', {},
+                              None)
+
+    def pyc(self, *fragments):
+        directory = os.path.join(self.tmppath(*fragments[:-1]), '__pycache__')
+        name = fragments[-1].replace('.py', '.%s.pyc'
+                                     % sys.implementation.cache_tag)
+        return os.path.join(directory, name)
+
+    def flags(self, pyc):
+        with open(pyc, 'rb') as f:
+            return struct.unpack('<4sL', f.read(8))[1]
+
+    def test_compiles_tree(self):
+        self.hook.compile_bytecode(self.tmppath('app'), sys.executable)
+        self.assertTrue(os.path.exists(self.pyc('app', 'foo.py')))
+        self.assertTrue(os.path.exists(self.pyc('app', 'pkg', '__init__.py')))
+
+    def test_checked_hash(self):
+        self.hook.compile_bytecode(self.tmppath('app'), sys.executable)
+        self.assertEqual(self.flags(self.pyc('app', 'foo.py')), 3)
+
+    def test_unchecked_hash(self):
+        self.hook.bytecode_invalidation_mode = 'unchecked-hash'
+        self.hook.compile_bytecode(self.tmppath('app'), sys.executable)
+        self.assertEqual(self.flags(self.pyc('app', 'foo.py')), 1)
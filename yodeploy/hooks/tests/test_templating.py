@@ -1,2 +1,92 @@
-from yodeploy.hooks.templating import TemplatedApp
-hush_pyflakes = TemplatedApp
+import os
+
+from unittest.mock import patch
+
+from yodeploy.hooks.templating import ContentBytecodeCache, TemplatedApp
+from yodeploy.tests import TmpDirTestCase
+
+
+class TestTemplatedApp(TmpDirTestCase):
+    def setUp(self):
+        super(TestTemplatedApp, self).setUp()
+        patcher = patch.dict(os.environ, {
+            'YODEPLOY_TEMPLATE_CACHE': self.tmppath('cache'),
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.th = self.hook('1')
+
+    def hook(self, version):
+        for name in ('vhost.conf', 'sites/one.conf', 'sites/two.conf'):
+            path = self.tmppath('versions', version, 'deploy', 'templates',
+                                name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write('%s: {{ aconf.name }} {{ cconf.domain }}\n' % name)
+        th = TemplatedApp('test', None, self.tmpdir, version, {}, None)
+        th.config = {'test': {'name': 'Test'}, 'common': {'domain': 'x.com'}}
+        return th
+
+    def test_template(self):
+        self.th.template('vhost.conf', self.tmppath('vhost.conf'))
+        self.assertTMPPContents('vhost.conf: Test x.com', 'vhost.conf')
+
+    def test_bytecode_cache_shared_between_versions(self):
+        self.th.template('vhost.conf', self.tmppath('vhost.conf'))
+        cached = os.listdir(self.tmppath('cache'))
+        self.assertEqual(len(cached), 1)
+        self.hook('2').template('vhost.conf', self.tmppath('vhost.conf'))
+        self.assertEqual(os.listdir(self.tmppath('cache')), cached)
+
+    def test_bytecode_cache_pruned(self):
+        self.th.template('vhost.conf', self.tmppath('vhost.conf'))
+        self.th.template('sites/one.conf', self.tmppath('one.conf'))
+        for i, fn in enumerate(sorted(os.listdir(self.tmppath('cache')))):
+            os.utime(self.tmppath('cache', fn), (i, i))
+        # Used again, so more recent
+        self.hook('2').template('vhost.conf', self.tmppath('vhost.conf'))
+        used = [fn for fn in os.listdir(self.tmppath('cache'))
+                if os.stat(self.tmppath('cache', fn)).st_mtime > 1]
+        self.assertEqual(len(used), 1)
+        ContentBytecodeCache(self.tmppath('cache')).prune(1)
+        self.assertEqual(os.listdir(self.tmppath('cache')), used)
+
+    def test_template_all(self):
+        self.th.template_all('sites', self.tmppath('sites'), min_count=2)
+        self.assertTMPPContents('sites/one.conf: Test x.com',
+                                'sites', 'one.conf')
+        self.assertTMPPContents('sites/two.conf: Test x.com',
+                                'sites', 'two.conf')
+
+    def test_template_all_min_count(self):
+        self.assertRaises(Exception, self.th.template_all, 'sites',
+                          self.tmppath('sites'), min_count=3)
+        self.assertRaises(Exception, self.th.template_all, 'missing',
+                          self.tmppath('missing'), min_count=1)
+
+    def test_unchanged(self):
+        self.assertTrue(self.th.template('vhost.conf',
+                                         self.tmppath('vhost.conf')))
+        os.chmod(self.tmppath('vhost.conf'), 0o600)
+        inode = os.stat(self.tmppath('vhost.conf')).st_ino
+        self.assertFalse(self.th.template('vhost.conf',
+                                          self.tmppath('vhost.conf')))
+        self.assertEqual(os.stat(self.tmppath('vhost.conf')).st_ino, inode)
+        self.assertEqual(os.stat(self.tmppath('vhost.conf')).st_mode & 0o777,
+                         0o644)
+
+    def test_templates_changed(self):
+        self.mkdir('sites')
+        with open(self.tmppath('sites', 'one.conf'), 'w') as f:
+            f.write('sites/one.conf: Test x.com')
+        self.assertEqual(
+            self.th.template_all('sites', self.tmppath('sites')),
+            set([self.tmppath('sites', 'two.conf')]))
+        self.assertTrue(self.th.templates_changed(self.tmppath('sites')))
+        self.assertFalse(self.th.templates_changed(self.tmppath('site')))
+
+        v2 = self.hook('2')
+        self.assertEqual(v2.template_all('sites', self.tmppath('sites')),
+                         set())
+        self.assertFalse(v2.templates_changed(self.tmppath('sites')))
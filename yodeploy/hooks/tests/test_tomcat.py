@@ -0,0 +1,52 @@
+import os
+
+from unittest.mock import patch
+
+from yodeploy.hooks.tomcat import TomcatServlet
+from yodeploy.tests import TmpDirTestCase
+
+
+class TestTomcatApacheReload(TmpDirTestCase):
+    def setUp(self):
+        super(TestTomcatApacheReload, self).setUp()
+        patcher = patch.dict(os.environ, {
+            'YODEPLOY_RELOAD_DIR': self.tmppath('reloads'),
+            'YODEPLOY_TEMPLATE_CACHE': self.tmppath('cache'),
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(TomcatServlet, '_reload_apache')
+        self.reload = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mkdir('sites-enabled')
+
+    def deploy(self, version, vhost='<VirtualHost *:80>\n'):
+        self.mkdir('versions', version, 'deploy', 'templates', 'apache2')
+        with open(self.tmppath('versions', version, 'deploy', 'templates',
+                               'apache2', 'vhost.conf.template'), 'w') as f:
+            f.write(vhost)
+        app = TomcatServlet('test', None, self.tmpdir, version, {}, None)
+        app.config = {}
+        app.vhost_path = self.tmppath('sites-enabled')
+        app.reload_window = 0
+        app.prepare_tomcat()
+        app.apache_deployed()
+
+    def test_unchanged(self):
+        self.deploy('1')
+        self.deploy('2')
+        self.assertEqual(self.reload.call_count, 1)
+
+    def test_changed(self):
+        self.deploy('1')
+        self.deploy('2', vhost='<VirtualHost *:443>\n')
+        self.assertEqual(self.reload.call_count, 2)
+
+    def test_failed_reload_retried(self):
+        self.reload.side_effect = SystemExit(1)
+        self.assertRaises(SystemExit, self.deploy, '1')
+        self.reload.side_effect = None
+        self.deploy('2')
+        self.assertEqual(self.reload.call_count, 2)
+        self.deploy('3')
+        self.assertEqual(self.reload.call_count, 2)
@@ -8,6 +8,7 @@ import time
 import distro
 
 from yodeploy.hooks.configurator import ConfiguratedApp
+from yodeploy.reloads import coalesced_reload, config_changed, reload_pending
 
 
 log = logging.getLogger(__name__)
@@ -18,6 +19,8 @@ class TomcatServlet(ConfiguratedApp):
     vhost_path = '/etc/apache2/sites-enabled'
     parallel_deploy_timeout = 60
     database_migration_class = 'com.yola.yodeploy.flywaydb.Migrator'
+    # Seconds to wait for concurrent deploys to join our Apache reload
+    reload_window = 1
 
     def prepare(self):
         super(TomcatServlet, self).prepare()
@@ -34,6 +37,10 @@ class TomcatServlet(ConfiguratedApp):
         old_vhost = os.path.join(self.vhost_path, self.app)
         if os.path.exists(old_vhost):
             os.unlink(old_vhost)
+            self.record_change(old_vhost)
+
+        if self.templates_changed(self.vhost_path):
+            config_changed('apache2')
 
     @property
     def has_apache_vhost(self):
@@ -51,13 +58,16 @@ class TomcatServlet(ConfiguratedApp):
         super(TomcatServlet, self).deployed()
         self.tomcat_deploy()
 
+    def apache_deployed(self):
+        # Our vhost changed, or an earlier deploy's reload failed
+        if reload_pending('apache2'):
+            coalesced_reload('apache2', self._reload_apache,
+                             window=self.reload_window)
+        else:
+            log.info('Apache configuration is unchanged, not reloading')
+
     def tomcat_deploy(self):
-        if self.has_apache_vhost:
-            try:
-                subprocess.check_call(('service', 'apache2', 'reload'))
-            except subprocess.CalledProcessError:
-                log.exception('Unable to reload apache2')
-                sys.exit(1)
+        self.apache_deployed()
 
         contexts = os.path.join(self.root, 'tomcat-contexts')
         if not os.path.isdir(contexts):
@@ -136,6 +146,13 @@ class TomcatServlet(ConfiguratedApp):
             raise Exception("Deploy must have failed - "
                             "tomcat didn't undeploy any old verisons")
 
+    def _reload_apache(self):
+        try:
+            subprocess.check_call(('service', 'apache2', 'reload'))
+        except subprocess.CalledProcessError:
+            log.exception('Unable to reload apache2')
+            sys.exit(1)
+
     def _deployed_versions(self):
         contexts = os.path.join(self.root, 'tomcat-contexts')
         return [name.split('##', 1)[1] for name in os.listdir(contexts)
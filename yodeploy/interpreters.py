@@ -0,0 +1,132 @@
+"""A registry of the Python interpreters on this machine.
+
+Asking an interpreter for its version means spawning it. The answers are
+cached on disk, keyed by the interpreter binary's path, inode and mtime, so
+they stay valid until the interpreter is replaced or upgraded. Wrapper
+scripts, such as pyenv shims, choose an interpreter at runtime, so they are
+introspected every time.
+"""
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+
+log = logging.getLogger(__name__)
+
+CACHE_FILE = os.path.join('~', '.cache', 'yodeploy', 'interpreters.json')
+
+# Compatible with every Python we could find, including 2.7
+_INTROSPECT = '; '.join((
+    'import json, platform, sys, sysconfig',
+    'print(json.dumps({'
+    '"version": ".".join(map(str, sys.version_info[:2])), '
+    '"full_version": platform.python_version(), '
+    '"implementation": platform.python_implementation(), '
+    '"abi": sysconfig.get_config_var("SOABI") or "", '
+    '"abiflags": getattr(sys, "abiflags", "")}))',
+))
+
+_NAME_RE = re.compile(r'^python(\d(\.\d+)?)?$')
+
+
+def cache_file():
+    return os.environ.get('YODEPLOY_INTERPRETER_CACHE',
+                          os.path.expanduser(CACHE_FILE))
+
+
+def _load_cache():
+    try:
+        with open(cache_file()) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_cache(cache):
+    fn = cache_file()
+    try:
+        if not os.path.isdir(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        with open(fn + '.%i' % os.getpid(), 'w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.rename(fn + '.%i' % os.getpid(), fn)
+    except (IOError, OSError) as e:
+        log.debug('Unable to write interpreter cache %s: %s', fn, e)
+
+
+def _is_script(path):
+    """Is path a #! script (e.g. a pyenv shim), rather than a binary?"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(2) == b'#!'
+    except IOError:
+        return False
+
+
+def _introspect(path):
+    return json.loads(subprocess.check_output(
+        [path, '-c', _INTROSPECT]).decode())
+
+
+def interpreter_info(path):
+    """Describe the interpreter at path.
+
+    Returns a dict with the path, version ('X.Y'), full_version,
+    implementation, abi (SOABI) and abiflags.
+    """
+    real_path = os.path.realpath(path)
+    if _is_script(real_path):
+        log.debug('Introspecting interpreter wrapper %s', path)
+        info = _introspect(real_path)
+    else:
+        st = os.stat(real_path)
+        key = '%s:%i:%i' % (real_path, st.st_ino, st.st_mtime_ns)
+        cache = _load_cache()
+        if key not in cache:
+            log.debug('Introspecting interpreter %s', path)
+            # Drop stale entries for replaced binaries
+            cache = dict((k, v) for k, v in cache.items()
+                         if not k.startswith(real_path + ':'))
+            cache[key] = _introspect(real_path)
+            _save_cache(cache)
+        info = dict(cache[key])
+
+    info['path'] = path
+    info['real_path'] = real_path
+    return info
+
+
+def find(name):
+    """Return the interpreter_info for name in $PATH, or None"""
+    path = shutil.which(name)
+    if not path:
+        return None
+    return interpreter_info(path)
+
+
+def discover():
+    """Return interpreter_info for every pythonX[.Y] in $PATH.
+
+    Interpreters are listed in $PATH order. Names that resolve to the same
+    binary are all listed.
+    """
+    found = []
+    seen = set()
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            if not _NAME_RE.match(name) or name in seen:
+                continue
+            path = os.path.join(directory, name)
+            if not os.access(path, os.X_OK):
+                continue
+            seen.add(name)
+            try:
+                found.append(interpreter_info(path))
+            except (OSError, subprocess.CalledProcessError, ValueError) as e:
+                log.warning('Unable to introspect %s', path)
+                log.debug('%s', e)
+    return found
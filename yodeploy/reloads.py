@@ -0,0 +1,139 @@
+"""Coalesce reloads of a service requested by concurrent deploys.
+
+Each request for a reload is numbered. One requester at a time (the holder of
+the service's reload lock) waits a short window for more requests to arrive,
+reloads the service, and records the newest request number that reload
+covered. Everyone else waits until a reload covering their request is done.
+If the reload fails, the holder raises, and the next waiting requester takes
+the lock and tries again.
+
+Configuration changes can be recorded with config_changed. reload_pending
+stays true until a reload that started after the change has succeeded, so a
+deploy that wrote the configuration but failed to reload it isn't forgotten
+by later deploys that find the configuration unchanged. Services that aren't
+reloaded with coalesced_reload record their successful reloads with
+config_applied.
+"""
+import json
+import logging
+import os
+import time
+
+from yodeploy.locking import LockFile, SpinLockFile
+
+log = logging.getLogger(__name__)
+
+STATE_DIR = '/run/yodeploy/reloads'
+
+
+def state_dir():
+    return os.environ.get('YODEPLOY_RELOAD_DIR', STATE_DIR)
+
+
+class _State(object):
+    """The request and reload counters for a service, on disk"""
+
+    def __init__(self, service):
+        directory = state_dir()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, '%s.json' % service)
+        self.lock = SpinLockFile(self.path + '.lock', timeout=30)
+        self.reload_lock = LockFile(
+            os.path.join(directory, '%s.reload.lock' % service))
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'requested': 0, 'reloaded': 0}
+
+    def write(self, state):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(self.path + '.tmp', self.path)
+
+    def request(self):
+        with self.lock:
+            state = self.read()
+            state['requested'] += 1
+            self.write(state)
+        return state['requested']
+
+    def requested(self):
+        with self.lock:
+            return self.read()['requested']
+
+    def reloaded(self, request, started):
+        with self.lock:
+            state = self.read()
+            state['reloaded'] = max(state['reloaded'], request)
+            state['applied'] = max(state.get('applied', 0), started)
+            self.write(state)
+
+    def applied(self, started):
+        with self.lock:
+            state = self.read()
+            state['applied'] = max(state.get('applied', 0), started)
+            self.write(state)
+
+    def changed(self):
+        with self.lock:
+            state = self.read()
+            state['changed'] = time.time()
+            self.write(state)
+
+
+def config_changed(service):
+    """Record that service's configuration has changed, and needs a reload"""
+    _State(service).changed()
+
+
+def config_applied(service, started):
+    """Record that a reload of service, started at started, succeeded"""
+    _State(service).applied(started)
+
+
+def reload_pending(service):
+    """Has service's configuration changed since its last good reload?"""
+    state = _State(service).read()
+    return state.get('changed', 0) > state.get('applied', 0)
+
+
+def coalesced_reload(service, reload, window=1, timeout=300):
+    """Call reload(), unless a concurrent deploy's reload covers us.
+
+    Blocks until a reload that started after this call has completed.
+    """
+    state = _State(service)
+    request = state.request()
+    start = time.time()
+    logged = False
+    while True:
+        if state.read()['reloaded'] >= request:
+            log.info('%s was reloaded by a concurrent deploy', service)
+            return
+        if state.reload_lock.try_acquire():
+            break
+        if time.time() - start > timeout:
+            raise Exception('Timed out waiting for a %s reload' % service)
+        if not logged:
+            log.info('Waiting for a concurrent %s reload', service)
+            logged = True
+        time.sleep(0.1)
+
+    try:
+        # Someone may have finished a reload, while we took the lock
+        if state.read()['reloaded'] >= request:
+            return
+        # Give other deploys a moment to join this reload
+        time.sleep(window)
+        covered = state.requested()
+        log.info('Reloading %s, for %i deploy(s)', service,
+                 covered - state.read()['reloaded'])
+        started = time.time()
+        reload()
+        state.reloaded(covered, started)
+    finally:
+        state.reload_lock.release()
@@ -14,6 +14,13 @@ from yodeploy.util import ignoring
 log = logging.getLogger(__name__)
 STORES = {}
 
+# Metadata keys that Repository.find can search on
+INDEXED_METADATA = ('commit', 'vcs_tag', 'build_number', 'deploy_compat')
+# Names within an artifact's directory that aren't versions
+RESERVED_VERSIONS = ('latest', 'index')
+# Artifacts mapping build keys (not versions) to versions of app.tar.gz
+BUILD_INDEX_SUFFIX = '.build-index'
+
 try:
     string_types = (basestring,)  # python 2
 except NameError:
@@ -315,16 +322,46 @@ class Repository(object):
         path = os.path.join(artifact_path, version)
         return self.store.get_metadata(path)
 
+    def _load_index(self, artifact_path):
+        """Return the metadata index for artifact_path, or None"""
+        try:
+            with self.store.get(os.path.join(artifact_path, 'index')) as f:
+                return json.loads(f.read().decode('utf-8'))
+        except KeyError:
+            return None
+
+    def _store_index(self, artifact_path, index):
+        self.store.put(os.path.join(artifact_path, 'index'),
+                       json.dumps(index, sort_keys=True))
+
     def put(self, app, version, fp, metadata, target='master',
             artifact=None):
-        """Store an object (fp) in the repository."""
+        """Store an object (fp) in the repository.
+
+        If metadata contains any INDEXED_METADATA, the version is added to the
+        artifact's index, for find(). The first indexed put of an artifact
+        builds the index from every stored version.
+
+        Updating the index is an unlocked read-modify-write, so concurrent
+        puts of the same artifact can lose each other's entries. find()
+        copes, by examining the metadata of versions missing from the index.
+        """
         if not artifact:
             artifact = '%s.tar.gz' % app
-        if version == 'latest' or version.endswith('.meta'):
+        if version in RESERVED_VERSIONS or version.endswith('.meta'):
             raise ValueError('Illegal version: %s' % version)
         artifact_path = os.path.join(app, target, artifact)
         path = os.path.join(artifact_path, version)
         self.store.put(path, fp, metadata)
+        entry = dict((key, str(metadata[key])) for key in INDEXED_METADATA
+                     if metadata and metadata.get(key) is not None)
+        if entry:
+            index = self._load_index(artifact_path)
+            if index is None:
+                self.reindex(app, target, artifact)
+            else:
+                index[version] = entry
+                self._store_index(artifact_path, index)
         latest_path = os.path.join(artifact_path, 'latest')
         self.store.put(latest_path, '%s\n' % version)
 
@@ -355,6 +392,11 @@ class Repository(object):
         path = os.path.join(artifact_path, version)
         self.store.delete(path, metadata=True)
 
+        index = self._load_index(artifact_path)
+        if index and version in index:
+            del index[version]
+            self._store_index(artifact_path, index)
+
     def list_apps(self):
         return sorted(self.store.list())
 
@@ -370,21 +412,98 @@ class Repository(object):
         path = os.path.join(app, target, artifact)
         versions = []
         for version in self.store.list(path, files=True, dirs=False):
-            if version == 'latest' or version.endswith('.meta'):
+            if version in RESERVED_VERSIONS or version.endswith('.meta'):
                 continue
             versions.append(version)
         return sorted(versions, key=version_sort_key)
 
+    def reindex(self, app, target='master', artifact=None):
+        """Rebuild an artifact's metadata index from every version's metadata
+
+        put() does this when it first indexes an artifact.
+        """
+        if not artifact:
+            artifact = '%s.tar.gz' % app
+        index = {}
+        for version in self.list_versions(app, target, artifact):
+            metadata = self.get_metadata(app, version, target, artifact)
+            index[version] = dict(
+                (key, str(metadata[key])) for key in INDEXED_METADATA
+                if metadata.get(key) is not None)
+        self._store_index(os.path.join(app, target, artifact), index)
+        return index
+
+    def find(self, app, target='master', artifact=None, **criteria):
+        """Return the versions whose metadata matches all of criteria.
+
+        Criteria are INDEXED_METADATA keys. commit may be abbreviated.
+        Versions are looked up in the artifact's index. Versions missing from
+        the index (or all of them, if there is no index) are looked up
+        (slowly) in their metadata.
+        """
+        for key in criteria:
+            if key not in INDEXED_METADATA:
+                raise ValueError('Unindexed metadata: %s' % key)
+        if not artifact:
+            artifact = '%s.tar.gz' % app
+
+        index = self._load_index(os.path.join(app, target, artifact))
+        if index is None:
+            log.debug('No index for %s/%s/%s, examining every version',
+                      app, target, artifact)
+            index = {}
+        entries = {}
+        for version in self.list_versions(app, target, artifact):
+            if version not in index:
+                # Stored before the index existed, or lost by a concurrent put
+                index[version] = self.get_metadata(app, version, target,
+                                                   artifact)
+            entries[version] = index[version]
+
+        def matches(entry):
+            for key, value in criteria.items():
+                found = entry.get(key)
+                if found is None:
+                    return False
+                if key == 'commit':
+                    if not found.startswith(str(value)):
+                        return False
+                elif found != str(value):
+                    return False
+            return True
+
+        versions = [version for version, entry in entries.items()
+                    if matches(entry)]
+        return sorted(versions, key=version_sort_key)
+
     def gc(self, max_versions=10):
         """Garbage collect old versions
 
         Delete all but the most recent max_versions versions of each artifact
         in the repository.
+        Build index entries don't sort by age, they are deleted when the
+        version they refer to is.
         """
         for app in self.list_apps():
             for target in self.list_targets(app):
+                build_indexes = []
                 for artifact in self.list_artifacts(app, target):
+                    if artifact.endswith(BUILD_INDEX_SUFFIX):
+                        build_indexes.append(artifact)
+                        continue
                     versions = self.list_versions(app, target, artifact)
                     versions.reverse()
                     for version in versions[max_versions:]:
                         self.delete(app, version, target, artifact)
+                for artifact in build_indexes:
+                    self._gc_build_index(app, target, artifact)
+
+    def _gc_build_index(self, app, target, artifact):
+        """Delete build index entries for versions that no longer exist"""
+        built = '%s.tar.gz' % artifact[:-len(BUILD_INDEX_SUFFIX)]
+        versions = set(self.list_versions(app, target, built))
+        for key in self.list_versions(app, target, artifact):
+            with self.get(app, key, target, artifact) as f:
+                version = f.read().decode().strip()
+            if version not in versions:
+                self.delete(app, key, target, artifact)
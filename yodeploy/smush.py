@@ -0,0 +1,116 @@
+"""A disk cache in front of yoconfigurator's smush_config.
+
+Smushing executes every config source module. The result only depends on the
+contents of those sources (in order), the initial values, and the version of
+yoconfigurator, so it is cached as JSON, keyed by their hashes. Sources are
+identified by name and contents, not path, so the same sources in a new
+version of an app are still a hit.
+
+Config sources must be deterministic for this to be safe: They can't import
+helper modules or read anything other than the config they are given (files,
+the environment, the clock), unless it is the same every time on this
+machine. If yours do, disable the cache, with the smush_cache setting, or
+YODEPLOY_NO_SMUSH_CACHE=1.
+
+Configs contain secrets, so the cache is only readable by its owner.
+"""
+import hashlib
+import json
+import logging
+import os
+from importlib.metadata import PackageNotFoundError, version
+
+from yoconfigurator.base import DetectMissingEncoder
+from yoconfigurator.dicts import DotDict
+from yoconfigurator.smush import smush_config as _smush_config
+
+from yodeploy.delta import sha256sum
+
+log = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join('~', '.cache', 'yodeploy', 'smush')
+# Most cached configs to keep
+CACHE_SIZE = 256
+
+
+def cache_dir():
+    return os.environ.get('YODEPLOY_SMUSH_CACHE',
+                          os.path.expanduser(CACHE_DIR))
+
+
+def cache_enabled():
+    return not os.environ.get('YODEPLOY_NO_SMUSH_CACHE')
+
+
+def yoconfigurator_version():
+    try:
+        return version('yoconfigurator')
+    except PackageNotFoundError:
+        return None
+
+
+def cache_key(sources, initial=None, environment=None, cluster=None):
+    m = hashlib.sha256()
+    m.update(json.dumps([yoconfigurator_version(), environment, cluster,
+                         initial], sort_keys=True).encode('utf-8'))
+    for fn in sources:
+        with open(fn, 'rb') as f:
+            m.update(('\0%s\0%s' % (os.path.basename(fn), sha256sum(f))
+                      ).encode('utf-8'))
+    return m.hexdigest()
+
+
+def _prune(directory):
+    entries = [os.path.join(directory, fn) for fn in os.listdir(directory)]
+    entries.sort(key=lambda path: os.stat(path).st_mtime)
+    for path in entries[:-CACHE_SIZE]:
+        os.unlink(path)
+
+
+def smush_config(sources, initial=None, environment=None, cluster=None,
+                 cache=True):
+    """Merge the configuration sources and return the resulting DotDict.
+
+    Like yoconfigurator's smush_config, but cached, unless cache is False.
+    environment and cluster are only part of the cache key.
+    """
+    sources = list(sources)
+    if not (cache and cache_enabled()):
+        return _smush_config(sources, initial=initial)
+    directory = cache_dir()
+    key = cache_key(sources, initial, environment, cluster)
+    fn = os.path.join(directory, '%s.json' % key)
+    try:
+        with open(fn) as f:
+            config = DotDict(json.load(f))
+    except (IOError, ValueError):
+        pass
+    else:
+        log.debug('Using cached config %s', key)
+        try:
+            # For pruning
+            os.utime(fn, None)
+        except OSError:
+            pass
+        return config
+
+    config = _smush_config(sources, initial=initial)
+    try:
+        data = json.dumps(config, cls=DetectMissingEncoder)
+    except ValueError:
+        # Missing values: Leave it to write_config to complain
+        return config
+    config = DotDict(json.loads(data))
+
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        tmp = fn + '.%i' % os.getpid()
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.rename(tmp, fn)
+        _prune(directory)
+    except (IOError, OSError) as e:
+        log.debug('Unable to write config cache %s: %s', fn, e)
+    return config
@@ -0,0 +1,162 @@
+"""A client for supervisord's XML-RPC interface, over its Unix socket.
+
+One connection is kept open for all the calls, and related calls are batched
+with system.multicall. Rather than waiting for each process in turn (as
+supervisorctl does), restarts are requested for every group at once, and then
+the processes' states are polled until they are all running again.
+"""
+import http.client
+import logging
+import socket
+import time
+import xmlrpc.client
+
+log = logging.getLogger(__name__)
+
+SOCKET_PATH = '/var/run/supervisor.sock'
+
+# supervisor.states.ProcessStates
+STOPPED = 0
+STARTING = 10
+RUNNING = 20
+BACKOFF = 30
+STOPPING = 40
+EXITED = 100
+FATAL = 200
+
+# Raised when we can't talk to supervisord at all
+CONNECTION_ERRORS = (OSError, http.client.HTTPException,
+                     xmlrpc.client.ProtocolError)
+
+
+class UnixStreamHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super(UnixStreamHTTPConnection, self).__init__('localhost')
+        self.socket_path = socket_path
+        self.socket_timeout = timeout
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.socket_timeout is not None:
+            self.sock.settimeout(self.socket_timeout)
+        self.sock.connect(self.socket_path)
+
+
+class UnixStreamTransport(xmlrpc.client.Transport):
+    """An XML-RPC transport that keeps a connection to a Unix socket open"""
+
+    def __init__(self, socket_path, timeout=None):
+        super(UnixStreamTransport, self).__init__()
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        self._connection = host, UnixStreamHTTPConnection(self.socket_path,
+                                                          self.timeout)
+        return self._connection[1]
+
+
+class SupervisorClient(object):
+    def __init__(self, socket_path=SOCKET_PATH, timeout=30):
+        self.transport = UnixStreamTransport(socket_path, timeout)
+        self.proxy = xmlrpc.client.ServerProxy('http://localhost',
+                                               transport=self.transport)
+
+    def close(self):
+        self.transport.close()
+
+    def multicall(self, calls):
+        """Make several calls in one request.
+
+        calls is a list of (method, param, ...) tuples. Returns a list of
+        results, where calls that failed have xmlrpc.client.Fault results.
+        """
+        if not calls:
+            return []
+        results = self.proxy.system.multicall([
+            {'methodName': call[0], 'params': list(call[1:])}
+            for call in calls])
+        return [xmlrpc.client.Fault(result['faultCode'],
+                                    result['faultString'])
+                if isinstance(result, dict) and 'faultCode' in result
+                else result
+                for result in results]
+
+    def _check(self, calls, ignore=()):
+        """multicall, logging failures other than the faultCodes in ignore"""
+        for call, result in zip(calls, self.multicall(calls)):
+            if (isinstance(result, xmlrpc.client.Fault)
+                    and result.faultCode not in ignore):
+                log.error('supervisord %s(%s) failed: %s', call[0],
+                          call[1], result.faultString)
+
+    def update(self):
+        """Apply configuration changes, like supervisorctl reread + update"""
+        added, changed, removed = self.proxy.supervisor.reloadConfig()[0]
+        if removed or changed:
+            self._check([('supervisor.stopProcessGroup', name)
+                         for name in removed + changed])
+            self._check([('supervisor.removeProcessGroup', name)
+                         for name in removed + changed])
+        self._check([('supervisor.addProcessGroup', name)
+                     for name in changed + added])
+        return added, changed, removed
+
+    def group_states(self, groups):
+        """Return {group: [state, ...]} for groups"""
+        states = dict((group, []) for group in groups)
+        for info in self.proxy.supervisor.getAllProcessInfo():
+            if info['group'] in states:
+                states[info['group']].append(info['state'])
+        return states
+
+    def stop(self, groups, timeout=60):
+        """Stop groups, and wait for them to stop"""
+        self.multicall([('supervisor.stopProcessGroup', group, False)
+                        for group in groups])
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            states = self.group_states(groups)
+            if not any(state == STOPPING for group_states in states.values()
+                       for state in group_states):
+                return
+            time.sleep(0.1)
+        log.error('Timed out waiting for %s to stop', ', '.join(groups))
+
+    def restart(self, groups, timeout=60):
+        """Restart groups, concurrently.
+
+        Returns {group: seconds}, where seconds is None if the group didn't
+        start running within timeout.
+        """
+        start = time.time()
+        self.stop(groups, timeout=timeout)
+        calls = [('supervisor.startProcessGroup', group, False)
+                 for group in groups]
+        results = {}
+        for call, result in zip(calls, self.multicall(calls)):
+            if isinstance(result, xmlrpc.client.Fault):
+                log.error('Unable to start %s: %s', call[1],
+                          result.faultString)
+                results[call[1]] = None
+
+        pending = set(groups) - set(results)
+        deadline = start + timeout
+        while pending and time.time() < deadline:
+            for group, states in self.group_states(pending).items():
+                if all(state == RUNNING for state in states):
+                    results[group] = time.time() - start
+                    pending.remove(group)
+                elif any(state in (FATAL, EXITED, STOPPED)
+                         for state in states):
+                    log.error('%s failed to start', group)
+                    results[group] = None
+                    pending.remove(group)
+            if pending:
+                time.sleep(0.1)
+        for group in pending:
+            log.error('Timed out waiting for %s to start', group)
+            results[group] = None
+        return results
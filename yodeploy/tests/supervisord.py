@@ -0,0 +1,121 @@
+"""A stand-in for supervisord's XML-RPC interface, on a Unix socket."""
+import os
+import socket
+import socketserver
+import threading
+import xmlrpc.client
+from xmlrpc.server import SimpleXMLRPCRequestHandler, SimpleXMLRPCServer
+
+from yodeploy.supervisor import FATAL, RUNNING, STARTING, STOPPED
+
+BAD_NAME = 10
+
+
+class UnixXMLRPCServer(socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+    address_family = socket.AF_UNIX
+    daemon_threads = True
+
+
+class FakeSupervisord(object):
+    """Processes are groups with a single process of the same name.
+
+    Processes named in broken never start. Processes take one poll of
+    getAllProcessInfo to go from STARTING to RUNNING.
+    """
+
+    def __init__(self, socket_path, groups=(), config=None):
+        self.socket_path = socket_path
+        self.states = dict((group, RUNNING) for group in groups)
+        # The groups in the configuration files
+        self.config = set(config if config is not None else groups)
+        self.broken = set()
+        self.calls = []
+        self.connections = 0
+
+        fake = self
+
+        class Handler(SimpleXMLRPCRequestHandler):
+            # Keep-alive, like supervisord
+            protocol_version = 'HTTP/1.1'
+            # TCP_NODELAY isn't supported on Unix sockets
+            disable_nagle_algorithm = False
+
+            def setup(self):
+                fake.connections += 1
+                super(Handler, self).setup()
+
+            def address_string(self):
+                return fake.socket_path
+
+        self.server = UnixXMLRPCServer(socket_path, requestHandler=Handler,
+                                       logRequests=False, allow_none=True)
+        self.server.register_function(self.multicall, 'system.multicall')
+        for name in ('reloadConfig', 'addProcessGroup', 'removeProcessGroup',
+                     'stopProcessGroup', 'startProcessGroup',
+                     'getAllProcessInfo'):
+            self.server.register_function(getattr(self, name),
+                                          'supervisor.%s' % name)
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def multicall(self, calls):
+        # Like supervisord: Results aren't wrapped in lists
+        results = []
+        for call in calls:
+            try:
+                method = self.server.funcs[call['methodName']]
+                results.append(method(*call['params']))
+            except xmlrpc.client.Fault as e:
+                results.append({'faultCode': e.faultCode,
+                                'faultString': e.faultString})
+        return results
+
+    def _check(self, name):
+        if name not in self.states:
+            raise xmlrpc.client.Fault(BAD_NAME, 'BAD_NAME: %s' % name)
+
+    def reloadConfig(self):
+        self.calls.append(('reloadConfig',))
+        current = set(self.states)
+        return [[sorted(self.config - current), [],
+                 sorted(current - self.config)]]
+
+    def addProcessGroup(self, name):
+        self.calls.append(('addProcessGroup', name))
+        self.states[name] = RUNNING
+        return True
+
+    def removeProcessGroup(self, name):
+        self.calls.append(('removeProcessGroup', name))
+        self._check(name)
+        del self.states[name]
+        return True
+
+    def stopProcessGroup(self, name, wait=True):
+        self.calls.append(('stopProcessGroup', name))
+        self._check(name)
+        self.states[name] = STOPPED
+        return []
+
+    def startProcessGroup(self, name, wait=True):
+        self.calls.append(('startProcessGroup', name))
+        self._check(name)
+        self.states[name] = STARTING
+        return []
+
+    def getAllProcessInfo(self):
+        info = [{'name': name, 'group': name, 'state': state}
+                for name, state in sorted(self.states.items())]
+        for name, state in self.states.items():
+            if state == STARTING:
+                self.states[name] = FATAL if name in self.broken else RUNNING
+        return info
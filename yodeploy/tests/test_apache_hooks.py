@@ -1,8 +1,12 @@
+import os
 import unittest
 
+from unittest.mock import Mock, patch
+
 from yodeploy.hooks.apache import ApacheHostedApp, ApacheMultiSiteApp
 from yodeploy.hooks.configurator import ConfiguratedApp
 from yodeploy.hooks.templating import TemplatedApp
+from yodeploy.tests import TmpDirTestCase
 
 
 class TestApacheHostedApp(unittest.TestCase):
@@ -18,3 +22,58 @@ class TestApacheMultiSiteApp(unittest.TestCase):
 
     def test_is_an_apache_hosted_app(self):
         self.assertTrue(issubclass(ApacheMultiSiteApp, ApacheHostedApp))
+
+
+class TestApacheReload(TmpDirTestCase):
+    def setUp(self):
+        super(TestApacheReload, self).setUp()
+        patcher = patch.dict(os.environ, {
+            'YODEPLOY_RELOAD_DIR': self.tmppath('reloads'),
+            'YODEPLOY_TEMPLATE_CACHE': self.tmppath('cache'),
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for method in ('configurator_prepare', 'configurator_deployed'):
+            patcher = patch.object(ApacheHostedApp, method)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.mkdir('sites-enabled')
+        self.mkdir('yola.d')
+        self.apache = Mock()
+
+    def deploy(self, version, vhost='<VirtualHost *:80>\n'):
+        self.mkdir('versions', version, 'deploy', 'templates', 'apache2')
+        with open(self.tmppath('versions', version, 'deploy', 'templates',
+                               'apache2', 'vhost.conf.template'), 'w') as f:
+            f.write(vhost)
+        app = ApacheHostedApp('test', None, self.tmpdir, version, {}, None)
+        app.config = {}
+        app.apache = self.apache
+        app.vhost_path = self.tmppath('sites-enabled')
+        app.includes_path = self.tmppath('yola.d')
+        app.reload_window = 0
+        app.reload_unchanged = False
+        app.prepare()
+        app.deployed()
+
+    def test_reloads_unchanged_by_default(self):
+        self.assertTrue(ApacheHostedApp.reload_unchanged)
+
+    def test_unchanged(self):
+        self.deploy('1')
+        self.deploy('2')
+        self.assertEqual(self.apache.reload.call_count, 1)
+
+    def test_changed(self):
+        self.deploy('1')
+        self.deploy('2', vhost='<VirtualHost *:443>\n')
+        self.assertEqual(self.apache.reload.call_count, 2)
+
+    def test_failed_reload_retried(self):
+        self.apache.reload.side_effect = SystemExit(1)
+        self.assertRaises(SystemExit, self.deploy, '1')
+        self.apache.reload.side_effect = None
+        self.deploy('2')
+        self.assertEqual(self.apache.reload.call_count, 2)
+        self.deploy('3')
+        self.assertEqual(self.apache.reload.call_count, 2)
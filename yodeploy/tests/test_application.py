@@ -7,6 +7,7 @@ import time
 
 from yodeploy import virtualenv
 from yodeploy.application import Application
+from yodeploy.hooks.base import EVENTS_FILE
 from yodeploy.locking import LockedException
 from yodeploy.repository import LocalRepositoryStore, Repository
 from yodeploy.tests import TmpDirTestCase
@@ -102,6 +103,14 @@ class ApplicationTest(ApplicationTestCase):
                    self.tmppath('srv', 'test', 'live'))
         self.assertEqual(self.app.live_version, 'bar')
 
+    def test_events(self):
+        self.assertEqual(self.app.events('foo'), [])
+        with open(self.tmppath('srv', 'test', 'versions', 'foo',
+                               EVENTS_FILE), 'w') as f:
+            f.write('{"event": "warmup", "success": true}\n')
+        self.assertEqual(self.app.events('foo'),
+                         [{'event': 'warmup', 'success': True}])
+
     def test_deployed_versions(self):
         self.mkdir('srv', 'test', 'versions', 'unpack')
         self.assertEqual(self.app.deployed_versions, ['bar', 'foo'])
@@ -0,0 +1,74 @@
+import gzip
+import os
+import tarfile
+
+from yodeploy.compression import ParallelGzipFile, benchmark, make_tarball
+from yodeploy.tests import TmpDirTestCase
+
+
+class TestParallelGzipFile(TmpDirTestCase):
+    def compress(self, data, **kwargs):
+        with ParallelGzipFile(self.tmppath('out.gz'), **kwargs) as f:
+            f.write(data)
+        with open(self.tmppath('out.gz'), 'rb') as f:
+            return f.read()
+
+    def test_empty(self):
+        self.assertEqual(gzip.decompress(self.compress(b'')), b'')
+
+    def test_many_blocks(self):
+        data = os.urandom(1000) + b'abcdefgh' * 10000
+        compressed = self.compress(data, block_size=4096, threads=4)
+        self.assertEqual(gzip.decompress(compressed), data)
+        self.assertLess(len(compressed), len(data))
+
+    def test_levels(self):
+        data = b'yodeploy ' * 100000
+        for level in (1, 6, 9):
+            compressed = self.compress(data, level=level, block_size=65536)
+            self.assertEqual(gzip.decompress(compressed), data)
+
+    def test_mtime(self):
+        with ParallelGzipFile(self.tmppath('out.gz'), mtime=1234) as f:
+            f.write(b'foo')
+        with gzip.open(self.tmppath('out.gz')) as f:
+            f.read()
+            self.assertEqual(f.mtime, 1234)
+
+
+class TestMakeTarball(TmpDirTestCase):
+    def setUp(self):
+        super(TestMakeTarball, self).setUp()
+        self.mkdir('src', 'sub')
+        for name in ('a', 'sub/b'):
+            with open(self.tmppath('src', name), 'w') as f:
+                f.write(name * 1000)
+        self.pwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.pwd)
+        super(TestMakeTarball, self).tearDown()
+
+    def test_make_tarball(self):
+        make_tarball('out.tar.gz', ['src'], threads=2)
+        with tarfile.open('out.tar.gz') as tar:
+            self.assertEqual(sorted(tar.getnames()),
+                             ['src', 'src/a', 'src/sub', 'src/sub/b'])
+            self.assertEqual(tar.extractfile('src/sub/b').read(),
+                             b'sub/b' * 1000)
+
+    def test_benchmark(self):
+        results = benchmark(['src'], levels=(1,))
+        self.assertEqual([r[0] for r in results], ['tarfile', 'parallel'])
+        self.assertNotTMPPExists('benchmark.tar.gz')
+
+    def test_reproducible(self):
+        make_tarball('1.tar.gz', ['src'], mtime=1234)
+        os.utime(self.tmppath('src', 'a'), (5678, 5678))
+        make_tarball('2.tar.gz', ['src'], mtime=1234)
+        with open('1.tar.gz', 'rb') as f1, open('2.tar.gz', 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+        with tarfile.open('2.tar.gz') as tar:
+            self.assertEqual(tar.getmember('src/a').mtime, 1234)
+            self.assertEqual(tar.getmember('src/a').uname, 'root')
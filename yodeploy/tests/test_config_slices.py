@@ -0,0 +1,72 @@
+import os
+
+from yodeploy import config_slices
+from yodeploy.repository import LocalRepositoryStore, Repository
+from yodeploy.tests import TmpDirTestCase
+
+CONFIG = (
+    'def update(config):\n'
+    '    config.setdefault("sources", []).append(%r)\n'
+    '    return config\n'
+)
+
+
+class TestConfigSlices(TmpDirTestCase):
+    def setUp(self):
+        super(TestConfigSlices, self).setUp()
+        self.repo = Repository(LocalRepositoryStore(self.mkdir('repo')))
+        self.mkdir('work')
+        self.configs = {
+            'configs/common.py': CONFIG % 'common',
+            'configs/common-prod.py': CONFIG % 'common-prod',
+            'configs/common-dev.py': CONFIG % 'common-dev',
+            'configs/app.py': CONFIG % 'app',
+        }
+        self.upload('configs', '1', self.configs)
+        self.upload('app', '1', {
+            'app/deploy/configuration/app-default.py': CONFIG % 'default',
+            'app/code.py': '',
+        })
+
+    def upload(self, app, version, contents):
+        self.create_tar('upload.tar.gz', contents=contents)
+        with open(self.tmppath('upload.tar.gz'), 'rb') as f:
+            self.repo.put(app, version, f, {})
+        os.unlink(self.tmppath('upload.tar.gz'))
+
+    def test_build_slices(self):
+        uploaded = config_slices.build_slices(
+            self.repo, 'app', [('prod', 'east')], self.tmppath('work'))
+        self.assertEqual(uploaded, ['app.config-prod-east.json'])
+        config = config_slices.download_slice(self.repo, 'app', '1', '1',
+                                              'prod', 'east')
+        self.assertEqual(config['sources'],
+                         ['common', 'common-prod', 'default', 'app'])
+        self.assertEqual(config['yoconfigurator'], {'app': 'app'})
+
+    def test_missing_slice(self):
+        self.assertRaises(KeyError, config_slices.download_slice, self.repo,
+                          'app', '1', '1', 'prod', 'east')
+
+    def test_machine_specific(self):
+        self.configs['configs/hostname.py'] = CONFIG % 'hostname'
+        self.upload('configs', '2', self.configs)
+        self.assertRaises(config_slices.SliceError,
+                          config_slices.build_slices, self.repo, 'app',
+                          [('prod', 'east')], self.tmppath('work'))
+
+    def test_override_sources(self):
+        overrides = self.mkdir('overrides')
+        app_conf = self.mkdir('configuration')
+        for directory, name in ((overrides, 'other.py'),
+                                (app_conf, 'app-default.py')):
+            with open(os.path.join(directory, name), 'w') as f:
+                f.write('')
+        self.assertEqual(config_slices.override_sources(
+            'app', 'prod', 'east', [overrides], app_conf), [])
+
+        with open(os.path.join(overrides, 'app-overrides.py'), 'w') as f:
+            f.write('')
+        self.assertEqual(config_slices.override_sources(
+            'app', 'prod', 'east', [overrides], app_conf),
+            [os.path.join(overrides, 'app-overrides.py')])
@@ -0,0 +1,162 @@
+import os
+import tarfile
+
+from yodeploy import delta
+from yodeploy.repository import LocalRepositoryStore, Repository
+from yodeploy.tests import TmpDirTestCase
+from yodeploy.util import extract_tar
+
+
+class DeltaTestCase(TmpDirTestCase):
+    def create_version(self, name, contents):
+        self.create_tar(name, contents=dict(
+            ('app/%s' % path, data) for path, data in contents.items()))
+        return self.tmppath(name)
+
+
+class TestTarManifest(DeltaTestCase):
+    def test_describes_files(self):
+        tarball = self.create_version('1.tar.gz', {'foo': 'bar\n'})
+        manifest = delta.tar_manifest(tarball)
+        self.assertEqual(manifest['root'], 'app')
+        self.assertEqual(manifest['size'], os.path.getsize(tarball))
+        self.assertEqual(manifest['files']['foo']['size'], 4)
+        self.assertEqual(manifest['files']['foo']['type'], 'file')
+
+    def create_hardlinked_version(self, name, contents):
+        self.mkdir(name, 'app')
+        with open(self.tmppath(name, 'app', 'foo'), 'w') as f:
+            f.write(contents)
+        os.link(self.tmppath(name, 'app', 'foo'),
+                self.tmppath(name, 'app', 'bar'))
+        with tarfile.open(self.tmppath('%s.tar.gz' % name), 'w:gz') as tar:
+            tar.add(self.tmppath(name, 'app'), 'app')
+        return self.tmppath('%s.tar.gz' % name)
+
+    def test_hardlink(self):
+        tarball = self.create_hardlinked_version('1', 'bar\n')
+        with tarfile.open(tarball) as tar:
+            self.assertTrue(any(member.islnk()
+                                for member in tar.getmembers()))
+        manifest = delta.tar_manifest(tarball)
+        self.assertEqual(manifest['files']['foo'], manifest['files']['bar'])
+        self.assertEqual(manifest['files']['bar']['type'], 'file')
+        self.assertEqual(manifest['files']['bar']['size'], 4)
+
+    def test_hardlink_delta(self):
+        old = self.create_version('1.tar.gz', {'foo': 'foo\n', 'bar': 'foo\n'})
+        new = self.create_hardlinked_version('2', 'new\n')
+        old_manifest = delta.tar_manifest(old)
+        new_manifest = delta.tar_manifest(new)
+        extract_tar(old, self.tmppath('base'))
+        delta.write_delta(new, new_manifest, old_manifest,
+                          self.tmppath('delta.tar.gz'))
+        delta.apply_delta(self.tmppath('base'), self.tmppath('delta.tar.gz'),
+                          new_manifest, self.tmppath('dest'))
+        self.assertTMPPContents('new\n', 'dest', 'foo')
+        self.assertTMPPContents('new\n', 'dest', 'bar')
+
+    def test_multi_root(self):
+        self.create_tar('bad.tar.gz', 'foo/bar', 'baz/quux')
+        self.assertRaises(delta.DeltaError, delta.tar_manifest,
+                          self.tmppath('bad.tar.gz'))
+
+
+class TestDelta(DeltaTestCase):
+    def setUp(self):
+        super(TestDelta, self).setUp()
+        self.old = self.create_version('1.tar.gz', {
+            'same': 'same\n',
+            'changed': 'old\n',
+            'removed': 'gone\n',
+            'sub/same': 'same\n',
+        })
+        self.new = self.create_version('2.tar.gz', {
+            'same': 'same\n',
+            'changed': 'new\n',
+            'added': 'added\n',
+            'sub/same': 'same\n',
+        })
+        self.old_manifest = delta.tar_manifest(self.old)
+        self.new_manifest = delta.tar_manifest(self.new)
+        extract_tar(self.old, self.tmppath('base'))
+
+    def test_delta_only_has_changes(self):
+        delta.write_delta(self.new, self.new_manifest, self.old_manifest,
+                          self.tmppath('delta.tar.gz'))
+        with tarfile.open(self.tmppath('delta.tar.gz')) as tar:
+            names = set(tar.getnames())
+        self.assertEqual(names, set(['app/changed', 'app/added']))
+
+    def test_apply(self):
+        delta.write_delta(self.new, self.new_manifest, self.old_manifest,
+                          self.tmppath('delta.tar.gz'))
+        delta.apply_delta(self.tmppath('base'), self.tmppath('delta.tar.gz'),
+                          self.new_manifest, self.tmppath('dest'))
+        self.assertTMPPContents('new\n', 'dest', 'changed')
+        self.assertTMPPContents('added\n', 'dest', 'added')
+        self.assertTMPPContents('same\n', 'dest', 'sub', 'same')
+        self.assertNotTMPPExists('dest', 'removed')
+
+    def test_apply_modified_base(self):
+        with open(self.tmppath('base', 'same'), 'w') as f:
+            f.write('modified\n')
+        delta.write_delta(self.new, self.new_manifest, self.old_manifest,
+                          self.tmppath('delta.tar.gz'))
+        self.assertRaises(delta.DeltaError, delta.apply_delta,
+                          self.tmppath('base'), self.tmppath('delta.tar.gz'),
+                          self.new_manifest, self.tmppath('dest'))
+
+
+    def test_apply_corrupt_delta(self):
+        delta.write_delta(self.new, self.new_manifest, self.old_manifest,
+                          self.tmppath('delta.tar.gz'))
+        self.new_manifest['files']['added']['sha256'] = 'f' * 64
+        self.assertRaises(delta.DeltaError, delta.apply_delta,
+                          self.tmppath('base'), self.tmppath('delta.tar.gz'),
+                          self.new_manifest, self.tmppath('dest'))
+
+    def test_apply_truncated_delta(self):
+        delta.write_delta(self.new, self.new_manifest, self.old_manifest,
+                          self.tmppath('delta.tar.gz'))
+        with open(self.tmppath('delta.tar.gz'), 'r+b') as f:
+            f.truncate(os.path.getsize(self.tmppath('delta.tar.gz')) // 2)
+        self.assertRaises(delta.DeltaError, delta.apply_delta,
+                          self.tmppath('base'), self.tmppath('delta.tar.gz'),
+                          self.new_manifest, self.tmppath('dest'))
+
+
+class TestBuildDeltas(DeltaTestCase):
+    def setUp(self):
+        super(TestBuildDeltas, self).setUp()
+        self.repo = Repository(LocalRepositoryStore(self.mkdir('repo')))
+        self.mkdir('work')
+        contents = dict(('file%i' % i, 'content %i\n' % i * 100)
+                        for i in range(20))
+        self.old = self.create_version('1.tar.gz', contents)
+        contents['file0'] = 'changed\n'
+        self.new = self.create_version('2.tar.gz', contents)
+
+    def upload(self, version, tarball):
+        with open(tarball, 'rb') as f:
+            self.repo.put('app', version, f, {})
+        return delta.build_deltas(self.repo, 'app', version, tarball,
+                                  workdir=self.tmppath('work'))
+
+    def test_first_version_has_no_deltas(self):
+        manifest = self.upload('1', self.old)
+        self.assertEqual(manifest['deltas'], {})
+        self.assertEqual(delta.load_manifest(self.repo, 'app', '1'), manifest)
+
+    def test_delta_against_previous(self):
+        self.upload('1', self.old)
+        manifest = self.upload('2', self.new)
+        self.assertEqual(list(manifest['deltas']), ['1'])
+        self.assertEqual(
+            self.repo.list_versions('app', artifact='app.delta.tar.gz'),
+            ['2-1'])
+
+    def test_choose_base(self):
+        manifest = {'size': 100, 'deltas': {'1': 50, '2': 10, '3': 5}}
+        self.assertEqual(delta.choose_base(manifest, ['1', '2']), '2')
+        self.assertEqual(delta.choose_base(manifest, ['4']), None)
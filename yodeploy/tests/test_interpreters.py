@@ -0,0 +1,84 @@
+import os
+import stat
+
+from unittest.mock import patch
+
+from yodeploy import interpreters
+from yodeploy.tests import TmpDirTestCase
+
+
+class TestInterpreterInfo(TmpDirTestCase):
+    def setUp(self):
+        super(TestInterpreterInfo, self).setUp()
+        patcher = patch.dict(os.environ, {
+            'YODEPLOY_INTERPRETER_CACHE': self.tmppath('cache.json'),
+            'PATH': self.mkdir('bin'),
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.python = self.fake_python('python3', '3.9')
+
+    def fake_python(self, name, version):
+        path = self.tmppath('bin', name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'echo \'{"version": "%s", "full_version": "%s.1", '
+                    '"implementation": "CPython", "abi": "", '
+                    '"abiflags": ""}\'\n' % (version, version))
+        os.chmod(path, stat.S_IRWXU)
+        return path
+
+    def test_introspects(self):
+        info = interpreters.interpreter_info(self.python)
+        self.assertEqual(info['version'], '3.9')
+        self.assertEqual(info['path'], self.python)
+
+    def fake_binary(self, name):
+        path = self.tmppath('bin', name)
+        with open(path, 'wb') as f:
+            f.write(b'\x7fELF')
+        os.chmod(path, stat.S_IRWXU)
+        return path
+
+    def test_cached(self):
+        python = self.fake_binary('python3.9')
+        with patch('subprocess.check_output',
+                   return_value=b'{"version": "3.9"}'):
+            interpreters.interpreter_info(python)
+        with patch('subprocess.check_output') as check_output:
+            info = interpreters.interpreter_info(python)
+        self.assertFalse(check_output.called)
+        self.assertEqual(info['version'], '3.9')
+
+    def test_invalidated_by_mtime(self):
+        python = self.fake_binary('python3.9')
+        with patch('subprocess.check_output',
+                   return_value=b'{"version": "3.9"}'):
+            interpreters.interpreter_info(python)
+        os.utime(python, (1, 1))
+        with patch('subprocess.check_output',
+                   return_value=b'{"version": "3.10"}') as check_output:
+            info = interpreters.interpreter_info(python)
+        self.assertTrue(check_output.called)
+        self.assertEqual(info['version'], '3.10')
+
+    def test_scripts_not_cached(self):
+        # Like a pyenv shim, that picks the interpreter each time it runs
+        interpreters.interpreter_info(self.python)
+        st = os.stat(self.python)
+        self.fake_python('python3', '3.10')
+        os.utime(self.python, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(
+            interpreters.interpreter_info(self.python)['version'], '3.10')
+        self.assertNotTMPPExists('cache.json')
+
+    def test_find(self):
+        self.assertEqual(interpreters.find('python3')['version'], '3.9')
+        self.assertEqual(interpreters.find('python2'), None)
+
+    def test_discover(self):
+        self.fake_python('python2.7', '2.7')
+        self.fake_python('pythonista', '0.1')
+        self.assertEqual(
+            [info['version'] for info in interpreters.discover()],
+            ['2.7', '3.9'])
@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+
+from unittest.mock import Mock, patch
+
+from yodeploy.reloads import (coalesced_reload, config_applied,
+                              config_changed, reload_pending)
+from yodeploy.tests import TmpDirTestCase
+
+
+class TestCoalescedReload(TmpDirTestCase):
+    def setUp(self):
+        super(TestCoalescedReload, self).setUp()
+        patcher = patch.dict(os.environ, {
+            'YODEPLOY_RELOAD_DIR': self.tmppath('reloads'),
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.reload = Mock()
+
+    def test_reload(self):
+        coalesced_reload('apache2', self.reload, window=0)
+        coalesced_reload('apache2', self.reload, window=0)
+        self.assertEqual(self.reload.call_count, 2)
+
+    def test_concurrent(self):
+        threads = [threading.Thread(target=coalesced_reload,
+                                    args=('apache2', self.reload),
+                                    kwargs={'window': 0.5})
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.reload.call_count, 1)
+
+    def test_services_independent(self):
+        coalesced_reload('apache2', self.reload, window=0)
+        nginx_reload = Mock()
+        coalesced_reload('nginx', nginx_reload, window=0)
+        self.assertEqual(self.reload.call_count, 1)
+        self.assertEqual(nginx_reload.call_count, 1)
+
+    def test_failure(self):
+        self.reload.side_effect = [Exception('Failed'), None]
+        self.assertRaises(Exception, coalesced_reload, 'apache2',
+                          self.reload, window=0)
+        coalesced_reload('apache2', self.reload, window=0)
+        self.assertEqual(self.reload.call_count, 2)
+
+    def test_config_changed(self):
+        self.assertFalse(reload_pending('apache2'))
+        config_changed('apache2')
+        self.assertTrue(reload_pending('apache2'))
+        coalesced_reload('apache2', self.reload, window=0)
+        self.assertFalse(reload_pending('apache2'))
+
+    def test_pending_after_failure(self):
+        config_changed('apache2')
+        self.reload.side_effect = Exception('Failed')
+        self.assertRaises(Exception, coalesced_reload, 'apache2',
+                          self.reload, window=0)
+        self.assertTrue(reload_pending('apache2'))
+
+    def test_config_applied(self):
+        config_changed('systemd')
+        config_applied('systemd', 0)
+        self.assertTrue(reload_pending('systemd'))
+        config_applied('systemd', time.time())
+        self.assertFalse(reload_pending('systemd'))
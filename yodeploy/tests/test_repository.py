@@ -288,3 +288,81 @@ class TestLocalRepository(TmpDirTestCase):
         self.repo.gc(2)
         self.assertEqual(self.repo.list_versions('foo'), ['3.0', '4.0'])
         self.assertEqual(self.repo.list_versions('foo', 'dev'), ['3.1', '4.1'])
+
+    def test_gc_build_index(self):
+        for version in ('1', '2', '3'):
+            self.repo.put('foo', version, 'data', {})
+        # Keyed by tree hashes, which sort in no particular order
+        self.repo.put('foo', 'ffff', '1\n', {}, artifact='foo.build-index')
+        self.repo.put('foo', '0000', '3\n', {}, artifact='foo.build-index')
+        self.repo.gc(2)
+        self.assertEqual(self.repo.list_versions('foo'), ['2', '3'])
+        self.assertEqual(
+            self.repo.list_versions('foo', artifact='foo.build-index'),
+            ['0000'])
+
+    def test_index(self):
+        self.repo.put('foo', '1.0', 'data', {'commit': 'abc', 'other': 'x'})
+        self.repo.put('foo', '2.0', 'data', {})
+        self.assertTMPPExists('repo', 'foo', 'master', 'foo.tar.gz', 'index')
+        self.assertEqual(self.repo.list_versions('foo'), ['1.0', '2.0'])
+
+    def test_store_illegal_index_version(self):
+        self.assertRaises(ValueError, self.repo.put, 'foo', 'index',
+                          'version 1', {})
+
+    def test_find(self):
+        self.repo.put('foo', '1.0', 'data', {'commit': 'abc123',
+                                             'build_number': '1.0'})
+        self.repo.put('foo', '2.0', 'data', {'commit': 'def456',
+                                             'build_number': '2.0',
+                                             'vcs_tag': 'v2'})
+        self.repo.put('foo', '2.1', 'data', {'commit': 'def456',
+                                             'build_number': '2.1'})
+        self.assertEqual(self.repo.find('foo', commit='abc'), ['1.0'])
+        self.assertEqual(self.repo.find('foo', commit='def456'),
+                         ['2.0', '2.1'])
+        self.assertEqual(self.repo.find('foo', vcs_tag='v2'), ['2.0'])
+        self.assertEqual(self.repo.find('foo', commit='def456',
+                                        build_number='2.1'), ['2.1'])
+        self.assertEqual(self.repo.find('foo', commit='fff'), [])
+
+    def test_find_unindexed(self):
+        self.assertRaises(ValueError, self.repo.find, 'foo', other='x')
+
+    def test_find_without_index(self):
+        self.repo.put('foo', '1.0', 'data', {'commit': 'abc123'})
+        self.repo.store.delete('foo/master/foo.tar.gz/index')
+        self.assertEqual(self.repo.find('foo', commit='abc123'), ['1.0'])
+
+    def test_index_seeded_on_upgrade(self):
+        # Stored before the index existed
+        self.repo.put('foo', '1.0', 'data', {'commit': 'abc123'})
+        self.repo.store.delete('foo/master/foo.tar.gz/index')
+        self.repo.put('foo', '2.0', 'data', {'commit': 'def456'})
+        self.repo.store.delete('foo/master/foo.tar.gz/1.0.meta')
+        self.assertEqual(self.repo.find('foo', commit='abc123'), ['1.0'])
+        self.assertEqual(self.repo.find('foo', commit='def456'), ['2.0'])
+
+    def test_find_missing_from_index(self):
+        # A concurrent put can overwrite the index, losing our entry
+        self.repo.put('foo', '1.0', 'data', {'commit': 'abc123'})
+        with self.repo.store.get('foo/master/foo.tar.gz/index') as f:
+            index = f.read()
+        self.repo.put('foo', '2.0', 'data', {'commit': 'abc123'})
+        self.repo.store.put('foo/master/foo.tar.gz/index', index)
+        self.assertEqual(self.repo.find('foo', commit='abc123'),
+                         ['1.0', '2.0'])
+
+    def test_find_deleted(self):
+        self.repo.put('foo', '1.0', 'data', {'commit': 'abc123'})
+        self.repo.put('foo', '2.0', 'data', {'commit': 'abc123'})
+        self.repo.delete('foo', '1.0')
+        self.assertEqual(self.repo.find('foo', commit='abc123'), ['2.0'])
+
+    def test_reindex(self):
+        self.repo.put('foo', '1.0', 'data', {'commit': 'abc123'})
+        self.repo.store.delete('foo/master/foo.tar.gz/index')
+        self.assertEqual(self.repo.reindex('foo'),
+                         {'1.0': {'commit': 'abc123'}})
+        self.assertTMPPExists('repo', 'foo', 'master', 'foo.tar.gz', 'index')
@@ -0,0 +1,99 @@
+import os
+
+from unittest.mock import patch
+
+from yodeploy import smush
+from yodeploy.tests import TmpDirTestCase
+
+CONFIG = (
+    'def update(config):\n'
+    '    config[%r] = config.get("count", 0) + 1\n'
+    '    config["count"] = config[%r]\n'
+    '    return config\n'
+)
+
+
+class TestSmushCache(TmpDirTestCase):
+    def setUp(self):
+        super(TestSmushCache, self).setUp()
+        patcher = patch.dict(os.environ,
+                             {'YODEPLOY_SMUSH_CACHE': self.tmppath('cache')})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mkdir('v1')
+        self.sources = [self.write('v1', 'common.py'),
+                        self.write('v1', 'app.py')]
+
+    def write(self, directory, name, key=None):
+        key = key or name.rsplit('.', 1)[0]
+        path = self.tmppath(directory, name)
+        with open(path, 'w') as f:
+            f.write(CONFIG % (key, key))
+        return path
+
+    def smush(self, sources, **kwargs):
+        with patch('yodeploy.smush._smush_config',
+                   wraps=smush._smush_config) as smush_config:
+            config = smush.smush_config(sources, **kwargs)
+        return config, smush_config.called
+
+    def test_cached(self):
+        config, smushed = self.smush(self.sources)
+        self.assertTrue(smushed)
+        self.assertEqual(config, {'common': 1, 'app': 2, 'count': 2})
+        config, smushed = self.smush(self.sources)
+        self.assertFalse(smushed)
+        self.assertEqual(config.count, 2)
+
+    def test_private(self):
+        self.smush(self.sources)
+        self.assertEqual(os.stat(self.tmppath('cache')).st_mode & 0o777,
+                         0o700)
+        for fn in os.listdir(self.tmppath('cache')):
+            self.assertEqual(
+                os.stat(self.tmppath('cache', fn)).st_mode & 0o777, 0o600)
+
+    def test_same_sources_elsewhere(self):
+        self.smush(self.sources)
+        self.mkdir('v2')
+        sources = [self.write('v2', 'common.py'), self.write('v2', 'app.py')]
+        self.assertFalse(self.smush(sources)[1])
+
+    def test_order(self):
+        self.smush(self.sources)
+        config, smushed = self.smush(list(reversed(self.sources)))
+        self.assertTrue(smushed)
+        self.assertEqual(config.common, 2)
+
+    def test_changed_source(self):
+        self.smush(self.sources)
+        self.write('v1', 'app.py', key='other')
+        config, smushed = self.smush(self.sources)
+        self.assertTrue(smushed)
+        self.assertEqual(config.other, 2)
+
+    def test_key(self):
+        self.smush(self.sources, environment='prod', cluster='east')
+        self.assertTrue(self.smush(self.sources, environment='qa',
+                                   cluster='east')[1])
+        self.assertTrue(self.smush(self.sources, environment='prod',
+                                   cluster='east', initial={'a': 1})[1])
+        self.assertFalse(self.smush(self.sources, environment='prod',
+                                    cluster='east')[1])
+
+    def test_disabled(self):
+        self.smush(self.sources)
+        self.assertTrue(self.smush(self.sources, cache=False)[1])
+
+    def test_disabled_by_environment(self):
+        self.smush(self.sources)
+        with patch.dict(os.environ, {'YODEPLOY_NO_SMUSH_CACHE': '1'}):
+            config, smushed = self.smush(self.sources)
+        self.assertTrue(smushed)
+        self.assertEqual(config['count'], 2)
+
+    def test_yoconfigurator_upgraded(self):
+        self.smush(self.sources)
+        with patch('yodeploy.smush.yoconfigurator_version',
+                   return_value='999'):
+            self.assertTrue(self.smush(self.sources)[1])
@@ -0,0 +1,45 @@
+import xmlrpc.client
+
+from yodeploy.supervisor import RUNNING, SupervisorClient
+from yodeploy.tests import TmpDirTestCase
+from yodeploy.tests.supervisord import FakeSupervisord
+
+
+class TestSupervisorClient(TmpDirTestCase):
+    def setUp(self):
+        super(TestSupervisorClient, self).setUp()
+        self.supervisord = FakeSupervisord(
+            self.tmppath('supervisor.sock'), groups=('web', 'worker'))
+        self.supervisord.start()
+        self.addCleanup(self.supervisord.stop)
+        self.client = SupervisorClient(self.tmppath('supervisor.sock'))
+        self.addCleanup(self.client.close)
+
+    def test_multicall(self):
+        results = self.client.multicall([
+            ('supervisor.stopProcessGroup', 'web'),
+            ('supervisor.stopProcessGroup', 'missing'),
+        ])
+        self.assertEqual(results[0], [])
+        self.assertIsInstance(results[1], xmlrpc.client.Fault)
+
+    def test_update(self):
+        self.supervisord.config = set(['web', 'celery'])
+        self.assertEqual(self.client.update(), (['celery'], [], ['worker']))
+        self.assertEqual(sorted(self.supervisord.states), ['celery', 'web'])
+
+    def test_restart(self):
+        results = self.client.restart(['web', 'worker'])
+        self.assertEqual(sorted(results), ['web', 'worker'])
+        self.assertTrue(all(seconds is not None
+                            for seconds in results.values()))
+        self.assertEqual(self.supervisord.states,
+                         {'web': RUNNING, 'worker': RUNNING})
+        self.assertEqual(self.supervisord.connections, 1)
+
+    def test_restart_failure(self):
+        self.supervisord.broken.add('worker')
+        results = self.client.restart(['web', 'worker', 'missing'])
+        self.assertIsNotNone(results['web'])
+        self.assertIsNone(results['worker'])
+        self.assertIsNone(results['missing'])
@@ -10,7 +10,7 @@ import unittest
 from yodeploy.tests import (
     HelperScriptConsumer, TmpDirTestCase, yodeploy_location)
 from yodeploy.util import (
-    chown_r, delete_dir_content, extract_tar, ignoring, touch)
+    chown_r, delete_dir_content, extract_tar, ignoring, link_tree, touch)
 
 
 class TestChown_R(TmpDirTestCase):
@@ -96,6 +96,19 @@ class TestExtractTar(TmpDirTestCase, HelperScriptConsumer):
             self.fail("Subprocess execution timed out")
 
 
+class TestLinkTree(TmpDirTestCase):
+    def test_links(self):
+        self.mkdir('src', 'foo')
+        with open(self.tmppath('src', 'foo', 'bar'), 'w') as f:
+            f.write('bar')
+        os.symlink('foo', self.tmppath('src', 'baz'))
+        link_tree(self.tmppath('src'), self.tmppath('dst'))
+        self.assertTMPPContents('bar', 'dst', 'foo', 'bar')
+        self.assertEqual(os.stat(self.tmppath('src', 'foo', 'bar')).st_ino,
+                         os.stat(self.tmppath('dst', 'foo', 'bar')).st_ino)
+        self.assertEqual(os.readlink(self.tmppath('dst', 'baz')), 'foo')
+
+
 class TestDelete_Dir_Content(TmpDirTestCase):
     def test_simple(self):
         f = self.tmppath('test.txt')
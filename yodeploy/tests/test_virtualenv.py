@@ -0,0 +1,141 @@
+import os
+
+from packaging.version import Version
+
+from yodeploy import virtualenv
+from yodeploy.repository import LocalRepositoryStore, Repository
+from yodeploy.tests import TmpDirTestCase
+
+
+class TestPinnedRequirements(TmpDirTestCase):
+    def test_pins(self):
+        with open(self.tmppath('other.txt'), 'w') as f:
+            f.write('six\n-c constraints.txt\n')
+        with open(self.tmppath('constraints.txt'), 'w') as f:
+            f.write('wheel==1.0\n')
+        with open(self.tmppath('requirements.txt'), 'w') as f:
+            f.write('# A comment\n'
+                    'Django == 1.11  # pinned\n'
+                    '-r other.txt\n'
+                    '\n'
+                    'python_dateutil>=2\n'
+                    'pytz==2017.*\n')
+        self.assertEqual(
+            virtualenv.pinned_requirements(
+                self.tmppath('requirements.txt')),
+            set([('django', Version('1.11')), ('wheel', Version('1.0'))]))
+
+
+class TestWheelhouse(TmpDirTestCase):
+    def setUp(self):
+        super(TestWheelhouse, self).setUp()
+        self.repo = Repository(LocalRepositoryStore(self.mkdir('repo')))
+        self.local = self.mkdir('local')
+        self.wheels = ['Django-1.11-py3-none-any.whl',
+                       'Django-2.0-py3-none-any.whl',
+                       'six-1.0-py2.py3-none-any.whl']
+        for fn in self.wheels + ['README']:
+            with open(os.path.join(self.local, fn), 'w') as f:
+                f.write(fn)
+
+    def test_wheel_name(self):
+        self.assertEqual(virtualenv.wheel_name(self.wheels[0]), 'django')
+        self.assertEqual(virtualenv.wheel_name('README'), None)
+
+    def test_upload_wheels(self):
+        virtualenv.upload_wheels(self.repo, 'linux', self.local)
+        self.assertEqual(
+            self.repo.list_artifacts(virtualenv.WHEELHOUSE_APP, 'linux'),
+            self.wheels)
+
+    def test_download_wheels(self):
+        virtualenv.upload_wheels(self.repo, 'linux', self.local)
+        cache = self.mkdir('cache')
+        # A transitive dependency, pinned by the frozen requirements
+        pins = set([('django', Version('1.11')), ('six', Version('1.0'))])
+        virtualenv.download_wheels(self.repo, 'linux', pins, cache)
+        self.assertEqual(sorted(os.listdir(cache)),
+                         [self.wheels[0], self.wheels[2]])
+        self.assertTMPPContents(self.wheels[0], 'cache', self.wheels[0])
+
+
+class TestRequirementsHash(TmpDirTestCase):
+    def write(self, name, contents):
+        with open(self.tmppath(name), 'w') as f:
+            f.write(contents)
+        return self.tmppath(name)
+
+    def test_insensitive_to_formatting(self):
+        a = self.write('a.txt', 'Django==1.11\nsix == 1.0\n')
+        b = self.write('b.txt', '# Comment\nsix==1.0  # pinned\n\n'
+                                'django ==1.11\n')
+        self.assertEqual(virtualenv.requirements_hash(a),
+                         virtualenv.requirements_hash(b))
+
+    def test_sensitive_to_versions(self):
+        a = self.write('a.txt', 'Django==1.11\n')
+        b = self.write('b.txt', 'Django==1.11.1\n')
+        self.assertNotEqual(virtualenv.requirements_hash(a),
+                            virtualenv.requirements_hash(b))
+
+    def test_follows_includes(self):
+        self.write('base.txt', 'six==1.0\n')
+        a = self.write('a.txt', '-r base.txt\nDjango==1.11\n')
+        b = self.write('b.txt', 'Django==1.11\nsix==1.0\n')
+        self.assertEqual(virtualenv.requirements_hash(a),
+                         virtualenv.requirements_hash(b))
+
+    def test_constraints_differ_from_requirements(self):
+        self.write('constraints.txt', 'six==1.0\n')
+        a = self.write('a.txt', '-c constraints.txt\nDjango==1.11\n')
+        b = self.write('b.txt', 'Django==1.11\nsix==1.0\n')
+        self.assertNotEqual(virtualenv.requirements_hash(a),
+                            virtualenv.requirements_hash(b))
+
+    def test_legacy_id(self):
+        a = self.write('a.txt', 'Django==1.11\n')
+        self.assertEqual(virtualenv.get_id(a, '3.9', 'linux', legacy=True),
+                         '3.9-linux-%s' % virtualenv.sha224sum(a))
+        self.assertNotEqual(virtualenv.get_id(a, '3.9', 'linux'),
+                            virtualenv.get_id(a, '3.9', 'linux', legacy=True))
+
+
+class TestDownloadVE(TmpDirTestCase):
+    def setUp(self):
+        super(TestDownloadVE, self).setUp()
+        self.repo = Repository(LocalRepositoryStore(self.mkdir('repo')))
+        self.repo.put('app', '1', 'legacy', {},
+                      artifact='virtualenv-old.tar.gz')
+
+    def test_fallback(self):
+        dest = self.tmppath('virtualenv.tar.gz')
+        ve_id = virtualenv.download_ve(self.repo, 'app', 'new', dest=dest,
+                                       fallback_ids=('old',))
+        self.assertEqual(ve_id, 'old')
+        self.assertTMPPContents('legacy', 'virtualenv.tar.gz')
+
+    def test_missing(self):
+        self.assertRaises(KeyError, virtualenv.download_ve, self.repo, 'app',
+                          'new', dest=self.tmppath('virtualenv.tar.gz'))
+
+
+class TestUploadVE(TmpDirTestCase):
+    def setUp(self):
+        super(TestUploadVE, self).setUp()
+        self.repo = Repository(LocalRepositoryStore(self.mkdir('repo')))
+
+    def upload(self, contents):
+        with open(self.tmppath('virtualenv.tar.gz'), 'w') as f:
+            f.write(contents)
+        virtualenv.upload_ve(self.repo, 'app', 'id',
+                             source=self.tmppath('virtualenv.tar.gz'),
+                             overwrite=True)
+        return self.repo.list_versions('app', artifact='virtualenv-id.tar.gz')
+
+    def test_skips_identical(self):
+        self.assertEqual(self.upload('foo'), ['1'])
+        self.assertEqual(self.upload('foo'), ['1'])
+
+    def test_overwrites_different(self):
+        self.assertEqual(self.upload('foo'), ['1'])
+        self.assertEqual(self.upload('bar'), ['1', '2'])
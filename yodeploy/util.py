@@ -77,6 +77,32 @@ def delete_dir_content(path):
                 log.warning("Unable to delete %s %s", root, d)
 
 
+def link_tree(src, dst):
+    """Recreate the tree src at dst, hardlinking files.
+
+    Falls back to copying files that can't be linked (e.g. across
+    filesystems). Symlinks are recreated, not followed.
+    """
+    os.makedirs(dst)
+    for root, dirs, files in os.walk(src):
+        dest_root = os.path.join(dst, os.path.relpath(root, src))
+        for d in dirs:
+            if os.path.islink(os.path.join(root, d)):
+                files.append(d)
+            else:
+                os.mkdir(os.path.join(dest_root, d))
+        for f in files:
+            src_fn = os.path.join(root, f)
+            dst_fn = os.path.join(dest_root, f)
+            if os.path.islink(src_fn):
+                os.symlink(os.readlink(src_fn), dst_fn)
+                continue
+            try:
+                os.link(src_fn, dst_fn)
+            except OSError:
+                shutil.copy2(src_fn, dst_fn)
+
+
 @contextlib.contextmanager
 def ignoring(ignore_err_no):
     """Ignore OSErrors accoring to the given error number."""
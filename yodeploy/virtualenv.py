@@ -1,13 +1,26 @@
 import hashlib
 import logging
 import os
+import re
 import subprocess
 import sys
 import shutil
-import tarfile
+
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.utils import (InvalidWheelFilename, canonicalize_name,
+                             parse_wheel_filename)
+from packaging.version import InvalidVersion, Version
+
+from yodeploy import interpreters
+from yodeploy.compression import (DEFAULT_LEVEL, make_tarball,
+                                  source_date_epoch)
 
 log = logging.getLogger(__name__)
 
+# The repository app that wheels are shared under, with the platform as the
+# target and the wheel filename as the artifact.
+WHEELHOUSE_APP = 'wheelhouse'
+
 
 def sha224sum(filename):
     m = hashlib.sha224()
@@ -16,8 +29,15 @@ def sha224sum(filename):
     return m.hexdigest()
 
 
+def sha256sum(f):
+    m = hashlib.sha256()
+    for chunk in iter(lambda: f.read(64 * 1024), b''):
+        m.update(chunk)
+    return m.hexdigest()
+
+
 def get_python_version(compat=None, is_deploy=False):
-    python3 = shutil.which('python3')
+    python3 = interpreters.find('python3')
     if not python3:
         log.error(
             'python3 not found in PATH%s' % (
@@ -25,12 +45,7 @@ def get_python_version(compat=None, is_deploy=False):
             )
         )
         sys.exit(1)
-    python3_version = subprocess.check_output(
-        [
-            python3,
-            '-c', 'import sys; print(".".join(map(str, sys.version_info[:2])))'
-        ]
-    ).decode().strip()
+    python3_version = python3['version']
     if is_deploy:
         return python3_version
 
@@ -47,18 +62,136 @@ def get_python_version(compat=None, is_deploy=False):
     return python3_version
 
 
-def get_id(filename, python_version, platform):
-    """Calculate the ID of a virtualenv for the given requirements.txt"""
-    req_hash = sha224sum(filename)
+_COMMENT_RE = re.compile(r'(^|\s+)#.*$')
+_INCLUDE_RE = re.compile(
+    r'^(-r|--requirement|-c|--constraint)(?:\s*=\s*|\s*)(\S+)$')
+
+
+def _logical_lines(filename):
+    """Yield the lines of a requirements file, without comments.
+
+    Continuation lines are joined, and whitespace is collapsed.
+    """
+    with open(filename) as f:
+        pending = ''
+        for line in f:
+            line = line.rstrip('\n')
+            if line.endswith('\\'):
+                pending += line[:-1]
+                continue
+            line = _COMMENT_RE.sub('', pending + line)
+            pending = ''
+            line = ' '.join(line.split())
+            if line:
+                yield line
+
+
+def _normalize_requirement(line):
+    """Return (name, normalized form) of a requirement line.
+
+    The name is None for lines that aren't PEP 508 requirements (e.g. options,
+    editables, paths and URLs).
+    """
+    line, sep, options = line.partition(' --')
+    try:
+        req = Requirement(line)
+    except InvalidRequirement:
+        return None, line + sep + options
+    name = canonicalize_name(req.name)
+    normalized = name
+    if req.extras:
+        normalized += '[%s]' % ','.join(
+            sorted(canonicalize_name(extra) for extra in req.extras))
+    if req.url:
+        normalized += ' @ %s' % req.url
+    else:
+        normalized += str(req.specifier)
+    if req.marker:
+        normalized += '; %s' % req.marker
+    if options:
+        normalized += ' ' + ' '.join(sorted(('--' + options).split()))
+    return name, normalized
+
+
+def parse_requirements(filename, constraint=False, _seen=None):
+    """Parse a requirements file, following -r and -c includes.
+
+    Yields (kind, name, normalized line) tuples, where kind is 'requirement',
+    'constraint' or 'option', and name is the canonical project name (or None).
+    """
+    filename = os.path.abspath(filename)
+    if _seen is None:
+        _seen = set()
+    if filename in _seen:
+        return
+    _seen.add(filename)
+
+    for line in _logical_lines(filename):
+        include = _INCLUDE_RE.match(line)
+        if include:
+            flag, path = include.groups()
+            path = os.path.join(os.path.dirname(filename), path)
+            for entry in parse_requirements(
+                    path, constraint or flag in ('-c', '--constraint'),
+                    _seen):
+                yield entry
+            continue
+        name, normalized = _normalize_requirement(line)
+        if name is None:
+            kind = 'option'
+        elif constraint:
+            kind = 'constraint'
+        else:
+            kind = 'requirement'
+        yield kind, name, normalized
+
+
+def requirements_hash(filename):
+    """Hash the normalized, sorted requirement set of a requirements file.
+
+    Unlike sha224sum(), this is insensitive to ordering, comments,
+    whitespace, and how the requirements are split between included files.
+    """
+    lines = sorted(set('%s %s' % (kind, normalized)
+                       for kind, name, normalized
+                       in parse_requirements(filename)))
+    m = hashlib.sha224()
+    m.update('\n'.join(lines).encode('utf-8'))
+    return m.hexdigest()
+
+
+def get_id(filename, python_version, platform, legacy=False):
+    """Calculate the ID of a virtualenv for the given requirements.txt
+
+    legacy IDs hash the raw bytes of the file, as older releases did.
+    """
+    if legacy:
+        req_hash = sha224sum(filename)
+    else:
+        req_hash = requirements_hash(filename)
     return '%s-%s-%s' % (python_version, platform, req_hash)
 
 
 def download_ve(repository, app, virtualenv_id, target='master',
-                dest='virtualenv.tar.gz'):
-    artifact = 'virtualenv-%s.tar.gz' % virtualenv_id
-    with repository.get(app, target=target, artifact=artifact) as f1:
-        with open(dest, 'wb') as f2:
-            shutil.copyfileobj(f1, f2)
+                dest='virtualenv.tar.gz', fallback_ids=()):
+    """Download a virtualenv tarball.
+
+    If virtualenv_id isn't in the repository, try each of fallback_ids.
+    """
+    for ve_id in (virtualenv_id,) + tuple(fallback_ids):
+        artifact = 'virtualenv-%s.tar.gz' % ve_id
+        try:
+            f1 = repository.get(app, target=target, artifact=artifact)
+        except KeyError:
+            continue
+        if ve_id != virtualenv_id:
+            log.info('Using virtualenv %s in place of %s', ve_id,
+                     virtualenv_id)
+        with f1:
+            with open(dest, 'wb') as f2:
+                shutil.copyfileobj(f1, f2)
+        return ve_id
+    raise KeyError('No such virtualenv: %s' % virtualenv_id)
 
 
 def upload_ve(repository, app, virtualenv_id, target='master',
@@ -66,20 +199,111 @@ def upload_ve(repository, app, virtualenv_id, target='master',
     log.debug('Uploading virtualenv %s for %s', virtualenv_id, app)
     artifact = 'virtualenv-%s.tar.gz' % virtualenv_id
     versions = repository.list_versions(app, target, artifact)
+    with open(source, 'rb') as f:
+        sha256 = sha256sum(f)
     version = '1'
     if versions:
         if not overwrite:
             log.error('Skipping: already exists')
             return
+        metadata = repository.get_metadata(app, versions[-1], target,
+                                           artifact)
+        if metadata.get('sha256') == sha256:
+            log.info('Skipping: identical to version %s', versions[-1])
+            return
         version = str(int(versions[-1]) + 1)
     with open(source, 'rb') as f:
-        repository.put(app, version, f, {}, target, artifact)
+        repository.put(app, version, f, {'sha256': sha256}, target, artifact)
+
+
+def pinned_requirements(req_file):
+    """Return the (canonical name, Version) pairs pinned (==) in req_file.
+
+    Frozen requirements (or constraints) pin every transitive dependency.
+    """
+    pins = set()
+    for kind, name, normalized in parse_requirements(req_file):
+        if kind == 'option':
+            continue
+        specifier = Requirement(normalized.partition(' --')[0]).specifier
+        if len(specifier) != 1:
+            continue
+        spec, = specifier
+        if spec.operator != '==' or spec.version.endswith('.*'):
+            continue
+        try:
+            pins.add((name, Version(spec.version)))
+        except InvalidVersion:
+            continue
+    return pins
+
+
+def wheel_name(filename):
+    """Return the canonical project name of a wheel, or None"""
+    try:
+        return parse_wheel_filename(filename)[0]
+    except InvalidWheelFilename:
+        return None
+
+
+def wheel_pin(filename):
+    """Return the (canonical name, Version) of a wheel, or None"""
+    try:
+        return parse_wheel_filename(filename)[:2]
+    except InvalidWheelFilename:
+        return None
+
+
+def download_wheels(repository, platform, pins, wheelhouse):
+    """Populate the local wheelhouse with the repository's wheels for pins.
+
+    pins are (name, Version) pairs, see pinned_requirements. Unpinned
+    requirements are left for pip to find.
+    """
+    count = 0
+    for artifact in repository.list_artifacts(WHEELHOUSE_APP, platform):
+        dest = os.path.join(wheelhouse, artifact)
+        if wheel_pin(artifact) not in pins or os.path.exists(dest):
+            continue
+        # Concurrent builds may share the wheelhouse
+        part = '%s.%i.part' % (dest, os.getpid())
+        with repository.get(WHEELHOUSE_APP, target=platform,
+                            artifact=artifact) as f1:
+            with open(part, 'wb') as f2:
+                shutil.copyfileobj(f1, f2)
+        os.rename(part, dest)
+        count += 1
+    log.info('Downloaded %i wheels from the repository', count)
+
+
+def upload_wheels(repository, platform, wheelhouse):
+    """Upload wheels in the local wheelhouse that the repository lacks"""
+    existing = set(repository.list_artifacts(WHEELHOUSE_APP, platform))
+    for fn in sorted(os.listdir(wheelhouse)):
+        if fn in existing or not wheel_name(fn):
+            continue
+        log.debug('Uploading wheel %s', fn)
+        with open(os.path.join(wheelhouse, fn), 'rb') as f:
+            repository.put(WHEELHOUSE_APP, '1', f, {}, platform, fn)
+
+
+def install_from_wheelhouse(ve_dir, pypi, wheelhouse, req_file):
+    """Install req_file from wheelhouse, building any missing wheels"""
+    install = ('--no-index', '--find-links', wheelhouse, '-r', req_file)
+    if pip(ve_dir, None, 'install', *install, check=False) == 0:
+        log.info('All requirements were available in the wheelhouse')
+        return
+    log.info('Building missing wheels')
+    pip(ve_dir, pypi, 'wheel', '--find-links', wheelhouse,
+        '--wheel-dir', wheelhouse, '-r', req_file)
+    pip(ve_dir, None, 'install', *install)
 
 
 def create_ve(
         app_dir, python_version, platform, pypi=None,
         req_file='requirements.txt',
-        verify_req_install=True):
+        verify_req_install=True, wheelhouse=None, legacy_id=False,
+        compress_level=DEFAULT_LEVEL, compress_threads=None):
     log.info('Building virtualenv')
     ve_dir = os.path.abspath(os.path.join(app_dir, 'virtualenv'))
     req_file = os.path.join(os.path.abspath(app_dir), req_file)
@@ -128,13 +352,20 @@ def create_ve(
             pip_install(ve_dir, pypi, '-U', 'setuptools<=73.0.1')
         pip_install(ve_dir, pypi, 'wheel')
         log.info('Installing requirements')
-        pip_install(ve_dir, pypi, '-r', req_file)
+        if wheelhouse:
+            install_from_wheelhouse(
+                ve_dir, pypi, os.path.abspath(wheelhouse), req_file)
+        else:
+            pip_install(ve_dir, pypi, '-r', req_file)
         if verify_req_install:
             log.info('Verifying requirements were met')
             check_requirements(ve_dir)
         relocateable_ve(ve_dir, python_version)
+        reproducible = python_version != '2.7'
+        if reproducible:
+            hash_based_pycs(ve_dir)
         ve_id = get_id(
-            req_file, python_version, platform
+            req_file, python_version, platform, legacy=legacy_id
         )
         with open(os.path.join(ve_dir, '.hash'), 'w') as f:
             f.write(ve_id)
@@ -142,11 +373,13 @@ def create_ve(
         log.info('Building virtualenv tarball')
         cwd = os.getcwd()
         os.chdir(app_dir)
-        t = tarfile.open('virtualenv.tar.gz', 'w:gz')
         try:
-            t.add('virtualenv')
+            # Python 2.7 pycs are only valid for the source's mtime
+            mtime = (source_date_epoch() or 0) if reproducible else None
+            make_tarball('virtualenv.tar.gz', ['virtualenv'],
+                         level=compress_level, threads=compress_threads,
+                         mtime=mtime)
         finally:
-            t.close()
             os.chdir(cwd)
     except subprocess.CalledProcessError as e:
         log.error('Failed to create VE: %s', e)
@@ -160,8 +393,16 @@ def create_ve(
 
 
 def pip_install(ve_dir, pypi, *arguments):
+    pip(ve_dir, pypi, 'install', *arguments)
+
+
+def pip(ve_dir, pypi, command, *arguments, check=True):
+    """Run a pip command in the virtualenv.
+
+    Exits on failure, unless check is False, when the exit code is returned.
+    """
     sub_log = logging.getLogger(__name__ + '.pip')
-    cmd = [os.path.join(ve_dir, 'bin', 'python'), '-m', 'pip', 'install']
+    cmd = [os.path.join(ve_dir, 'bin', 'python'), '-m', 'pip', command]
     if pypi:
         cmd += ['--index-url', pypi]
     cmd += arguments
@@ -173,9 +414,33 @@ def pip_install(ve_dir, pypi, *arguments):
         sub_log.info(line.strip())
     if p.returncode != 0:
         for line in stderr.decode().splitlines():
-            sub_log.error(line.strip())
+            if check:
+                sub_log.error(line.strip())
+            else:
+                sub_log.debug(line.strip())
+        if not check:
+            return p.returncode
         log.error('pip exited non-zero (%i)', p.returncode)
         sys.exit(1)
+    return p.returncode
+
+
+def hash_based_pycs(ve_dir):
+    """Recompile the virtualenv's bytecode with hash-based validation.
+
+    Timestamp-based pycs would be invalidated by normalizing the mtimes in
+    the tarball.
+    """
+    log.info('Compiling hash-based bytecode')
+    p = subprocess.Popen(
+        [os.path.join(ve_dir, 'bin', 'python'), '-m', 'compileall', '-q',
+         '-f', '--invalidation-mode', 'checked-hash', ve_dir],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out, err = p.communicate()
+    if p.returncode != 0:
+        # Packages may contain sources for other Python versions
+        log.debug(out.decode().strip())
+        log.warning('Some virtualenv modules failed to compile')
 
 
 def check_requirements(ve_dir):